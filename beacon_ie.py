@@ -0,0 +1,564 @@
+from collections import namedtuple
+from functools import lru_cache
+import logging
+import struct
+import utils
+
+# Declarative bitfield spec. The value is read from
+# byte_data[offset:offset + width] as a little-endian integer, then shifted
+# right by `shift` and masked with `mask` (full width if None). Bytes are read
+# from lowest index, example: [0x00, 0xFF, 0x1A] in wireshark becomes 0x1AFF00.
+# Fields marked `partial` mirror int.from_bytes() over a slice, which accepts
+# truncated IEs instead of failing.
+Field = namedtuple("Field",
+                   ["name", "offset", "width", "shift", "mask", "partial"],
+                   defaults=[1, 0, None, False])
+
+# struct format characters for byte-aligned, full width fields
+struct_fmt = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+def byte_uint_to_int(byte_uint):
+    out = byte_uint
+    # check sign bit
+    if (out & 0x8000) == 0x8000:
+        # if set, invert and add one to get the negative value,
+        # then add the negative sign
+        out = -((out ^ 0xffff) + 1)
+    return out
+
+
+def field_mask(field):
+    if field.mask is None:
+        return (1 << (8 * field.width)) - 1
+    return field.mask
+
+
+class IEDecoder:
+    """Precompiled decoder for one IE (or one ext ID of IE 255).
+
+    `fields` are compiled once into a function that unpacks the fixed part of
+    the IE with a single struct.Struct layout and returns the elements dict.
+    Byte-aligned, full width fields in ascending order map to their own
+    struct items ("<HBH" for BSS Load), otherwise every referenced byte is
+    unpacked and bitfields are evaluated on the local values. `transforms` map
+    field names to a function applied on the raw value, and `extra` decodes
+    the variable-length part of the IE after the fixed fields.
+    """
+
+    def __init__(self, ie_type, fields=(), transforms=None, extra=None):
+        self.ie_type = ie_type
+        self.fields = tuple(fields)
+        self.transforms = transforms or {}
+        self.extra = extra
+        self.decode_fixed = None
+        self.end = 0
+
+        if (len(self.fields) > 0):
+            self.end = max(field.offset + field.width for field in self.fields)
+            self.decode_fixed = self.compile()
+
+    def is_struct_layout(self):
+        pos = 0
+        for field in self.fields:
+            if (field.width not in struct_fmt
+                    or field.shift != 0
+                    or field_mask(field) != (1 << (8 * field.width)) - 1
+                    or field.offset < pos):
+                return False
+            pos = field.offset + field.width
+        return True
+
+    def compile(self):
+        namespace = {"from_bytes": int.from_bytes}
+        start = min(field.offset for field in self.fields)
+        values = list()
+        exprs = list()
+
+        if (self.is_struct_layout()):
+            fmt = "<"
+            pos = start
+            for i, field in enumerate(self.fields):
+                fmt += "x" * (field.offset - pos) + struct_fmt[field.width]
+                pos = field.offset + field.width
+                values.append(f"v{i}")
+                exprs.append(f"v{i}")
+        else:
+            # Unpack every byte used by a field of at most 2 bytes, wider
+            # fields are read directly from the IE
+            used = set()
+            for field in self.fields:
+                if (field.width <= 2):
+                    used.update(range(field.offset, field.offset + field.width))
+            fmt = "<"
+            for offset in range(start, max(used) + 1 if used else start):
+                fmt += "B" if offset in used else "x"
+            values = [f"b{offset}" for offset in sorted(used)]
+
+            for field in self.fields:
+                if (field.width == 1):
+                    expr = f"b{field.offset}"
+                elif (field.width == 2):
+                    expr = f"(b{field.offset} | b{field.offset + 1} << 8)"
+                else:
+                    expr = (f"from_bytes(data[{field.offset}:"
+                            f"{field.offset + field.width}], 'little')")
+                if (field.shift):
+                    expr = f"({expr} >> {field.shift})"
+                if (field_mask(field) != (1 << (8 * field.width)) - 1):
+                    expr = f"({expr} & {field_mask(field):#x})"
+                exprs.append(expr)
+
+        namespace["layout"] = struct.Struct(fmt)
+        source = "def decode_fixed(data):\n"
+        if (len(values) > 0):
+            source += (f"    {', '.join(values)}, = "
+                       f"layout.unpack_from(data, {start})\n")
+        source += "    return {\n"
+        for i, (field, expr) in enumerate(zip(self.fields, exprs)):
+            if (field.name in self.transforms):
+                namespace[f"t{i}"] = self.transforms[field.name]
+                expr = f"t{i}({expr})"
+            source += f"        {field.name!r}: {expr},\n"
+        source += "    }\n"
+
+        exec(compile(source, f"<IEDecoder {self.ie_type}>", "exec"),
+             namespace)
+        return namespace["decode_fixed"]
+
+    def decode(self, byte_data, output):
+        if (self.decode_fixed):
+            if (len(byte_data) < self.end):
+                # Truncated IE, decode field by field until it runs out
+                self.decode_partial(byte_data, output["elements"])
+            else:
+                output["elements"] = self.decode_fixed(byte_data)
+
+        if (self.extra):
+            self.extra(byte_data, output["elements"])
+
+    def decode_partial(self, byte_data, elements):
+        for field in self.fields:
+            chunk = byte_data[field.offset:field.offset + field.width]
+            if (len(chunk) < field.width and not field.partial):
+                raise IndexError(f"{field.name} is out of range")
+            value = ((int.from_bytes(chunk, "little") >> field.shift)
+                     & field_mask(field))
+            if (field.name in self.transforms):
+                value = self.transforms[field.name](value)
+            elements[field.name] = value
+
+
+def ht_mcs_set_fields(offset):
+    # Supported MCS set shared by HT Capabilities and HT Operation
+    return [
+        Field("rx_mcs_bitmask", offset, 10, partial=True),
+        Field("rx_highest_supported_rate", offset + 10, 2, 0, 0x3FF),
+        Field("tx_mcs_set_defined", offset + 12, 1, 0, 0x01),
+        Field("tx_rx_mcs_set_not_equal", offset + 12, 1, 1, 0x01),
+        Field("tx_max_ss_supported", offset + 12, 1, 2, 0x03),
+        Field("tx_unequal_modulation_supported", offset + 12, 1, 4, 0x01),
+    ]
+
+
+def decode_cisco_ccx1(byte_data, elements):
+    # 1 ID | 1 len | 10 unknown | 15 device name | 2 num clients | 3 unknown
+    elements["ap_name"] = byte_data[12:27].decode('utf-8')
+    elements["sta_count"] = int.from_bytes(
+        byte_data[27:29], byteorder='little')
+
+
+def decode_vendor_specific(byte_data, elements):
+    # 1 ID | 1 Len | 3 OUI | 1 OUI Type | vendor specific payload
+    elements["oui"] = byte_data[2:5].hex().lower()
+    elements["oui_type"] = byte_data[5]
+
+    if (elements["oui"] == "000b86"):
+        elements["vendor_name"] = "Aruba"
+        # Only Aruba have subtype
+        elements["oui_subtype"] = byte_data[6]
+        if (elements["oui_type"] == 1 and elements["oui_subtype"] == 3):
+            # Skip byte_data[7] since it's always 0x00
+            elements["ap_name"] = byte_data[8:].decode('utf-8')
+    elif (elements["oui"] == "8cfdf0"):
+        elements["vendor_name"] = "Qualcomm"
+    elif (elements["oui"] == "0050f2"):
+        elements["vendor_name"] = "Microsoft"
+    elif (elements["oui"] == "506f9a"):
+        elements["vendor_name"] = "Wi-Fi Alliance"
+        if (elements["oui_type"] == 28):
+            elements["bssid"] = utils.hex_to_bssid(byte_data[6:12].hex())
+            # Skip byte_data[12] = SSID length
+            elements["ssid"] = byte_data[13:].decode('utf-8')
+
+
+def decode_he_mcs_sets(byte_data, elements):
+    # Optional HE-MCS and NSS sets depend on the supported channel widths
+    if (elements["channel_width_set"] & 4 > 0):
+        elements["supported_rx_mcs_set_160mhz"] = int.from_bytes(
+            byte_data[24:26], byteorder='little')
+        elements["supported_tx_mcs_set_160mhz"] = int.from_bytes(
+            byte_data[26:28], byteorder='little')
+    if (elements["channel_width_set"] & 8 > 0):
+        elements["supported_rx_mcs_set_80+80mhz"] = int.from_bytes(
+            byte_data[28:30], byteorder='little')
+        elements["supported_tx_mcs_set_80+80mhz"] = int.from_bytes(
+            byte_data[30:32], byteorder='little')
+
+
+def decode_he_operation_optionals(byte_data, elements):
+    start_index = 9
+    if (elements["vht_info_present"]):
+        # Decode VHT info
+        elements["vht_info"] = {
+            "channel_width": byte_data[start_index],
+            "channel_center_freq_0": byte_data[start_index + 1],
+            "channel_center_freq_1": byte_data[start_index + 2]
+        }
+        start_index += 3
+
+    if (elements["cohosted_bss"]):
+        elements["max_cohosted_bss_indicator"] = byte_data[start_index]
+        start_index += 1
+
+    if (elements["6ghz_info_present"]):
+        control = byte_data[start_index + 1]
+
+        elements["6ghz_info"] = {
+            "primary_channel": byte_data[start_index],
+            "channel_width": (control & 0x03),
+            "duplicate_beacon": ((control >> 2) & 0x01),
+            "regulatory_info": ((control >> 3) & 0x07),
+            "channel_center_freq_0": byte_data[start_index + 2],
+            "channel_center_freq_1": byte_data[start_index + 3],
+            "min_rate": byte_data[start_index + 4],
+        }
+        start_index += 5
+
+
+# Decoders keyed by IE ID
+ie_decoders = {
+    11: IEDecoder("BSS Load", [
+        Field("sta_count", 2, 2, partial=True),
+        Field("ch_utilization", 4),
+        Field("available_admission_cap", 5, 2, partial=True),
+    ], transforms={"ch_utilization": lambda x: x / 255}),
+
+    35: IEDecoder("TPC Report", [
+        Field("tx_power", 2),
+        Field("link_margin", 3),
+    ], transforms={"tx_power": byte_uint_to_int,
+                   "link_margin": byte_uint_to_int}),
+
+    45: IEDecoder("HT Capabilities", [
+        # HT capabilities info
+        Field("ht_ldpc_coding_capability", 2, 1, 0, 0x01),
+        Field("ht_support_channel_width", 2, 1, 1, 0x01),
+        Field("ht_sm_power_save", 2, 1, 2, 0x03),
+        Field("ht_green_field", 2, 1, 4, 0x01),
+        Field("ht_short_gi_for_20mhz", 2, 1, 5, 0x01),
+        Field("ht_short_gi_for_40mhz", 2, 1, 6, 0x01),
+        Field("ht_tx_stbc", 2, 1, 7, 0x01),
+        Field("ht_rx_stbc", 3, 1, 0, 0x03),
+        Field("ht_delayed_block_ack", 3, 1, 2, 0x01),
+        Field("ht_max_a_msdu_length", 3, 1, 3, 0x01),
+        Field("ht_dsss_cck_mode_in_40mhz", 3, 1, 4, 0x01),
+        Field("ht_psmp_support", 3, 1, 5, 0x01),
+        Field("ht_forty_mhz_intolerant", 3, 1, 6, 0x01),
+        Field("ht_l_sig_txop_protection_support", 3, 1, 7, 0x01),
+        # A-MPDU parameters
+        Field("maximum_rx_a_mpdu_length", 4, 1, 0, 0x03),
+        Field("mpdu_density", 4, 1, 2, 0x07),
+        # Supported MCS set
+        *ht_mcs_set_fields(5),
+        # HT extended capabilities
+        Field("transmitter_supports_pco", 21, 1, 0, 0x01),
+        Field("time_needed_to_transition_between_20mhz_and_40mhz",
+              21, 1, 1, 0x03),
+        Field("mcs_feedback_capability", 22, 1, 0, 0x03),
+        Field("high_throughput", 22, 1, 2, 0x01),
+        Field("reverse_direction_responder", 22, 1, 3, 0x01),
+        # Transmit beamforming capabilities
+        Field("transmit_beamforming", 23, 1, 0, 0x01),
+        Field("receive_staggered_sounding", 23, 1, 1, 0x01),
+        Field("transmit_staggered_sounding", 23, 1, 2, 0x01),
+        Field("receive_null_data_packet_(ndp)", 23, 1, 3, 0x01),
+        Field("transmit_null_data_packet_(ndp)", 23, 1, 4, 0x01),
+        Field("implicit_txbf_capable", 23, 1, 5, 0x01),
+        Field("calibration", 23, 1, 6, 0x03),
+        Field("sta_can_apply_txbf_using_csi_explicit_feedback",
+              24, 1, 0, 0x01),
+        Field(("sta_can_apply_txbf_using_uncompressed_beamforming_feedback_"
+               "matrix"), 24, 1, 1, 0x01),
+        Field(("sta_can_apply_txbf_using_compressed_beamforming_feedback_"
+               "matrix"), 24, 1, 2, 0x01),
+        Field("receiver_can_return_explicit_csi_feedback", 24, 1, 3, 0x03),
+        Field(("receiver_can_return_explicit_uncompressed_beamforming_"
+               "feedback_matrix"), 24, 1, 5, 0x03),
+        Field(("sta_can_compress_and_use_compressed_beamforming_feedback_"
+               "matrix"), 24, 2, 7, 0x03),
+        Field("minimal_grouping_used_for_explicit_feedback_reports",
+              25, 1, 1, 0x03),
+        Field("max_antennae_sta_can_support_when_csi_feedback_required",
+              25, 1, 3, 0x03),
+        Field(("max_antennae_sta_can_support_when_uncompressed_beamforming_"
+               "feedback_required"), 25, 1, 5, 0x03),
+        Field(("max_antennae_sta_can_support_when_compressed_beamforming_"
+               "feedback_required"), 25, 2, 7, 0x03),
+        Field("maximum_number_of_rows_of_csi_explicit_feedback",
+              26, 1, 1, 0x03),
+        Field(("maximum_number_of_space_time_streams_for_which_channel_"
+               "dimensions_can_be_simultaneously_estimated"), 26, 1, 3, 0x03),
+        # ASEL capabilities
+        Field("antenna_selection_capable", 27, 1, 0, 0x01),
+        Field("explicit_csi_feedback_based_tx_asel", 27, 1, 1, 0x01),
+        Field("antenna_indices_feedback_based_tx_asel", 27, 1, 2, 0x01),
+        Field("explicit_csi_feedback", 27, 1, 3, 0x01),
+        Field("antenna_indices_feedback", 27, 1, 4, 0x01),
+        Field("rx_asel", 27, 1, 5, 0x01),
+        Field("tx_sounding_ppdus", 27, 1, 6, 0x01),
+    ]),
+
+    61: IEDecoder("HT Operation", [
+        Field("primary_channel", 2),
+        # HT operation info
+        Field("secondary_channel_offset", 3, 1, 0, 0x03),
+        Field("sta_channel_width", 3, 1, 2, 0x01),
+        Field("rifs_mode", 3, 1, 3, 0x01),
+        Field("ht_protection", 4, 1, 0, 0x03),
+        Field("nongf_ht_sta_present", 4, 1, 2, 0x01),
+        Field("obss_nonht_sta_present", 4, 1, 4, 0x01),
+        Field("channel_center_freq_segment_2", 4, 2, 5, 0xFF),
+        Field("dual_beacon", 6, 1, 6, 0x01),
+        Field("dual_cts_protection", 6, 1, 7, 0x01),
+        Field("stbc_beacon", 7, 1, 0, 0x01),
+        Field("lsig_txop_protection", 7, 1, 1, 0x01),
+        Field("pco_active", 7, 1, 2, 0x01),
+        Field("pco_phase", 7, 1, 3, 0x01),
+        # Basic HT-MCS set
+        *ht_mcs_set_fields(8),
+    ]),
+
+    133: IEDecoder("Cisco CCX1 CKIP", extra=decode_cisco_ccx1),
+
+    191: IEDecoder("VHT Capabilities", [
+        # VHT capabilities info
+        Field("maximum_mpdu_length", 2, 1, 0, 0x03),
+        Field("supported_channel_width_set", 2, 1, 2, 0x03),
+        Field("rx_ldpc", 2, 1, 4, 0x01),
+        Field("short_gi_for_80mhz_tvht_mode_4c", 2, 1, 5, 0x01),
+        Field("short_gi_for_160mhz_and_80+80mhz", 2, 1, 6, 0x01),
+        Field("tx_stbc", 2, 1, 7, 0x01),
+        Field("rx_stbc", 3, 1, 0, 0x07),
+        Field("su_beamformer_capable", 3, 1, 3, 0x01),
+        Field("su_beamformee_capable", 3, 1, 4, 0x01),
+        Field("beamformee_sts_capability", 3, 1, 5, 0x07),
+        Field("number_of_sounding_dimensions", 4, 1, 0, 0x07),
+        Field("mu_beamformer_capable", 4, 1, 3, 0x01),
+        Field("mu_beamformee_capable", 4, 1, 4, 0x01),
+        Field("txop_ps", 4, 1, 5, 0x01),
+        Field("+htc_vht_capable", 4, 1, 6, 0x01),
+        Field("max_a_mpdu_length_exponent", 4, 2, 7, 0x07),
+        Field("vht_link_adaptation", 5, 1, 2, 0x03),
+        Field("rx_antenna_pattern_consistency", 5, 1, 4, 0x01),
+        Field("tx_antenna_pattern_consistency", 5, 1, 5, 0x01),
+        Field("extended_nss_bw_support", 5, 1, 6, 0x03),
+        # Supported VHT-MCS and NSS set
+        Field("supported_rx_mcs_set", 6, 2, partial=True),
+        Field("rx_highest_long_gi_data_rate", 8, 2, 0, 0x1FFF),
+        Field("max_nsts_total", 5, 1, 5, 0x07),
+        Field("supported_tx_mcs_set", 10, 2, partial=True),
+        Field("tx_highest_long_gi_data_rate_", 12, 2, 0, 0x1FFF),
+        Field("extended_nss_bw_capable", 13, 1, 5, 0x01),
+    ]),
+
+    192: IEDecoder("VHT Operation", [
+        Field("channel_width", 2),
+        Field("channel_center_freq_0", 3),
+        Field("channel_center_freq_1", 4),
+        Field("basic_mcs_set", 5, 2, partial=True),
+    ]),
+
+    221: IEDecoder("Vendor Specific", extra=decode_vendor_specific),
+}
+
+# Decoders for IE 255, keyed by ext ID. The ext ID itself is kept as the
+# first element.
+ext_ie_decoders = {
+    35: IEDecoder("HE Capabilities", [
+        Field("ext_id", 2),
+        # HE MAC capabilities info
+        Field("+htc_he_support", 3, 1, 0, 0x01),
+        Field("twt_requester_support", 3, 1, 1, 0x01),
+        Field("twt_responder_support", 3, 1, 2, 0x01),
+        Field("dynamic_fragmentation_support", 3, 1, 3, 0x03),
+        Field("trigger_frame_mac_padding_duration", 4, 1, 2, 0x03),
+        Field("multi_tid_aggregation_rx_support", 4, 1, 4, 0x07),
+        Field("he_link_adaptation_support", 4, 2, 7, 0x03),
+        Field("all_ack_support", 5, 1, 1, 0x01),
+        Field("trs_support", 5, 1, 2, 0x01),
+        Field("bsr_support", 5, 1, 3, 0x01),
+        Field("broadcast_twt_support", 5, 1, 4, 0x01),
+        Field("32_bit_ba_bitmap_support", 5, 1, 5, 0x01),
+        Field("mu_cascading_support", 5, 1, 6, 0x01),
+        Field("ack_enabled_aggregation_support", 5, 1, 7, 0x01),
+        Field("om_control_support", 6, 1, 1, 0x01),
+        Field("ofdma_ra_support", 6, 1, 2, 0x01),
+        Field("maximum_a_mpdu_length_exponent_extension", 6, 1, 3, 0x03),
+        Field("flexible_twt_schedule_support", 6, 1, 6, 0x01),
+        Field("rx_control_frame_to_multibss", 6, 1, 7, 0x01),
+        Field("bsrp_bqrp_a_mpdu_aggregation", 7, 1, 0, 0x01),
+        Field("qtp_support", 7, 1, 1, 0x01),
+        Field("bqr_support", 7, 1, 2, 0x01),
+        Field("psr_responder", 7, 1, 3, 0x01),
+        Field("ndp_feedback_report_support", 7, 1, 4, 0x01),
+        Field("ops_support", 7, 1, 5, 0x01),
+        Field("a_msdu_not_under_ba_in_ack_enabled_a_mpdu_support",
+              7, 1, 6, 0x01),
+        Field("multi_tid_aggregation_tx_support", 7, 2, 7, 0x07),
+        Field("he_subchannel_selective_transmission_support", 8, 1, 2, 0x01),
+        Field("ul_2x996_tone_ru_support", 8, 1, 3, 0x01),
+        Field("om_control_ul_mu_data_disable_rx_support", 8, 1, 4, 0x01),
+        Field("he_dynamic_sm_power_save", 8, 1, 5, 0x01),
+        Field("punctured_sounding_support", 8, 1, 6, 0x01),
+        Field("ht_and_vht_trigger_frame_rx_support", 8, 1, 7, 0x01),
+        # HE PHY capabilities info
+        Field("channel_width_set", 9, 1, 1, 0x7F),
+        Field("punctured_preamble_rx", 10, 1, 0, 0x0F),
+        Field("device_class", 10, 1, 4, 0x01),
+        Field("ldpc_coding_in_payload", 10, 1, 5, 0x01),
+        Field("he_su_ppdu_with_1x_he_ltf_and_0.8us_gi", 10, 1, 6, 0x01),
+        Field("midamble_tx_rx_max_nsts", 10, 2, 7, 0x03),
+        Field("ndp_with_4x_he_ltf_and_3.2us_gi", 11, 1, 1, 0x01),
+        Field("stbc_tx_<=_80mhz", 11, 1, 2, 0x01),
+        Field("stbc_rx_<=_80mhz", 11, 1, 3, 0x01),
+        Field("doppler_tx", 11, 1, 4, 0x01),
+        Field("doppler_rx", 11, 1, 5, 0x01),
+        Field("full_bandwidth_ul_mu_mimo", 11, 1, 6, 0x01),
+        Field("partial_bandwidth_ul_mu_mimo", 11, 1, 7, 0x01),
+        Field("dcm_max_constellation_tx", 12, 1, 0, 0x03),
+        Field("dcm_max_nss_tx", 12, 1, 2, 0x01),
+        Field("dcm_max_constellation_rx", 12, 1, 3, 0x03),
+        Field("dcm_max_nss_rx", 12, 1, 5, 0x01),
+        Field("rx_partial_bw_su_in_20mhz_he_mu_ppdu", 12, 1, 6, 0x01),
+        Field("su_beamformer", 12, 1, 7, 0x01),
+        Field("su_beamformee", 13, 1, 0, 0x01),
+        Field("mu_beamformer", 13, 1, 1, 0x01),
+        Field("beamformee_sts_<=_80mhz", 13, 1, 2, 0x07),
+        Field("beamformee_sts_>_80mhz", 13, 1, 5, 0x07),
+        Field("number_of_sounding_dimensions_<=_80mhz", 14, 1, 0, 0x07),
+        Field("number_of_sounding_dimensions_>_80mhz", 14, 1, 3, 0x07),
+        Field("ng_=_16_su_feedback", 14, 1, 6, 0x01),
+        Field("ng_=_16_mu_feedback", 14, 1, 7, 0x01),
+        Field("codebook_size_su_feedback", 15, 1, 0, 0x01),
+        Field("codebook_size_mu_feedback", 15, 1, 1, 0x01),
+        Field("triggered_su_beamforming_feedback", 15, 1, 2, 0x01),
+        Field("triggered_mu_beamforming_feedback", 15, 1, 3, 0x01),
+        Field("triggered_cqi_feedback", 15, 1, 4, 0x01),
+        Field("partial_bandwidth_extended_range", 15, 1, 5, 0x01),
+        Field("partial_bandwidth_dl_mu_mimo", 15, 1, 6, 0x01),
+        Field("ppe_thresholds_present", 15, 1, 7, 0x01),
+        Field("psr_based_sr_support", 16, 1, 0, 0x01),
+        Field("power_boost_factor_ar_support", 16, 1, 1, 0x01),
+        Field("he_su_ppdu_and_he_mu_ppdu_with_4x_he_ltf_and_0.8us_gi",
+              16, 1, 2, 0x01),
+        Field("max_nc", 16, 1, 3, 0x07),
+        Field("stbc_tx_>_80mhz", 16, 1, 6, 0x01),
+        Field("stbc_rx_>_80mhz", 16, 1, 7, 0x01),
+        Field("he_er_su_ppdu_with_4x_he_ltf_and_0.8us_gi", 17, 1, 0, 0x01),
+        Field("20mhz_in_40mhz_he_ppdu_in_2.4ghz_band", 17, 1, 1, 0x01),
+        Field("20mhz_in_160_80+80mhz_he_ppdu", 17, 1, 2, 0x01),
+        Field("80mhz_in_160_80+80mhz_he_ppdu", 17, 1, 3, 0x01),
+        Field("he_er_su_ppdu_with_1x_he_ltf_and_0.8us_gi", 17, 1, 4, 0x01),
+        Field("midamble_tx_rx_2x_and_1x_he_ltf", 17, 1, 5, 0x01),
+        Field("dcm_max_ru", 17, 1, 6, 0x03),
+        Field("longer_than_16_he_sig_b_ofdm_symbols_support", 18, 1, 0, 0x01),
+        Field("non_triggered_cqi_feedback", 18, 1, 1, 0x01),
+        Field("tx_1024_qam_support_<_242_tone_ru_support", 18, 1, 2, 0x01),
+        Field("rx_1024_qam_support_<_242_tone_ru_support", 18, 1, 3, 0x01),
+        Field("rx_full_bw_su_using_he_mu_ppdu_with_compressed_he_sig_b",
+              18, 1, 4, 0x01),
+        Field("rx_full_bw_su_using_he_mu_ppdu_with_non_compressed_he_sig_b",
+              18, 1, 5, 0x01),
+        Field("nominal_packet_padding", 18, 1, 6, 0x03),
+        Field("he_mu_ppdu_with_more_than_one_ru_rx_max_n_he_ltf",
+              19, 1, 0, 0x01),
+        # Supported HE-MCS and NSS set
+        Field("supported_rx_mcs_set_<=_80mhz", 20, 2, partial=True),
+        Field("supported_tx_mcs_set_<=_80mhz", 22, 2, partial=True),
+    ], extra=decode_he_mcs_sets),
+
+    36: IEDecoder("HE Operation", [
+        Field("ext_id", 2),
+        # HE operation parameters
+        Field("default_pe_duration", 3, 1, 0, 0x07),
+        Field("twt_required", 3, 1, 3, 0x01),
+        Field("txop_dur_rts_thresh", 3, 2, 4, 0x3FF),
+        Field("vht_info_present", 4, 1, 6, 0x01),
+        Field("cohosted_bss", 4, 1, 7, 0x01),
+        Field("er_su_disable", 5, 1, 0, 0x01),
+        Field("6ghz_info_present", 5, 1, 1, 0x01),
+        # BSS color info
+        Field("bss_color", 6, 1, 0, 0x3F),
+        Field("partial_bss_color", 6, 1, 6, 0x01),
+        Field("bss_color_disabled", 6, 1, 7, 0x01),
+        Field("basic_mcs_set", 7, 2, partial=True),
+    ], extra=decode_he_operation_optionals),
+
+    59: IEDecoder("HE 6 GHz Band Capabilities", [
+        Field("ext_id", 2),
+        Field("minimum_mpdu_start_spacing", 3, 1, 0, 0x07),
+        Field("maximum_a_mpdu_length_exponent", 3, 1, 3, 0x07),
+        Field("maximum_mpdu_length", 3, 1, 6, 0x03),
+        Field("sm_power_save", 4, 1, 1, 0x03),
+        Field("rd_responder", 4, 1, 3, 0x01),
+        Field("rx_antenna_pattern_consistency", 4, 1, 4, 0x01),
+        Field("tx_antenna_pattern_consistency", 4, 1, 5, 0x01),
+    ]),
+}
+
+
+@lru_cache(maxsize=4096)
+def decode_ie(ie_hex_string):
+    # The same IEs are seen again on every scan of a session, so keep the
+    # decoded output of recent ones.
+    output = {
+        "id": 0,
+        "raw": ie_hex_string,
+        "type": "Unknown",
+        "elements": {}
+    }
+    # Convert hex string to bytes
+    byte_data = bytes.fromhex(ie_hex_string)
+    output["id"] = byte_data[0]
+
+    try:
+        if (output["id"] == 255):
+            output["elements"]["ext_id"] = byte_data[2]
+            decoder = ext_ie_decoders.get(byte_data[2])
+        else:
+            decoder = ie_decoders.get(output["id"])
+
+        if (decoder):
+            output["type"] = decoder.ie_type
+            decoder.decode(byte_data, output)
+    except Exception as e:
+        logging.error(f"Error parsing IE {ie_hex_string} !\n{e}", exc_info=1)
+
+    return output
+
+
+def copy_output(value):
+    # Deep copy of a decoded IE, which only holds dicts, lists and scalars,
+    # much faster than copy.deepcopy
+    if (isinstance(value, dict)):
+        return {key: copy_output(item) for key, item in value.items()}
+    if (isinstance(value, list)):
+        return [copy_output(item) for item in value]
+    return value
+
+
+def read_beacon_ie(ie_hex_string):
+    # Return a deep copy to keep the cached output intact, callers may edit
+    # the nested element dicts
+    return copy_output(decode_ie(ie_hex_string))
@@ -0,0 +1,495 @@
+import argparse
+import time
+
+# Netlink recording replayed by bench_nl80211, written from
+# sample_nl80211_recording(12)
+nl80211_recording = "samples/nl80211-scan.json"
+
+# Sample IEs as reported by iwlist: BSS Load, TPC Report, HT Capabilities,
+# HT Operation, VHT Capabilities, VHT Operation, 2x Vendor Specific,
+# HE Capabilities, HE Operation, HE 6 GHz Band Capabilities, plus RSN and
+# Extended Capabilities which are not decoded.
+sample_ies = [
+    "0B0552F22665A6",
+    "23020C12",
+    "2D1AD289185D950EE8813609166F6B113D178D6C0FD3901FF239A1A0",
+    "3D1695F20F9395650CF9380B8EDB224A6B248A1E924E8FD0",
+    "BF0CAE2E1A9492A3305F188CB610",
+    "C005900F9E347F",
+    "DD080050F202AE886DC6",
+    "DD078CFDF001507795",
+    "FF1A2300000000000004EC745C4C3FCB2EB2C73E14934C867EE057BA",
+    "FF0724000000007249",
+    "FF033B9BFA",
+    "3014121E836B2AC15726EE7D6B0AF6AB13C38E92CAE0",
+    "7F08D15057B159987F94",
+]
+
+
+def sample_iwlist_output(n_cells):
+    # Fake `iwlist <iface> scanning` output with n_cells cells
+    lines = ["wlan0     Scan completed :"]
+    for i in range(n_cells):
+        channel = [1, 6, 11, 36, 149][i % 5]
+        freq = ("2.4{:02d} GHz".format(12 + 5 * (channel - 1)) if channel < 14
+                else "5.{:03d} GHz".format(5 * channel - 0))
+        lines += [
+            f"          Cell {i + 1:02d} - Address: 02:00:00:00:{i // 256:02X}:"
+            f"{i % 256:02X}",
+            f"                    Channel:{channel}",
+            f"                    Frequency:{freq} (Channel {channel})",
+            "                    Quality=42/70  Signal level=-68 dBm  ",
+            "                    Encryption key:on",
+            f"                    ESSID:\"Network {i}\"",
+            ("                    Bit Rates:1 Mb/s; 2 Mb/s; 5.5 Mb/s; "
+             "11 Mb/s; 9 Mb/s"),
+            "                              18 Mb/s; 36 Mb/s; 54 Mb/s",
+            "                    Bit Rates:6 Mb/s; 12 Mb/s; 24 Mb/s; 48 Mb/s",
+            "                    Mode:Master",
+            "                    Extra:tsf=0000001f5c3a2b10",
+            "                    Extra: Last beacon: 40ms ago",
+            "                    IE: IEEE 802.11i/WPA2 Version 1",
+            "                        Group Cipher : CCMP",
+            "                        Pairwise Ciphers (1) : CCMP",
+            "                        Authentication Suites (1) : PSK",
+        ]
+        lines += [f"                    IE: Unknown: {ie_hex}"
+                  for ie_hex in sample_ies]
+    return "\n".join(lines) + "\n"
+
+
+def sample_ping_output(n_replies):
+    # Fake `ping -D` output with n_replies replies and summary
+    lines = ["PING ns-mn1.cse.nd.edu (129.74.246.1) 56(84) bytes of data."]
+    lines += [f"[{1700000000 + i}.{i % 1000000:06d}] 64 bytes from "
+              f"ns-mn1.cse.nd.edu (129.74.246.1): icmp_seq={i + 1} ttl=54 "
+              f"time={10 + i % 7}.{i % 10}{i % 3} ms"
+              for i in range(n_replies)]
+    lines += [
+        "",
+        "--- ns-mn1.cse.nd.edu ping statistics ---",
+        (f"{n_replies} packets transmitted, {n_replies} received, "
+         f"0% packet loss, time {n_replies * 1000}ms"),
+        "rtt min/avg/max/mdev = 10.000/13.010/16.920/2.012 ms",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def sample_pcap(n_frames):
+    # Fake radiotap pcap with n_frames beacons, QoS data and ACKs from 16
+    # transmitters on one channel
+    import struct
+    out = [struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 765, 127)]
+    for i in range(n_frames):
+        # Radiotap with Flags, Rate, Channel and dBm antenna signal
+        radiotap = struct.pack("<BBHIBBHHbx", 0, 0, 16, 0x2e, 0, 12, 2437,
+                               0xa0, -40 - i % 30)
+        ta = bytes([2, 0, 0, 0, 0, i % 16])
+        kind = i % 3
+        if (kind == 0):
+            frame = (b"\x80\x00\x00\x00" + b"\xff" * 6 + ta + ta
+                     + b"\x00" * 2 + b"\x00" * 12 + b"\x00\x03net")
+        elif (kind == 1):
+            frame = (b"\x88" + (b"\x08" if i % 7 == 0 else b"\x00")
+                     + b"\x00\x00" + ta + ta + ta + b"\x00" * 4
+                     + b"x" * 200)
+        else:
+            frame = b"\xd4\x00\x00\x00" + ta
+        packet = radiotap + frame
+        out.append(struct.pack("<IIII", 1700000000 + i // 1000,
+                               i % 1000 * 1000, len(packet), len(packet)))
+        out.append(packet)
+    return b"".join(out)
+
+
+def sample_nl80211_recording(n_bss, ifindex=3, family_id=28):
+    """Fake netlink recording of a GenlSocket scan on interface ifindex
+    with n_bss BSSes, in the format of `python nl80211.py <iface>
+    <record.json>`: the nl80211 family lookup, the TRIGGER_SCAN ACK, the
+    NEW_SCAN_RESULTS event and the GET_SCAN dump, with multicast events of
+    another interface and a late reply to an earlier request mixed in."""
+    import struct
+    import nl80211
+    from nl80211 import nlmsghdr, genlmsghdr, pack_attr
+
+    def message(msg_type, seq, payload, flags=0):
+        return (nlmsghdr.pack(nlmsghdr.size + len(payload), msg_type, flags,
+                              seq, 4242) + payload
+                + b"\0" * ((4 - len(payload) % 4) % 4))
+
+    def genl(msg_type, seq, cmd, attrs, flags=0):
+        return message(msg_type, seq, genlmsghdr.pack(cmd, 1, 0) + attrs,
+                       flags)
+
+    def ack(seq):
+        return message(nl80211.NLMSG_ERROR, seq, struct.pack("=i", 0)
+                       + nlmsghdr.pack(nlmsghdr.size, 0, 0, seq, 0))
+
+    def event(cmd, event_ifindex):
+        return genl(family_id, 0, cmd, pack_attr(
+            nl80211.NL80211_ATTR_IFINDEX, struct.pack("=I", event_ifindex)))
+
+    bsses = [{
+        "bssid": f"02:00:00:00:{i // 256:02X}:{i % 256:02X}",
+        "freq": [2412, 2437, 2462, 5180, 5745][i % 5],
+        "signal_mbm": -4000 - 100 * (i % 50),
+        "capability": 0x1411,
+        "seen_ms_ago": 40 * i,
+        "associated": i == 1,
+        "ies": bytes.fromhex(f"0009{bytes(f'Net {i:05d}', 'ascii').hex()}"
+                             + "".join(sample_ies)),
+    } for i in range(n_bss)]
+
+    groups = b"".join(
+        pack_attr(index + 1, pack_attr(nl80211.CTRL_ATTR_MCAST_GRP_NAME,
+                                       name.encode() + b"\0")
+                  + pack_attr(nl80211.CTRL_ATTR_MCAST_GRP_ID,
+                              struct.pack("=I", group_id)))
+        for index, (name, group_id) in enumerate(
+            [("config", 4), ("scan", 5), ("regulatory", 6), ("mlme", 7)]))
+    messages = [
+        # resolve_family (seq 1): reply and ACK in one datagram
+        genl(nl80211.GENL_ID_CTRL, 1, 1,
+             pack_attr(nl80211.CTRL_ATTR_FAMILY_NAME, b"nl80211\0")
+             + pack_attr(nl80211.CTRL_ATTR_FAMILY_ID,
+                         struct.pack("=H", family_id))
+             + pack_attr(nl80211.CTRL_ATTR_MCAST_GROUPS, groups))
+        + ack(1),
+        # TRIGGER_SCAN (seq 2): the scan started event comes first
+        event(nl80211.NL80211_CMD_TRIGGER_SCAN, ifindex),
+        ack(2),
+        # Another interface finishing its scan is not ours
+        event(nl80211.NL80211_CMD_NEW_SCAN_RESULTS, ifindex + 4),
+        event(nl80211.NL80211_CMD_NEW_SCAN_RESULTS, ifindex),
+        # Late duplicate ACK of TRIGGER_SCAN, not part of the dump
+        ack(2),
+    ]
+    # GET_SCAN dump (seq 3), a few BSSes per datagram
+    dump = [genl(family_id, 3, nl80211.NL80211_CMD_NEW_SCAN_RESULTS,
+                 pack_attr(nl80211.NL80211_ATTR_IFINDEX,
+                           struct.pack("=I", ifindex))
+                 + pack_attr(nl80211.NL80211_ATTR_BSS, b"".join([
+                     pack_attr(nl80211.NL80211_BSS_BSSID,
+                               bytes.fromhex(bss["bssid"].replace(":", ""))),
+                     pack_attr(nl80211.NL80211_BSS_FREQUENCY,
+                               struct.pack("=I", bss["freq"])),
+                     pack_attr(nl80211.NL80211_BSS_TSF,
+                               struct.pack("=Q", 1000000 * i)),
+                     pack_attr(nl80211.NL80211_BSS_BEACON_INTERVAL,
+                               struct.pack("=H", 100)),
+                     pack_attr(nl80211.NL80211_BSS_CAPABILITY,
+                               struct.pack("=H", bss["capability"])),
+                     pack_attr(nl80211.NL80211_BSS_INFORMATION_ELEMENTS,
+                               bss["ies"]),
+                     pack_attr(nl80211.NL80211_BSS_SIGNAL_MBM,
+                               struct.pack("=i", bss["signal_mbm"])),
+                     pack_attr(nl80211.NL80211_BSS_SEEN_MS_AGO,
+                               struct.pack("=I", bss["seen_ms_ago"])),
+                 ] + ([pack_attr(nl80211.NL80211_BSS_STATUS, struct.pack(
+                     "=I", nl80211.NL80211_BSS_STATUS_ASSOCIATED))]
+                      if bss["associated"] else list()))),
+                 flags=2)
+            for i, bss in enumerate(bsses)]
+    for i in range(0, len(dump), 3):
+        messages.append(b"".join(dump[i:i + 3]))
+        if (i == 3):
+            # Multicast event in the middle of the dump
+            messages.append(event(nl80211.NL80211_CMD_TRIGGER_SCAN,
+                                  ifindex + 4))
+    messages.append(message(nl80211.NLMSG_DONE, 3, struct.pack("=i", 0),
+                            flags=2))
+    return {"ifindex": ifindex,
+            "bss": [nl80211.bss_to_json(bss) for bss in bsses],
+            # GETFAMILY, TRIGGER_SCAN after its reply and GET_SCAN after
+            # the NEW_SCAN_RESULTS event
+            "sent": [0, 1, 5],
+            "messages": [data.hex() for data in messages]}
+
+
+def timeit(func, min_time_s=1.0):
+    # Run func repeatedly for at least min_time_s, return (runs, seconds)
+    runs = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < min_time_s:
+        func()
+        runs += 1
+        elapsed = time.perf_counter() - start
+    return runs, elapsed
+
+
+def bench_ie(min_time_s):
+    from beacon_ie import decode_ie, read_beacon_ie
+
+    def run_cold():
+        decode_ie.cache_clear()
+        for ie_hex in sample_ies:
+            read_beacon_ie(ie_hex)
+
+    def run_warm():
+        for ie_hex in sample_ies:
+            read_beacon_ie(ie_hex)
+
+    for label, func in [("cold", run_cold), ("warm", run_warm)]:
+        runs, elapsed = timeit(func, min_time_s)
+        print(f"read_beacon_ie ({label} cache): "
+              f"{runs * len(sample_ies) / elapsed:,.0f} IEs/s")
+
+
+def bench_scan(min_time_s):
+    from wifi_scan import process_scan_results
+    wifi_link = {"bssid": "02:00:00:00:00:00", "tx_bitrate": "",
+                 "rx_bitrate": ""}
+
+    for n_cells in [10, 100, 1000]:
+        results = sample_iwlist_output(n_cells)
+        runs, elapsed = timeit(
+            lambda: process_scan_results(results, wifi_link), min_time_s)
+        print(f"process_scan_results ({n_cells} cells): "
+              f"{elapsed / runs * 1e3:.2f} ms/scan, "
+              f"{runs * n_cells / elapsed:,.0f} cells/s")
+
+
+def bench_nl80211(min_time_s):
+    # Replay the netlink recording of a scan and check that nl80211.scan()
+    # and wifi_scan.scan_nl80211() get the recorded BSSes. Replay a real
+    # recording with `python nl80211.py wlan0 <record.json>` made on a Pi
+    # by setting nl80211_recording.
+    import logging
+    import nl80211
+    from wifi_scan import bss_to_cell, scan_nl80211
+    logging.disable(logging.WARNING)
+
+    expected = nl80211.ReplaySocket(nl80211_recording).bss
+    bsses = nl80211.scan("wlan0", timeout_s=1,
+                         sock=nl80211.ReplaySocket(nl80211_recording))
+    cells = scan_nl80211("wlan0", timeout_s=1,
+                         sock=nl80211.ReplaySocket(nl80211_recording))
+    if (bsses != expected
+            or cells != [bss_to_cell(bss) for bss in expected]):
+        raise SystemExit(f"Replay of {nl80211_recording} got "
+                         f"{len(bsses)} BSSes and {len(cells)} cells instead "
+                         f"of the {len(expected)} recorded BSSes !")
+
+    runs, elapsed = timeit(
+        lambda: nl80211.scan("wlan0", timeout_s=1, sock=nl80211.ReplaySocket(
+            nl80211_recording)), min_time_s)
+    print(f"nl80211 replay ({len(expected)} BSSes): matches the recording, "
+          f"{elapsed / runs * 1e3:.2f} ms/scan")
+
+
+def bench_ping(min_time_s):
+    from ping import PingParser
+
+    for n_replies in [10, 100, 1000]:
+        lines = sample_ping_output(n_replies).splitlines()
+
+        def run_feed():
+            parser = PingParser()
+            for line in lines:
+                parser.feed(line)
+            return parser
+
+        parser = run_feed()
+        for label, func in [("feed", run_feed), ("result", parser.result)]:
+            runs, elapsed = timeit(func, min_time_s)
+            print(f"PingParser {label} ({n_replies} replies): "
+                  f"{elapsed / runs * 1e3:.3f} ms")
+
+
+def bench_cmd(min_time_s):
+    # Per-command latency of "sudo" commands through cmd_broker versus
+    # starting a shell and sudo, run on a Pi with the broker service up
+    import logging
+    import utils
+    logging.disable(logging.CRITICAL)
+
+    for cmd in ["sudo iw dev", "sudo nmcli --terse device status"]:
+        for use_broker in [False, True]:
+            utils.use_broker = use_broker
+            if (use_broker and not utils.broker_argv(cmd)):
+                print(f"{cmd} (broker): broker not available")
+                continue
+            runs, elapsed = timeit(
+                lambda: utils.run_cmd(cmd, log_result=False), min_time_s)
+            print(f"{cmd} ({'broker' if use_broker else 'shell'}): "
+                  f"{elapsed / runs * 1e3:.2f} ms/cmd")
+    utils.use_broker = True
+    logging.disable(logging.NOTSET)
+
+
+def bench_pcap(min_time_s):
+    from pcap_summary import summarize
+
+    for n_frames in [1000, 10000, 100000]:
+        buf = sample_pcap(n_frames)
+        runs, elapsed = timeit(lambda: summarize(buf), min_time_s)
+        print(f"pcap_summary.summarize ({n_frames} frames): "
+              f"{elapsed / runs * 1e3:.2f} ms, "
+              f"{runs * n_frames / elapsed:,.0f} frames/s")
+
+
+class StandInServer:
+    # Stand-in iperf3 server on a local port: takes one client at a time
+    # after its cookie and denies access to the others, a hung server
+    # accepts clients but never answers
+    def __init__(self, hung=False):
+        import socket
+        import threading
+        self.hung = hung
+        self.busy = False
+        self.lock = threading.Lock()
+        self.held = list()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        import threading
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            if (self.hung):
+                self.held.append(conn)
+                continue
+            with self.lock:
+                busy = self.busy
+                self.busy = True
+            if (busy):
+                conn.sendall(bytes([0xff]))
+                conn.close()
+                continue
+            threading.Thread(target=self.handle, args=(conn,),
+                             daemon=True).start()
+
+    def handle(self, conn):
+        from iperf_ports import COOKIE_SIZE, PARAM_EXCHANGE
+        with conn:
+            try:
+                conn.settimeout(5)
+                if (len(conn.recv(COOKIE_SIZE)) > 0):
+                    conn.sendall(bytes([PARAM_EXCHANGE]))
+                    # The test lasts until the client closes
+                    while conn.recv(4096):
+                        pass
+            except OSError:
+                pass
+        with self.lock:
+            self.busy = False
+
+    def close(self):
+        self.sock.close()
+        for conn in self.held:
+            conn.close()
+
+
+def stand_in_test(port, test_s, timeout_s):
+    # Client side of a test against a StandInServer, returns "done", "busy"
+    # or "timeout"
+    import socket
+    from iperf_ports import PARAM_EXCHANGE, make_cookie
+    with socket.create_connection(("127.0.0.1", port), timeout_s) as sock:
+        try:
+            sock.sendall(make_cookie())
+            if (sock.recv(1) != bytes([PARAM_EXCHANGE])):
+                return "busy"
+        except TimeoutError:
+            return "timeout"
+        time.sleep(test_s)
+    return "done"
+
+
+def bench_ports(min_time_s):
+    # Fleet of Pis running iperf tests against a pool of stand-in servers,
+    # one of them hung, with random ports versus iperf_ports.PortSelector.
+    # Times are scaled down 100x: 0.1s tests, 1.2s client timeout
+    import logging
+    import random
+    import threading
+    from iperf_ports import PortSelector
+    logging.disable(logging.CRITICAL)
+    n_pis, n_ports, test_s, timeout_s = 16, 8, 0.1, 1.2
+
+    for strategy in ["random", "probe"]:
+        servers = ([StandInServer(hung=True)]
+                   + [StandInServer() for _ in range(n_ports - 1)])
+        ports = [server.port for server in servers]
+        lock = threading.Lock()
+        stats = {"done": 0, "wasted": 0, "wasted_s": 0, "probes": 0}
+        deadline = time.monotonic() + max(min_time_s, 5)
+
+        def pi():
+            selector = PortSelector("127.0.0.1", ports, ttl_s=0.3,
+                                    timeout_s=0.01)
+            while time.monotonic() < deadline:
+                # Sessions of different Pis start at random times
+                time.sleep(random.uniform(0, 0.5))
+                start = time.monotonic()
+                while True:
+                    if (strategy == "random"):
+                        port = random.choice(ports)
+                    else:
+                        port = selector.pick()
+                    if (port is None):
+                        status = "busy"
+                        break
+                    status = stand_in_test(port, test_s, timeout_s)
+                    if (status != "busy" or strategy == "random"):
+                        break
+                    selector.mark_busy(port)
+                with lock:
+                    if (status == "done"):
+                        stats["done"] += 1
+                    else:
+                        # A slot that ran no test
+                        stats["wasted"] += 1
+                        stats["wasted_s"] += time.monotonic() - start
+            with lock:
+                stats["probes"] += selector.probes
+
+        threads = [threading.Thread(target=pi) for _ in range(n_pis)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for server in servers:
+            server.close()
+        slots = stats["done"] + stats["wasted"]
+        print(f"iperf ports ({strategy}, {n_pis} Pis, {n_ports} ports, 1 "
+              f"hung): {stats['wasted']}/{slots} slots wasted "
+              f"({stats['wasted'] / max(slots, 1):.1%}), "
+              f"{stats['wasted_s']:.1f}s lost, "
+              f"{stats['probes'] / max(slots, 1):.1f} probes/slot")
+    logging.disable(logging.NOTSET)
+
+
+benchmarks = {
+    "ie": bench_ie,
+    "scan": bench_scan,
+    "nl80211": bench_nl80211,
+    "ping": bench_ping,
+    "cmd": bench_cmd,
+    "pcap": bench_pcap,
+    "ports": bench_ports,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for the measurement hot paths.")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help=("Benchmarks to run, default all. One of: "
+                              f"{', '.join(benchmarks)}."))
+    parser.add_argument("-t", "--min-time", type=float, default=1.0,
+                        help="Minimum run time per benchmark in seconds.")
+    args = parser.parse_args()
+    for name in args.names:
+        if (name not in benchmarks):
+            parser.error(f"Unknown benchmark {name} !")
+
+    for name in (args.names or benchmarks):
+        benchmarks[name](args.min_time)
@@ -0,0 +1,376 @@
+import argparse
+from functools import lru_cache
+import json
+import logging
+import os
+import pwd
+import re
+import selectors
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+# Long-lived privileged helper running the commands that would otherwise be
+# started with "sudo" through a shell. Requests are JSON lines on a Unix
+# socket carrying an argv list, which is checked against the allowlist and
+# executed without a shell.
+#
+# Request:  {"argv": [...], "cwd": "...", "timeout_s": n, "async": false}
+# Response: {"returncode": n, "stdout": "...", "stderr": "..."}, or
+#           {"error": "..."} if the request is refused
+#
+# Async requests get {"pid": n} with the stdout and stderr pipes attached as
+# SCM_RIGHTS, then {"returncode": n} once the process exits. The client can
+# send {"signal": n} to signal the process group meanwhile, the process is
+# killed if the client disconnects.
+
+socket_path = "/run/sigcap-buddy/cmd_broker.sock"
+
+
+def matches(pattern):
+    # Argument check: full match of pattern, and not an option
+    regex = re.compile(pattern, re.DOTALL)
+    return lambda arg: not arg.startswith("-") and bool(regex.fullmatch(arg))
+
+
+def one_of(*values):
+    return lambda arg: arg in values
+
+
+def module_name(path):
+    return os.path.basename(path).split(".ko")[0].replace("-", "_")
+
+
+@lru_cache(maxsize=None)
+def wireless_drivers():
+    """Kernel modules of the running kernel depending on cfg80211, i.e. the
+    Wi-Fi drivers, from modules.dep."""
+    drivers = set()
+    try:
+        with open(f"/lib/modules/{os.uname().release}/modules.dep",
+                  "r") as dep_file:
+            for line in dep_file:
+                module, _, deps = line.partition(":")
+                if ("cfg80211" in map(module_name, deps.split())):
+                    drivers.add(module_name(module))
+    except OSError as e:
+        logging.warning("Cannot read the kernel modules: %s", e)
+    return drivers
+
+
+def wireless_driver(arg):
+    return not arg.startswith("-") and module_name(arg) in wireless_drivers()
+
+
+iface = matches(r"[\w.:@-]{1,15}")
+number = matches(r"\d+")
+address = matches(r"[0-9A-Fa-f.:]+")
+table = matches(r"\w+")
+# SSID, password or connection name
+value = matches(r".+")
+# Empty to clear the BSSID of a connection
+bssid = matches(r"([0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}|")
+
+# Allowed argv shapes after the program name, as the code sends them: each
+# item is a literal argument or a check of the argument, and a final ...
+# allows any number of further arguments that are not options (the tcpdump
+# filter expression).
+allowlist = {
+    "ip": [
+        ("link", "set", iface, one_of("up", "down")),
+        ("route", "replace", "default", "via", address, "dev", iface,
+         "table", table),
+        ("rule", one_of("add", "del"), "from", address, "table", table),
+    ],
+    "iw": [
+        ("dev",),
+        ("dev", iface, "link"),
+        ("dev", iface, "scan", "trigger"),
+        ("dev", iface, "set", "type", one_of("monitor", "managed")),
+        ("dev", iface, "set", "freq", number, number),
+        ("dev", iface, "set", "freq", number, number, number),
+    ],
+    "iwlist": [(iface, "scanning")],
+    "nmcli": [
+        ("--terse", "connection", "show"),
+        ("--terse", "device", "status"),
+        ("--terse", "--fields", "GENERAL.CONNECTION", "device", "show",
+         iface),
+        ("--fields", one_of("connection.interface-name",
+                            "802-11-wireless.bssid"),
+         "connection", "show", value),
+        ("connection", one_of("up", "down", "delete"), value),
+        ("connection", "modify", value, "connection.interface-name", iface),
+        ("connection", "modify", value, "802-11-wireless.bssid", bssid),
+        ("device", "wifi", "connect", value, "password", value),
+    ],
+    "rfkill": [(one_of("block", "unblock"), "wlan")],
+    "modprobe": [(wireless_driver,), ("-r", wireless_driver)],
+    # Capture to stdout only, no -w <file> or -z <program>
+    "tcpdump": [("-i", iface, "-s", number, "-U", "-w", "-", ...)],
+    "systemctl": [
+        (one_of("restart", "stop", "disable"), "speedtest_logger.service"),
+        ("restart", "mqtt.service"),
+    ],
+    "reboot": [()],
+}
+
+ucred = struct.Struct("=iII")
+
+
+def match_shape(args, shape):
+    if (shape and shape[-1] is ...):
+        shape = shape[:-1]
+        if (any(arg.startswith("-") for arg in args[len(shape):])):
+            return False
+        args = args[:len(shape)]
+    return (len(args) == len(shape)
+            and all(arg == item if isinstance(item, str) else item(arg)
+                    for arg, item in zip(args, shape)))
+
+
+def check_argv(argv):
+    return (isinstance(argv, list) and len(argv) > 0
+            and all(isinstance(arg, str) and "\0" not in arg for arg in argv)
+            and any(match_shape(argv[1:], shape)
+                    for shape in allowlist.get(argv[0], [])))
+
+
+def recv_line(conn, buf):
+    # Read a JSON line from conn, returns (message, rest of buffer)
+    while b"\n" not in buf:
+        data = conn.recv(65536)
+        if (not data):
+            return None, b""
+        buf += data
+    line, _, buf = buf.partition(b"\n")
+    return json.loads(line), buf
+
+
+def send_msg(conn, msg, fds=None):
+    data = json.dumps(msg).encode() + b"\n"
+    if (fds):
+        socket.send_fds(conn, [data], fds)
+    else:
+        conn.sendall(data)
+
+
+def handle_sync(conn, argv, request):
+    try:
+        result = subprocess.run(
+            argv,
+            cwd=request.get("cwd"),
+            timeout=request.get("timeout_s"),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        send_msg(conn, {
+            "returncode": result.returncode,
+            "stdout": result.stdout.decode("utf-8", "replace"),
+            "stderr": result.stderr.decode("utf-8", "replace")})
+    except subprocess.TimeoutExpired as e:
+        send_msg(conn, {"timeout": str(e)})
+
+
+def handle_async(conn, argv, request, buf):
+    proc = subprocess.Popen(
+        argv,
+        cwd=request.get("cwd"),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True)
+    send_msg(conn, {"pid": proc.pid},
+             [proc.stdout.fileno(), proc.stderr.fileno()])
+    proc.stdout.close()
+    proc.stderr.close()
+
+    lock = threading.Lock()
+
+    def wait():
+        returncode = proc.wait()
+        with lock:
+            try:
+                send_msg(conn, {"returncode": returncode})
+            except OSError:
+                pass
+
+    waiter = threading.Thread(target=wait, daemon=True)
+    waiter.start()
+    try:
+        while True:
+            msg, buf = recv_line(conn, buf)
+            if (msg is None):
+                break
+            if (proc.poll() is None and "signal" in msg):
+                os.killpg(proc.pid, int(msg["signal"]))
+    except (OSError, ValueError):
+        pass
+    finally:
+        if (proc.poll() is None):
+            logging.warning("Client of %s gone, killing pid %d.",
+                            argv[0], proc.pid)
+            os.killpg(proc.pid, signal.SIGKILL)
+        waiter.join()
+
+
+def handle(conn, allowed_uids):
+    with conn:
+        _, uid, _ = ucred.unpack(conn.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, ucred.size))
+        if (uid not in allowed_uids):
+            logging.warning("Refusing connection from uid %d.", uid)
+            return
+
+        try:
+            request, buf = recv_line(conn, b"")
+            if (request is None):
+                return
+            argv = request.get("argv")
+            if (not check_argv(argv)):
+                logging.warning("Refusing command: %s", argv)
+                send_msg(conn, {"error": "Command not allowed"})
+                return
+            path = shutil.which(argv[0])
+            if (not path):
+                send_msg(conn, {"error": f"{argv[0]} not found"})
+                return
+
+            start = time.monotonic()
+            if (request.get("async")):
+                handle_async(conn, [path] + argv[1:], request, buf)
+            else:
+                handle_sync(conn, [path] + argv[1:], request)
+            logging.info("Ran %s in %.1f ms.", argv,
+                         (time.monotonic() - start) * 1e3)
+        except Exception as e:
+            logging.warning("Broker error: %s", e, exc_info=1)
+            try:
+                send_msg(conn, {"error": str(e)})
+            except OSError:
+                pass
+
+
+def serve(path, user):
+    pw = pwd.getpwnam(user)
+    allowed_uids = {0, pw.pw_uid}
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if (os.path.exists(path)):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chown(path, pw.pw_uid, pw.pw_gid)
+    os.chmod(path, 0o600)
+    server.listen()
+    logging.info("Command broker listening on %s for %s.", path, user)
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=handle, args=(conn, allowed_uids),
+                         daemon=True).start()
+
+
+class BrokerProcess:
+    """Popen-like handle of a command started through the broker."""
+
+    def __init__(self, argv, cwd=None, path=socket_path):
+        self.args = argv
+        self.returncode = None
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.connect(path)
+        send_msg(self.conn, {"argv": argv, "cwd": cwd, "async": True})
+        data, fds, _, _ = socket.recv_fds(self.conn, 65536, 2)
+        line, _, self.buf = data.partition(b"\n")
+        msg = json.loads(line)
+        if ("error" in msg):
+            self.conn.close()
+            raise PermissionError(msg["error"])
+        self.pid = msg["pid"]
+        self.stdout = os.fdopen(fds[0], "rb")
+        self.stderr = os.fdopen(fds[1], "rb")
+
+    def send_signal(self, sig):
+        if (self.returncode is None):
+            send_msg(self.conn, {"signal": int(sig)})
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def wait(self, timeout=None):
+        if (self.returncode is None):
+            self.conn.settimeout(timeout)
+            try:
+                msg, self.buf = recv_line(self.conn, self.buf)
+            except (socket.timeout, BlockingIOError):
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            self.returncode = msg["returncode"] if msg else -1
+            self.conn.close()
+        return self.returncode
+
+    def poll(self):
+        try:
+            return self.wait(0)
+        except subprocess.TimeoutExpired:
+            return None
+
+    def communicate(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout else None
+        out = {self.stdout: [], self.stderr: []}
+        with selectors.DefaultSelector() as selector:
+            for pipe in out:
+                if (not pipe.closed):
+                    selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = (deadline - time.monotonic() if deadline
+                             else None)
+                if (remaining is not None and remaining <= 0):
+                    raise subprocess.TimeoutExpired(self.args, timeout)
+                for key, _ in selector.select(remaining):
+                    data = os.read(key.fd, 65536)
+                    if (data):
+                        out[key.fileobj].append(data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+        self.wait(deadline - time.monotonic() if deadline else None)
+        return b"".join(out[self.stdout]), b"".join(out[self.stderr])
+
+
+def available(path=socket_path):
+    return os.path.exists(path)
+
+
+def run(argv, timeout_s=None, cwd=None, path=socket_path):
+    """Run argv through the broker, returns a dict like utils.run_cmd with
+    raw_out. Raises subprocess.TimeoutExpired on timeout."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        send_msg(conn, {"argv": argv, "cwd": cwd, "timeout_s": timeout_s})
+        msg, _ = recv_line(conn, b"")
+    if (msg is None):
+        raise ConnectionError("Broker closed the connection")
+    elif ("error" in msg):
+        raise PermissionError(msg["error"])
+    elif ("timeout" in msg):
+        raise subprocess.TimeoutExpired(argv, timeout_s)
+    return msg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Privileged command broker for sigcap-buddy.")
+    parser.add_argument("--user", required=True,
+                        help="User allowed to connect to the broker.")
+    parser.add_argument("--socket", default=socket_path,
+                        help="Unix socket path.")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(message)s")
+    serve(args.socket, args.user)
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import firebase_admin
 from firebase_admin import credentials
@@ -6,8 +7,16 @@ from firebase_admin import storage
 from getpass import getuser
 from google.cloud.storage import transfer_manager
 import json
+import log_bundle
 import logging
+import math
+import os
 from pathlib import Path
+import sys
+import threading
+import time
+import upload_queue
+from usage_ledger import UsageLedger
 
 # Firebase setup
 cred = credentials.Certificate(
@@ -20,6 +29,231 @@ firebase_admin.initialize_app(cred, {
 })
 
 
+def set_at(node, keys, value):
+    # Copy of node with value set at the keys path, None deletes
+    if (not keys):
+        return value
+    node = dict(node) if isinstance(node, dict) else dict()
+    child = set_at(node.get(keys[0]), keys[1:], value)
+    if (child is None):
+        node.pop(keys[0], None)
+    else:
+        node[keys[0]] = child
+    return node or None
+
+
+def find_child_key(node, key, value):
+    # Key of the first child of node with node[child][key] == value, in key
+    # order like order_by_child(key).equal_to(value)
+    for child_key in sorted(node or dict()):
+        child = node[child_key]
+        if (isinstance(child, dict) and child.get(key) == value):
+            return child_key
+    return None
+
+
+def write_json_atomic(path, obj):
+    # Write obj as JSON so readers never see a partial file
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as json_file:
+        json.dump(obj, json_file)
+    os.replace(tmp_path, path)
+
+
+class ConfigCache:
+    """Local mirror of this Pi's entries in DB lists, kept up to date with
+    listen() streams.
+
+    The entry of a list whose `key` child equals `value` is found once with
+    order_by_child(key).equal_to(value), and only that entry is listened to,
+    so the entries of the other Pis are never fetched or stored. The entry
+    is looked up again if it is deleted or moves to another Pi. Every
+    update is written to a versioned snapshot on disk, which is served until
+    the first event arrives after a restart.
+
+    A listen() stream that dies quietly sends no more events, so a stream
+    without events for max_age_s is reopened, which sends the whole entry
+    again."""
+
+    max_age_s = 3600
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = Path(snapshot_path)
+        self.lock = threading.Lock()
+        # path: this Pi's entry
+        self.data = dict()
+        # path: {"key", "value", "child"} locating the entry
+        self.refs = dict()
+        self.synced = dict()
+        self.registrations = dict()
+        # path: time.monotonic() of the stream start or last event
+        self.event_s = dict()
+        self.version = 0
+        self.refresh_count = 0
+        self.network_reads = 0
+        self.updated = None
+        self.load()
+
+    def load(self):
+        if (not self.snapshot_path.is_file()):
+            return
+        try:
+            with open(self.snapshot_path, "r") as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            if ("refs" not in snapshot):
+                # Older snapshots mirrored the whole lists, other Pis'
+                # Wi-Fi passwords included
+                self.snapshot_path.unlink()
+                logging.info("Deleted config snapshot of whole lists.")
+                return
+            self.data = snapshot["data"]
+            self.refs = snapshot["refs"]
+            self.version = snapshot["version"]
+            self.updated = datetime.fromisoformat(snapshot["updated"])
+            logging.info("Loaded config snapshot v%d from %s.",
+                         self.version, snapshot["updated"])
+        except Exception as e:
+            logging.warning("Cannot load config snapshot: %s", e)
+
+    def save(self):
+        write_json_atomic(self.snapshot_path, {
+            "version": self.version,
+            "updated": self.updated.isoformat(),
+            "refs": self.refs,
+            "data": self.data})
+
+    def resolve(self, path, key, value):
+        # Find the child key of the entry, returns whether there is one
+        self.network_reads += 1
+        found = db.reference(path).order_by_child(key).equal_to(value).get()
+        child = find_child_key(found, key, value)
+        if (child is None):
+            return False
+        self.close(path)
+        with self.lock:
+            self.refs[path] = {"key": key, "value": value, "child": child}
+            self.data[path] = found[child]
+            self.synced[path] = threading.Event()
+        logging.info("Found db %s entry %s.", path, child)
+        return True
+
+    def close(self, path):
+        # Stop listening to path, outside self.lock as close() waits for
+        # the listener thread, which may be waiting for the lock in on_event
+        registration = self.registrations.pop(path, None)
+        if (registration):
+            registration.close()
+
+    def drop(self, path):
+        # Forget the entry of path and stop listening to it
+        self.close(path)
+        with self.lock:
+            self.refs.pop(path, None)
+            self.data.pop(path, None)
+            self.synced.pop(path, None)
+            self.updated = datetime.now(timezone.utc).astimezone()
+            try:
+                self.save()
+            except Exception as e:
+                logging.warning("Cannot save config snapshot: %s", e)
+
+    def start(self, path):
+        # Subscribe to the entry of path if not listened to yet, or again if
+        # the stream has been silent for max_age_s
+        if (path in self.registrations):
+            if (time.monotonic() - self.event_s[path] < self.max_age_s):
+                return
+            child = self.refs[path]["child"]
+            logging.info("No db %s/%s event for %ds, listening again.",
+                         path, child, self.max_age_s)
+            self.close(path)
+            self.synced[path].clear()
+        child = self.refs[path]["child"]
+        self.synced.setdefault(path, threading.Event())
+        self.event_s[path] = time.monotonic()
+        try:
+            self.registrations[path] = db.reference(
+                f"{path}/{child}").listen(
+                    lambda event, path=path: self.on_event(path, event))
+            logging.info("Listening to db %s/%s.", path, child)
+        except Exception as e:
+            logging.error("Cannot listen to db %s/%s: %s", path, child, e,
+                          exc_info=1)
+
+    def on_event(self, path, event):
+        keys = [key for key in event.path.split("/") if key]
+        with self.lock:
+            if (path not in self.refs):
+                # Dropped meanwhile
+                return
+            self.event_s[path] = time.monotonic()
+            if (event.event_type == "put"):
+                self.data[path] = set_at(self.data.get(path), keys,
+                                         event.data)
+            elif (event.event_type == "patch"):
+                for key, value in event.data.items():
+                    self.data[path] = set_at(
+                        self.data.get(path), keys + key.split("/"), value)
+            else:
+                return
+            self.version += 1
+            self.refresh_count += 1
+            self.updated = datetime.now(timezone.utc).astimezone()
+            try:
+                self.save()
+            except Exception as e:
+                logging.warning("Cannot save config snapshot: %s", e)
+            self.synced[path].set()
+        logging.debug("db %s updated at %s, snapshot v%d.",
+                      path, event.path, self.version)
+
+    def get(self, path, key, value, timeout_s=10, lookup=True):
+        """This Pi's entry of the list at path, the child whose key is value.
+        Returns None if there is none, or if nothing is cached and no event
+        arrived in time."""
+        ref = self.refs.get(path)
+        if (not ref or ref["key"] != key or ref["value"] != value):
+            logging.info("Querying db %s for %s %s.", path, key, value)
+            if (not self.resolve(path, key, value)):
+                return None
+            lookup = False
+        self.start(path)
+        if (not self.synced[path].is_set() and self.data.get(path) is None):
+            self.synced[path].wait(timeout_s)
+        entry = self.data.get(path)
+        if ((entry is None and self.synced[path].is_set())
+                or (entry is not None and entry.get(key) != value)):
+            # The entry was deleted or now belongs to another Pi, look for
+            # ours again
+            logging.warning("db %s entry %s no longer matches %s %s.",
+                            path, self.refs[path]["child"], key, value)
+            self.drop(path)
+            if (lookup):
+                return self.get(path, key, value, timeout_s, lookup=False)
+            return None
+        return entry
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "age_s": ((datetime.now(timezone.utc) - self.updated)
+                      .total_seconds() if self.updated else None),
+            "refresh_count": self.refresh_count,
+            "network_reads": self.network_reads,
+            "synced": all(event.is_set() for event in self.synced.values()),
+        }
+
+    def stop(self):
+        for registration in self.registrations.values():
+            registration.close()
+        self.registrations.clear()
+
+
+# One snapshot per process, speedtest_logger and rpi_pub both read the config
+config_cache = ConfigCache(f".config-cache.{Path(sys.argv[0]).stem}.json")
+
+
 def read_config(mac):
     logging.info("Reading config.json.")
     config = dict()
@@ -27,11 +261,8 @@ def read_config(mac):
         config = json.load(config_file)
 
     try:
-        query = db.reference("config").order_by_child(
-            "mac").equal_to(mac.replace("-", ":")).get()
-        values = list(query.values())
-        if (len(values) > 0):
-            val = values[0]
+        val = config_cache.get("config", "mac", mac.replace("-", ":"))
+        if (val):
             logging.debug(val)
             for key in val:
                 if (key == "rpi_id" and val[key] == ""):
@@ -41,111 +272,206 @@ def read_config(mac):
     except Exception as e:
         logging.error("Cannot connect db config: %s", e, exc_info=1)
 
+    stats = config_cache.stats()
+    logging.info("Config snapshot v%d, %s old, refreshed %d times, %d "
+                 "network reads.", stats["version"],
+                 (f"{stats['age_s']:.0f}s" if stats["age_s"] is not None
+                  else "never"),
+                 stats["refresh_count"], stats["network_reads"])
     return config
 
 
-def push_heartbeat(rpi_id):
-    hb_append_ref = db.reference("hb_append").child(rpi_id)
-    now = datetime.now()
-    timestamp = datetime.timestamp(now) * 1000
-    logging.info("Pushing heartbeat with timestamp %f", timestamp)
-
-    try:
-        found = hb_append_ref.order_by_child(
+class Heartbeat:
+    """Write-behind heartbeat extending the current hb_append segment.
+
+    The segment key, its start and the last beat are kept locally in
+    `state_path`, so a beat is a single update of last_timestamp, or a
+    single push when a new segment starts. Beats that fail while offline
+    only advance the local state and are caught up by the next successful
+    write. A segment left with an unwritten last beat when the next one
+    starts is kept in "pending" and written before it. The DB is queried
+    for the latest segment only when there is no local state yet."""
+
+    # Beats further apart than this start a new segment
+    max_span_ms = 5400000  # 90 minutes
+
+    def __init__(self, state_path):
+        self.state_path = Path(state_path)
+        self.state = None
+        self.writes = 0
+        if (self.state_path.is_file()):
+            try:
+                with open(self.state_path, "r") as state_file:
+                    self.state = json.load(state_file)
+            except Exception as e:
+                logging.warning("Cannot load heartbeat state: %s", e)
+
+    def bootstrap(self, rpi_id):
+        # Get the latest segment from the DB, as the old heartbeat did
+        found = db.reference("hb_append").child(rpi_id).order_by_child(
             "last_timestamp").limit_to_last(1).get()
-        updated = False
-
         if (found and len(found) > 0):
             key = list(found.keys())[0]
-            last_timestamp = found[key]["last_timestamp"]
-            span = (timestamp - last_timestamp)
-            if (span < 5400000):  # 90 minutes
-                logging.debug(("Updating key %s rpi_id %s last_timestamp from "
-                               "%f to %f (span %.3f hour)"),
-                              key, rpi_id, found[key]['last_timestamp'],
-                              timestamp, span / 3600000)
-                ref = hb_append_ref.child(key)
-                ref.update({
-                    "last_timestamp": timestamp
+            return {
+                "rpi_id": rpi_id,
+                "key": key,
+                "start_timestamp": found[key]["start_timestamp"],
+                "last_timestamp": found[key]["last_timestamp"],
+                "written_timestamp": found[key]["last_timestamp"]}
+        return None
+
+    def beat(self, rpi_id):
+        hb_append_ref = db.reference("hb_append").child(rpi_id)
+        timestamp = datetime.timestamp(datetime.now()) * 1000
+        logging.info("Pushing heartbeat with timestamp %f", timestamp)
+
+        try:
+            if (not self.state or self.state["rpi_id"] != rpi_id):
+                self.state = self.bootstrap(rpi_id)
+        except Exception as e:
+            logging.error("Cannot connect db hb_append: %s", e, exc_info=1)
+            return
+
+        state = self.state
+        if (state and timestamp - state["last_timestamp"] < self.max_span_ms):
+            span = timestamp - state["start_timestamp"]
+            logging.debug(("Extending key %s rpi_id %s last_timestamp from "
+                           "%f to %f (span %.3f hour)"),
+                          state["key"], rpi_id, state["written_timestamp"],
+                          timestamp, span / 3600000)
+            state["last_timestamp"] = timestamp
+        else:
+            pending = list()
+            if (state and state["rpi_id"] == rpi_id):
+                pending = state.get("pending", list())
+                if (state["written_timestamp"] != state["last_timestamp"]):
+                    # Last beats of the previous segment not written yet
+                    pending.append({
+                        "key": state["key"],
+                        "start_timestamp": state["start_timestamp"],
+                        "last_timestamp": state["last_timestamp"]})
+            state = self.state = {
+                "rpi_id": rpi_id,
+                "key": None,
+                "start_timestamp": timestamp,
+                "last_timestamp": timestamp,
+                "written_timestamp": None,
+                "pending": pending}
+            logging.debug("Starting new heartbeat segment: %s", state)
+
+        try:
+            # Finish the previous segments first, oldest first
+            pending = state.get("pending", list())
+            while (pending):
+                segment = pending[0]
+                if (segment["key"]):
+                    hb_append_ref.child(segment["key"]).update({
+                        "last_timestamp": segment["last_timestamp"]
+                    })
+                else:
+                    hb_append_ref.push({
+                        "start_timestamp": segment["start_timestamp"],
+                        "last_timestamp": segment["last_timestamp"]
+                    })
+                pending.pop(0)
+                self.writes += 1
+            if (state["key"]):
+                hb_append_ref.child(state["key"]).update({
+                    "last_timestamp": state["last_timestamp"]
                 })
-                updated = True
+            else:
+                state["key"] = hb_append_ref.push({
+                    "start_timestamp": state["start_timestamp"],
+                    "last_timestamp": state["last_timestamp"]
+                }).key
+            state["written_timestamp"] = state["last_timestamp"]
+            self.writes += 1
+        except Exception as e:
+            logging.error("Cannot connect db hb_append, heartbeat kept "
+                          "locally: %s", e, exc_info=1)
 
-        if (not updated):
-            entry = {
-                "start_timestamp": timestamp,
-                "last_timestamp": timestamp
-            }
-            print("new entry:", entry)
-            hb_append_ref.push().set(entry)
-    except Exception as e:
-        logging.error("Cannot connect db hb_append: %s", e, exc_info=1)
+        try:
+            write_json_atomic(self.state_path, state)
+        except Exception as e:
+            logging.warning("Cannot save heartbeat state: %s", e)
 
 
-def get_data_used(rpi_id):
-    data_used_ref = db.reference("data_used").child(rpi_id)
-    try:
-        found = data_used_ref.order_by_child(
-            "last_timestamp").limit_to_last(1).get()
-        if (found and len(found) > 0):
-            key = list(found.keys())[0]
-            return found[key]["data_used_gbytes"]
-        else:
-            return 0
-    except Exception as e:
-        logging.error("Cannot connect db data_used: %s", e, exc_info=1)
-        return 0
+heartbeat = Heartbeat(".heartbeat.json")
 
 
-def push_data_used(rpi_id, data_used_gbytes):
+def push_heartbeat(rpi_id):
+    heartbeat.beat(rpi_id)
+
+
+def import_data_used(rpi_id):
+    # Latest data_used entry to start the usage ledger from
+    found = db.reference("data_used").child(rpi_id).order_by_child(
+        "last_timestamp").limit_to_last(1).get()
+    if (found and len(found) > 0):
+        key = list(found.keys())[0]
+        logging.info("Importing data_used entry %s: %s", key, found[key])
+        return {
+            "start": found[key]["start_timestamp"],
+            "last": found[key]["last_timestamp"],
+            "gbytes": found[key]["data_used_gbytes"],
+            "key": key}
+    return None
+
+
+def sync_data_used(rpi_id, cycle):
+    # Write a usage ledger cycle to its data_used entry, returns the key
     data_used_ref = db.reference("data_used").child(rpi_id)
-    now = datetime.now(timezone.utc).astimezone()
-    logging.info("Pushing data used: %f GB", data_used_gbytes)
+    entry = {
+        "start_timestamp": cycle["start"].isoformat(timespec="seconds"),
+        "last_timestamp": cycle["last"].isoformat(timespec="seconds"),
+        "data_used_gbytes": cycle["gbytes"]
+    }
+    if (cycle["key"]):
+        logging.debug("Updating data_used key %s rpi_id %s: %s",
+                      cycle["key"], rpi_id, entry)
+        del entry["start_timestamp"]
+        data_used_ref.child(cycle["key"]).update(entry)
+        return cycle["key"]
+    else:
+        logging.debug("New data_used entry rpi_id %s: %s", rpi_id, entry)
+        return data_used_ref.push(entry).key
 
-    try:
-        found = data_used_ref.order_by_child(
-            "last_timestamp").limit_to_last(1).get()
-        updated = False
 
-        if (found and len(found) > 0):
-            key = list(found.keys())[0]
-            start_timestamp = datetime.fromisoformat(
-                found[key]["start_timestamp"])
-            last_timestamp = datetime.fromisoformat(
-                found[key]["last_timestamp"])
-            curr_used = found[key]["data_used_gbytes"]
-            timedelta_total = now - start_timestamp
-            if (timedelta_total.days < 32
-                    and now.day >= last_timestamp.day):
-                logging.debug(("Updating key %s rpi_id %s last_timestamp %s "
-                               "data used %.3f GB"),
-                              key, rpi_id, now.isoformat(timespec="seconds"),
-                              (curr_used + data_used_gbytes))
-                ref = data_used_ref.child(key)
-                ref.update({
-                    "last_timestamp": now.isoformat(timespec="seconds"),
-                    "data_used_gbytes": curr_used + data_used_gbytes
-                })
-                updated = True
+usage_ledgers = dict()
 
-        if (not updated):
-            entry = {
-                "start_timestamp": now.isoformat(timespec="seconds"),
-                "last_timestamp": now.isoformat(timespec="seconds"),
-                "data_used_gbytes": data_used_gbytes
-            }
-            print("new entry:", entry)
-            data_used_ref.push().set(entry)
 
-    except Exception as e:
-        logging.error("Cannot connect db data_used: %s", e, exc_info=1)
+def get_usage_ledger(rpi_id):
+    if (rpi_id not in usage_ledgers):
+        ledger = UsageLedger(
+            f".data-usage-{rpi_id}.ledger",
+            sync_func=lambda cycle: sync_data_used(rpi_id, cycle),
+            import_func=lambda: import_data_used(rpi_id))
+        if (not ledger.imported):
+            # Start from the Firebase entry so the cap carries over
+            try:
+                ledger.sync()
+            except Exception as e:
+                logging.error("Cannot connect db data_used: %s", e,
+                              exc_info=1)
+        ledger.start_sync()
+        usage_ledgers[rpi_id] = ledger
+    return usage_ledgers[rpi_id]
+
+
+def get_data_used(rpi_id):
+    return get_usage_ledger(rpi_id).usage()
+
+
+def push_data_used(rpi_id, data_used_gbytes):
+    logging.info("Pushing data used: %f GB", data_used_gbytes)
+    get_usage_ledger(rpi_id).record(data_used_gbytes)
 
 
 def get_wifi_conn(rpi_id):
     logging.info("Getting Wi-Fi connection from Firebase.")
     wifi_ref = None
     try:
-        wifi_ref = db.reference("wifi_v2").order_by_child("rpi_id").equal_to(
-            rpi_id).get()
+        wifi_ref = config_cache.get("wifi_v2", "rpi_id", rpi_id)
     except Exception as e:
         logging.error("Cannot connect db wifi_v2: %s", e, exc_info=1)
 
@@ -153,9 +479,8 @@ def get_wifi_conn(rpi_id):
         logging.warning("Cannot find Wi-Fi info for %s", rpi_id)
         return False
     else:
-        wifi_ref_key = list(wifi_ref.keys())[0]
-        logging.info("Got SSID: %s", wifi_ref[wifi_ref_key]["ssid"])
-        return wifi_ref[wifi_ref_key]
+        logging.info("Got SSID: %s", wifi_ref["ssid"])
+        return dict(wifi_ref)
 
 
 def get_mqtt_conn():
@@ -182,76 +507,181 @@ def get_mqtt_conn():
         return True
 
 
+upload_manifest = upload_queue.UploadQueue()
+
+
+def upload_many(bucket, files, source_dir, rpi_id, max_workers=8,
+                throttle=None, batch_bytes=None):
+    """Upload (file_path, entry) pairs with the workers picked by
+    upload_queue.plan_workers() and record the run. Returns None or an
+    exception for each file, in order.
+
+    If throttle is given, each file is charged to it just before it is
+    sent, or each batch of up to batch_bytes with process workers, which
+    start their uploads together. Files not sent because throttle raised
+    upload_queue.Paused get that exception as their result."""
+    sizes = [entry["size"] for _, entry in files]
+    worker_type, workers = upload_queue.plan_workers(sizes, max_workers)
+    logging.info("Uploading %d files with %d %s workers.",
+                 len(files), workers, worker_type)
+    names = [str(Path(file_path).relative_to(source_dir))
+             for file_path, _ in files]
+    upload_queue.reset_peak_rss()
+    start = time.monotonic()
+
+    if (worker_type == "process"):
+        # Batches of up to batch_bytes, or all files at once
+        batches = [[]]
+        batch_size = 0
+        for i, size in enumerate(sizes):
+            if (batches[-1] and batch_bytes
+                    and batch_size + size > batch_bytes):
+                batches.append(list())
+                batch_size = 0
+            batches[-1].append(i)
+            batch_size += size
+        results = list()
+        for batch in batches:
+            try:
+                if (throttle):
+                    throttle(sum(sizes[i] for i in batch))
+            except upload_queue.Paused as e:
+                results += [e] * (len(files) - len(results))
+                break
+            results += transfer_manager.upload_many_from_filenames(
+                bucket, [names[i] for i in batch],
+                source_directory=str(source_dir),
+                max_workers=min(workers, len(batch)),
+                blob_name_prefix=f"{rpi_id}/",
+                worker_type=transfer_manager.PROCESS
+            )
+        # Per-file timing is not available from the worker processes,
+        # only the wall time is recorded
+        latencies = None
+    else:
+        def upload(file_path, name, size):
+            try:
+                if (throttle):
+                    throttle(size)
+            except upload_queue.Paused as e:
+                return e, None
+            file_start = time.monotonic()
+            try:
+                bucket.blob(f"{rpi_id}/{name}").upload_from_filename(
+                    file_path)
+                result = None
+            except Exception as e:
+                result = e
+            return result, time.monotonic() - file_start
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outcomes = list(executor.map(
+                upload, [file_path for file_path, _ in files], names, sizes))
+        results = [result for result, _ in outcomes]
+        latencies = [latency for _, latency in outcomes
+                     if latency is not None]
+
+    upload_queue.record_run(worker_type, workers, sizes, latencies,
+                            time.monotonic() - start)
+    return results
+
+
 def upload_directory(
     source_dir,
     rpi_id,
-    workers=8
+    workers=8,
+    throttle=None,
+    batch_bytes=None
 ):
-    """Upload every file in a directory, including all files in subdirectories.
-
-    Each blob name is derived from the filename, not including the `directory`
-    parameter itself. For complete control of the blob name for each file (and
-    other aspects of individual blob metadata), use
-    transfer_manager.upload_many() instead.
+    """Upload the files queued in the upload manifest under source_dir.
+
+    Each blob name is the file path relative to source_dir, prefixed with
+    rpi_id. Uploaded files are deleted, failed files are retried with
+    exponential backoff in later calls. Returns the uploaded GB.
+
+    If throttle is given, the bytes of the large files pass through
+    throttle(n) as they are sent in chunks, see upload_queue.ThrottledReader,
+    while each small file is charged to it before it is sent, see
+    upload_many(). Files over batch_bytes, e.g. the burst of a rate limit,
+    also go through the chunked path so none is sent faster than throttle
+    allows. The call returns early if throttle raises upload_queue.Paused.
     """
     logging.info("Uploading files.")
 
-    # The directory on your computer to upload. Files in the directory and its
-    # subdirectories will be uploaded. An empty string means "the current
-    # working directory".
-    # source_dir=
+    # Files written before the manifest existed
+    upload_manifest.bootstrap(source_dir)
 
-    # The maximum number of processes to use for the operation. The performance
-    # impact of this value depends on the use case, but smaller files usually
-    # benefit from a higher number of processes. Each additional process
-    # occupies some CPU and memory resources until finished. Threads can be
-    # used instead of processes by passing `worker_type=transfer_manager.
-    # THREAD`.
-    # workers=8
+    # Pack the result logs into one compressed bundle, so a session is a
+    # single upload and only the compressed bytes count against the cap
+    try:
+        log_bundle.bundle_directory(source_dir, upload_manifest.entries)
+    except Exception as e:
+        logging.error("Cannot bundle logs: %s", e, exc_info=1)
+
+    source_dir = Path(source_dir).resolve()
+    small_files = list()
+    large_files = list()
+    for file_path, entry in upload_manifest.due():
+        if (not Path(file_path).is_file()):
+            logging.warning("Dropping missing file from upload queue: %s.",
+                            file_path)
+            upload_manifest.append({"type": "done", "path": file_path})
+        elif (entry["size"] > min(upload_queue.resumable_threshold,
+                                  batch_bytes or math.inf)):
+            large_files.append((file_path, entry))
+        else:
+            small_files.append((file_path, entry))
+    logging.info("Upload queue: %s, %d files due.", upload_manifest.stats(),
+                 len(small_files) + len(large_files))
+    if (not small_files and not large_files):
+        return 0
 
     bucket = storage.bucket()
-
-    # Generate a list of paths (in string form) relative to the `directory`.
-    # This can be done in a single list comprehension, but is expanded into
-    # multiple lines here for clarity.
-
-    # First, recursively get all files in `directory` as Path objects.
-    directory_as_path_obj = Path(source_dir)
-    paths = directory_as_path_obj.rglob("*")
-
-    # Filter so the list only includes files, not directories themselves.
-    file_paths = [path for path in paths
-                  if path.is_file() and not path.name.endswith(".log")]
-    total_size_gbytes = (sum([path.stat().st_size for path in file_paths])
-                         / 1e9)
-
-    # These paths are relative to the current working directory. Next, make
-    # them relative to `directory`
-    relative_paths = [path.relative_to(source_dir) for path in file_paths]
-
-    # Finally, convert them all to strings.
-    string_paths = [str(path) for path in relative_paths]
-
-    logging.info("Found %d files.", len(string_paths))
-
-    # Start the upload.
-    results = transfer_manager.upload_many_from_filenames(
-        bucket, string_paths, source_directory=source_dir,
-        max_workers=workers, blob_name_prefix=f"{rpi_id}/"
-    )
-
-    for name, result in zip(string_paths, results):
-        # The results list is either `None` or an exception for each filename
-        # in the input list, in order.
-
-        if isinstance(result, Exception):
+    total_size_bytes = 0
+
+    def blob_name(file_path):
+        return str(Path(file_path).relative_to(source_dir))
+
+    # Small files in parallel, one request each
+    paused = False
+    if (small_files):
+        results = upload_many(
+            bucket, small_files, source_dir, rpi_id, workers, throttle,
+            batch_bytes)
+        for (file_path, entry), result in zip(small_files, results):
+            # The results list is either `None` or an exception for each
+            # filename in the input list, in order.
+            if isinstance(result, upload_queue.Paused):
+                # Not sent, stays due
+                paused = True
+                continue
+            total_size_bytes += entry["size"]
+            if isinstance(result, Exception):
+                logging.warning("Failed to upload %s due to exception: %s.",
+                                file_path, result)
+                upload_manifest.fail(file_path, result)
+            else:
+                logging.info("Uploaded %s.", file_path)
+                upload_manifest.done(file_path)
+
+    if (paused):
+        logging.info("Upload paused before some small files.")
+        return total_size_bytes / 1e9
+
+    # Large files in chunks, resuming where a previous attempt stopped
+    for file_path, entry in large_files:
+        blob = bucket.blob(f"{rpi_id}/{blob_name(file_path)}")
+        try:
+            total_size_bytes += upload_manifest.upload_resumable(
+                blob, file_path, entry, throttle)
+            logging.info("Uploaded %s.", file_path)
+            upload_manifest.done(file_path)
+        except upload_queue.Paused:
+            logging.info("Upload paused at %s.", file_path)
+            break
+        except Exception as e:
             logging.warning("Failed to upload %s due to exception: %s.",
-                            name, result)
-        else:
-            logging.info("Uploaded %s.", name)
-            if name != "speedtest_logger.log" and name != "rpi_pub.log":
-                local_copy = Path("{}/{}".format(source_dir, name))
-                local_copy.unlink()
-                logging.info("Deleted local copy: %s.", local_copy)
+                            file_path, e)
+            upload_manifest.fail(file_path, e)
 
-    return total_size_gbytes
+    return total_size_bytes / 1e9
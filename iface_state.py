@@ -0,0 +1,163 @@
+import argparse
+from contextlib import contextmanager
+from glob import glob
+import json
+import logging
+import nl80211
+import select
+import socket
+import struct
+import time
+
+# Interface state from sysfs, and link change events from rtnetlink to wait
+# for transitions instead of sleeping, see include/uapi/linux/rtnetlink.h.
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 1
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+IFLA_IFNAME = 3
+
+IFF_UP = 0x1
+ARPHRD_IEEE80211_RADIOTAP = 803
+
+ifinfomsg = struct.Struct("=BxHiII")
+
+sys_class_net = "/sys/class/net"
+
+# Timed transitions since the last drain()
+transitions = list()
+
+
+def read_sysfs(iface, name):
+    try:
+        with open(f"{sys_class_net}/{iface}/{name}", "r") as sysfs_file:
+            return sysfs_file.read().strip()
+    except OSError:
+        # Missing interface, or carrier of an interface that is down
+        return None
+
+
+def link_state(iface):
+    """State of iface: whether it exists, is administratively up, its
+    operstate ("up" once associated for Wi-Fi), carrier, whether it is in
+    monitor mode and whether its radio is rfkill blocked."""
+    flags = read_sysfs(iface, "flags")
+    if (flags is None):
+        return {"exists": False, "up": False, "operstate": "missing",
+                "carrier": False, "monitor": False, "blocked": False}
+    blocked = False
+    for state_path in glob(f"{sys_class_net}/{iface}/phy80211/rfkill*/*"):
+        if (state_path.endswith(("/soft", "/hard"))):
+            with open(state_path, "r") as state_file:
+                blocked |= state_file.read().strip() == "1"
+    return {
+        "exists": True,
+        "up": bool(int(flags, 16) & IFF_UP),
+        "operstate": read_sysfs(iface, "operstate"),
+        "carrier": read_sysfs(iface, "carrier") == "1",
+        "monitor": (read_sysfs(iface, "type")
+                    == str(ARPHRD_IEEE80211_RADIOTAP)),
+        "blocked": blocked,
+    }
+
+
+class LinkEvents:
+    """rtnetlink subscription to the link changes of iface, None of the
+    methods fail if netlink is unavailable, wait() just times out."""
+
+    def __init__(self, iface):
+        self.iface = iface.encode()
+        try:
+            self.sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self.sock.bind((0, RTMGRP_LINK))
+        except OSError as e:
+            logging.debug("Cannot subscribe to link events: %s", e)
+            self.sock = None
+
+    def wait(self, timeout_s):
+        """Wait up to timeout_s for a link change of iface, returns whether
+        there was one."""
+        deadline = time.monotonic() + timeout_s
+        while True:
+            remaining_s = deadline - time.monotonic()
+            if (remaining_s <= 0):
+                return False
+            if (self.sock is None):
+                time.sleep(remaining_s)
+                return False
+            ready, _, _ = select.select([self.sock], [], [], remaining_s)
+            if (not ready):
+                return False
+            data = self.sock.recv(65536)
+            for msg_type, _, payload in nl80211.parse_messages(data):
+                if (msg_type not in (RTM_NEWLINK, RTM_DELLINK)):
+                    continue
+                attrs = nl80211.parse_attrs(payload[ifinfomsg.size:])
+                if (attrs.get(IFLA_IFNAME, b"").rstrip(b"\0") == self.iface):
+                    return True
+
+    def close(self):
+        if (self.sock):
+            self.sock.close()
+
+
+def wait_for(iface, predicate, timeout_s, poll_s=0.2):
+    """Wait until predicate(link_state(iface)) is true, checking on every
+    link event of iface and at least every poll_s for changes without
+    events (e.g. rfkill). Returns whether it became true in timeout_s."""
+    events = LinkEvents(iface)
+    try:
+        deadline = time.monotonic() + timeout_s
+        while True:
+            if (predicate(link_state(iface))):
+                return True
+            remaining_s = deadline - time.monotonic()
+            if (remaining_s <= 0):
+                return False
+            events.wait(min(remaining_s, poll_s))
+    finally:
+        events.close()
+
+
+@contextmanager
+def transition(iface, name):
+    """Time a transition of iface, set "skipped" in the yielded entry if it
+    was a no-op."""
+    entry = {"iface": iface, "transition": name, "skipped": False}
+    start = time.monotonic()
+    try:
+        yield entry
+    finally:
+        entry["duration_s"] = time.monotonic() - start
+        entry["state"] = link_state(iface)["operstate"]
+        transitions.append(entry)
+        logging.info("Interface %s %s %s in %.2fs, operstate %s.", iface,
+                     name, "skipped" if entry["skipped"] else "done",
+                     entry["duration_s"], entry["state"])
+
+
+def drain():
+    # Return and forget the transitions recorded so far
+    drained = list(transitions)
+    transitions.clear()
+    return drained
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print interface states, or follow their changes.")
+    parser.add_argument("ifaces", nargs="+", help="Interface names.")
+    parser.add_argument("-f", "--follow", action="store_true",
+                        help="Print the state again on every link change.")
+    args = parser.parse_args()
+
+    for iface in args.ifaces:
+        print(iface, json.dumps(link_state(iface)))
+    if (args.follow):
+        events = [LinkEvents(iface) for iface in args.ifaces]
+        while True:
+            for iface, iface_events in zip(args.ifaces, events):
+                if (iface_events.wait(0.1)):
+                    print(iface, json.dumps(link_state(iface)))
@@ -0,0 +1,101 @@
+import argparse
+import logging
+import random
+import socket
+import time
+
+# Port selection for the iperf3 servers, which run one test at a time per
+# port. Ports are probed with the first step of the iperf3 control protocol
+# (see src/iperf_api.c): the client sends a 37 byte cookie, and the server
+# answers PARAM_EXCHANGE if it takes the test or ACCESS_DENIED if it is
+# running one.
+
+PARAM_EXCHANGE = 9
+ACCESS_DENIED = 0xff
+COOKIE_SIZE = 37
+cookie_chars = "abcdefghijklmnopqrstuvwxyz234567"
+
+
+def make_cookie():
+    return ("".join(random.choice(cookie_chars)
+                    for _ in range(COOKIE_SIZE - 1)) + "\0").encode()
+
+
+def probe(server, port, timeout_s=1, dev=None):
+    """State of the iperf3 server on port: "free" if it accepted the cookie,
+    "busy" if it denied access or did not answer within timeout_s, "down" if
+    it cannot be reached. An accepted probe is closed before the parameter
+    exchange, which the server logs as an error before taking the next
+    client. dev binds the probe to an interface (SO_BINDTODEVICE)."""
+    try:
+        family, sock_type, proto, _, addr = socket.getaddrinfo(
+            server, port, type=socket.SOCK_STREAM)[0]
+        with socket.socket(family, sock_type, proto) as sock:
+            sock.settimeout(timeout_s)
+            if (dev):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE,
+                                dev.encode())
+            sock.connect(addr)
+            sock.sendall(make_cookie())
+            state = sock.recv(1)
+    except TimeoutError:
+        return "busy"
+    except OSError as e:
+        logging.debug("iperf port %d on %s: %s", port, server, e)
+        return "down"
+    return "free" if state == bytes([PARAM_EXCHANGE]) else "busy"
+
+
+def busy_reply(error):
+    # Whether an iperf3 client error is the server turning it away
+    return bool(error) and "busy" in error
+
+
+class PortSelector:
+    """Picks the ports of an iperf3 server for the tests of a session.
+
+    Ports found busy or down are skipped for ttl_s, and the others are
+    probed in random order so a fleet of Pis spreads over the ports."""
+
+    def __init__(self, server, ports, ttl_s=30, timeout_s=1):
+        self.server = server
+        self.ports = list(ports)
+        self.ttl_s = ttl_s
+        self.timeout_s = timeout_s
+        # port: time.monotonic() until which it is assumed busy
+        self.busy_until = dict()
+        self.probes = 0
+
+    def mark_busy(self, port):
+        self.busy_until[port] = time.monotonic() + self.ttl_s
+
+    def pick(self, dev=None):
+        """A port whose server accepts a test, None if all are busy."""
+        now = time.monotonic()
+        candidates = [port for port in self.ports
+                      if self.busy_until.get(port, 0) <= now]
+        random.shuffle(candidates)
+        for port in candidates:
+            self.probes += 1
+            state = probe(self.server, port, self.timeout_s, dev)
+            if (state == "free"):
+                return port
+            logging.info("iperf port %d on %s is %s.", port, self.server,
+                         state)
+            self.mark_busy(port)
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Probe the ports of an iperf3 server.")
+    parser.add_argument("server", help="iperf3 server.")
+    parser.add_argument("min_port", type=int, help="First port.")
+    parser.add_argument("max_port", type=int, help="Last port.")
+    parser.add_argument("-d", "--dev", help="Interface to probe from.")
+    parser.add_argument("-t", "--timeout", type=float, default=1,
+                        help="Probe timeout in seconds.")
+    args = parser.parse_args()
+
+    for port in range(args.min_port, args.max_port + 1):
+        print(port, probe(args.server, port, args.timeout, args.dev))
@@ -0,0 +1,153 @@
+import argparse
+import json
+import logging
+import math
+import statistics
+
+# Running counters over the output of iperf3 --json-stream (iperf3 3.17+),
+# one JSON object per line: {"event": "start" | "interval" | "end" | "error",
+# "data": ...}, so a test can be stopped as soon as it has used its data
+# budget or measured its throughput precisely enough.
+
+# Two-sided 95% Student's t quantiles by degrees of freedom
+t_95 = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36,
+        8: 2.31, 9: 2.26, 10: 2.23, 15: 2.13, 20: 2.09, 30: 2.04}
+
+
+def t_quantile(df):
+    # Quantile of the closest tabulated df below, normal above 30
+    if (df > 30):
+        return 1.96
+    return t_95[max(limit for limit in t_95 if limit <= df)]
+
+
+class IperfStream:
+    """Result of one iperf3 --json-stream run, fed line by line.
+
+    feed() returns why the test should stop early, or None: "budget" once
+    the next interval would use more than budget_bytes, "confidence" once
+    the 95% confidence interval of the interval throughputs is within
+    +/- confidence of their mean (0 disables it). The first omit intervals
+    (TCP slow start) are left out of the confidence interval, which needs
+    at least min_intervals others."""
+
+    def __init__(self, budget_bytes=math.inf, confidence=0, omit=1,
+                 min_intervals=3):
+        self.budget_bytes = budget_bytes
+        self.confidence = confidence
+        self.omit = omit
+        self.min_intervals = min_intervals
+        self.start = None
+        self.intervals = list()
+        self.end = None
+        self.error = None
+        self.bytes = 0
+        self.seconds = 0
+        self.samples = list()
+        self.stop_reason = None
+
+    def feed(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            logging.debug("Not an iperf3 event: %s", line)
+            return None
+        data = event.get("data")
+        if (event.get("event") == "start"):
+            self.start = data
+        elif (event.get("event") == "interval"):
+            self.intervals.append(data)
+            return self.count(data["sum"])
+        elif (event.get("event") == "end"):
+            self.end = data
+        elif (event.get("event") == "error"):
+            self.error = data
+        return None
+
+    def count(self, interval_sum):
+        self.bytes += interval_sum["bytes"]
+        self.seconds += interval_sum["seconds"]
+        if (len(self.intervals) > self.omit):
+            self.samples.append(interval_sum["bits_per_second"])
+        if (self.stop_reason):
+            return None
+
+        if (self.bytes + interval_sum["bytes"] > self.budget_bytes):
+            self.stop_reason = "budget"
+        elif (self.confidence > 0
+                and len(self.samples) >= self.min_intervals):
+            mean_bps, ci_bps = self.throughput()
+            if (mean_bps > 0 and ci_bps <= self.confidence * mean_bps):
+                self.stop_reason = "confidence"
+        return self.stop_reason
+
+    def throughput(self):
+        # Mean of the interval throughputs and the half width of its 95%
+        # confidence interval, in bits/s
+        if (len(self.samples) < 2):
+            return (self.samples[0] if self.samples else 0, math.inf)
+        return (statistics.fmean(self.samples),
+                t_quantile(len(self.samples) - 1)
+                * statistics.stdev(self.samples)
+                / math.sqrt(len(self.samples)))
+
+    def result(self):
+        """The same {"start", "intervals", "end"} object as iperf3 -J, with
+        "end" rebuilt from the intervals if the test was stopped before
+        iperf3 reported it. None if iperf3 printed nothing."""
+        if (self.start is None and self.error is None):
+            return None
+        end = self.end
+        if (not end or "sum_sent" not in end or "sum_received" not in end):
+            total = {
+                "start": 0,
+                "end": self.seconds,
+                "seconds": self.seconds,
+                "bytes": self.bytes,
+                "bits_per_second": (8 * self.bytes / self.seconds
+                                    if self.seconds > 0 else 0),
+            }
+            end = dict(end or dict())
+            end["sum_sent"] = dict(total, sender=True)
+            end["sum_received"] = dict(total, sender=False)
+        result = {"start": self.start or dict(), "intervals": self.intervals,
+                  "end": end}
+        if (self.error):
+            result["error"] = self.error
+        if (self.stop_reason):
+            mean_bps, ci_bps = self.throughput()
+            end["early_stop"] = {
+                "reason": self.stop_reason,
+                "bytes": self.bytes,
+                "seconds": self.seconds,
+                "budget_bytes": (self.budget_bytes
+                                 if math.isfinite(self.budget_bytes)
+                                 else None),
+                "confidence": self.confidence,
+                "mean_bps": mean_bps,
+                "ci_bps": ci_bps if math.isfinite(ci_bps) else None,
+            }
+        return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=("Replay a saved iperf3 --json-stream output and print "
+                     "where it would have stopped."))
+    parser.add_argument("stream", help="iperf3 --json-stream output.")
+    parser.add_argument("-b", "--budget-gbytes", type=float,
+                        default=math.inf, help="Data budget in GB.")
+    parser.add_argument("-c", "--confidence", type=float, default=0,
+                        help=("Relative half width of the 95%% confidence "
+                              "interval of the throughput to stop at."))
+    args = parser.parse_args()
+
+    stream = IperfStream(args.budget_gbytes * 1e9, args.confidence)
+    with open(args.stream, "r") as stream_file:
+        for line in stream_file:
+            if (stream.feed(line)):
+                break
+    mean_bps, ci_bps = stream.throughput()
+    print(f"{stream.stop_reason or 'full test'} after {stream.seconds:.1f}s, "
+          f"{stream.bytes / 1e9:.3f} GB, {mean_bps / 1e6:.1f} "
+          f"+/- {ci_bps / 1e6:.1f} Mbps")
@@ -0,0 +1,157 @@
+from array import array
+from datetime import datetime, timedelta, timezone
+import logging
+import nl80211
+import socket
+import threading
+import time
+
+# Stored in the signal ring buffer if the signal is unknown
+no_signal = -32768
+
+
+def read_proc_wireless(iface):
+    # Get the signal level in dBm of iface from /proc/net/wireless, e.g.
+    #  wlan0: 0000   70.  -40.  -256        0      0      0      0      0 ...
+    with open("/proc/net/wireless", "r") as proc_file:
+        for line in proc_file:
+            name, _, values = line.partition(":")
+            if (name.strip() == iface):
+                return (int(float(values.split()[2])), None, None)
+    return None
+
+
+class LinkSampler:
+    """Sample the Wi-Fi link of `iface` at a fixed rate in a thread.
+
+    Station info (signal, tx/rx bitrate) is read with nl80211 GET_STATION,
+    or the signal only from /proc/net/wireless if nl80211 is unavailable.
+    Samples are kept in a ring buffer of `capacity` entries preallocated at
+    start, the oldest samples are overwritten once it is full."""
+
+    def __init__(self, iface, rate_hz=10, capacity=4096):
+        self.iface = iface
+        self.period_s = 1 / rate_hz
+        self.capacity = capacity
+        self.mono_ns = array("q", bytes(8 * capacity))
+        self.signal = array("h", bytes(2 * capacity))
+        self.tx_rate = [None] * capacity
+        self.rx_rate = [None] * capacity
+        self.count = 0
+        self.missed = 0
+        self.cost_ns = 0
+        self.cost_max_ns = 0
+        self.cpu_ns = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name=f"link-sampler-{iface}", daemon=True)
+        # Wall clock at the monotonic start, to convert sample timestamps
+        self.start_ns = time.monotonic_ns()
+        self.start_wall = datetime.now(timezone.utc).astimezone()
+
+    def open_reader(self):
+        # Return a function reading (signal_dbm, tx_rate, rx_rate), and the
+        # socket to close when done
+        try:
+            sock = nl80211.GenlSocket()
+            try:
+                family_id, _ = nl80211.resolve_family(sock, "nl80211")
+                ifindex = socket.if_nametoindex(self.iface)
+                nl80211.get_station(sock, family_id, ifindex)
+            except Exception:
+                sock.close()
+                raise
+            logging.info("Sampling Wi-Fi link of %s with nl80211.", self.iface)
+            return (lambda: nl80211.get_station(sock, family_id, ifindex),
+                    sock)
+        except Exception as e:
+            logging.warning("nl80211 unavailable for link sampling (%s), "
+                            "using /proc/net/wireless.", e)
+            return (lambda: read_proc_wireless(self.iface), None)
+
+    def run(self):
+        read_station, sock = self.open_reader()
+        next_ns = time.monotonic_ns()
+        try:
+            while not self.stop_event.is_set():
+                start_ns = time.monotonic_ns()
+                start_cpu_ns = time.thread_time_ns()
+                try:
+                    station = read_station()
+                except Exception as e:
+                    logging.debug("Link sample error: %s", e)
+                    station = None
+                if (station):
+                    i = self.count % self.capacity
+                    self.mono_ns[i] = start_ns
+                    self.signal[i] = (station[0] if station[0] is not None
+                                      else no_signal)
+                    self.tx_rate[i] = station[1]
+                    self.rx_rate[i] = station[2]
+                    self.count += 1
+                else:
+                    self.missed += 1
+                cost_ns = time.monotonic_ns() - start_ns
+                self.cost_ns += cost_ns
+                self.cost_max_ns = max(self.cost_max_ns, cost_ns)
+                self.cpu_ns += time.thread_time_ns() - start_cpu_ns
+
+                # Keep a fixed rate, skipping ticks if a sample overran
+                next_ns += int(self.period_s * 1e9)
+                now_ns = time.monotonic_ns()
+                if (next_ns < now_ns):
+                    next_ns = now_ns
+                self.stop_event.wait((next_ns - now_ns) / 1e9)
+        finally:
+            if (sock):
+                sock.close()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def stats(self):
+        # Per-sample cost of the sampler itself
+        attempts = self.count + self.missed
+        return {
+            "samples": self.count,
+            "missed": self.missed,
+            "dropped": max(self.count - self.capacity, 0),
+            "mean_cost_us": self.cost_ns / attempts / 1e3 if attempts else 0,
+            "max_cost_us": self.cost_max_ns / 1e3,
+            "mean_cpu_us": self.cpu_ns / attempts / 1e3 if attempts else 0,
+        }
+
+    def results(self):
+        # Samples oldest first, with signal and bitrates formatted like
+        # "iw dev <iface> link" prints them
+        out_arr = []
+        for n in range(max(self.count - self.capacity, 0), self.count):
+            i = n % self.capacity
+            timestamp = self.start_wall + timedelta(
+                microseconds=(self.mono_ns[i] - self.start_ns) // 1000)
+            out_arr.append({
+                "timestamp": timestamp.isoformat(timespec="microseconds"),
+                "rssi": (f"{self.signal[i]} dBm"
+                         if self.signal[i] != no_signal else ""),
+                "tx_bitrate": nl80211.format_rate(self.tx_rate[i]),
+                "rx_bitrate": nl80211.format_rate(self.rx_rate[i])
+            })
+        return out_arr
+
+
+if __name__ == '__main__':
+    # Usage: python link_sampler.py <iface> [duration_s] [rate_hz]
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    sampler = LinkSampler(
+        sys.argv[1], float(sys.argv[3]) if len(sys.argv) > 3 else 10).start()
+    time.sleep(float(sys.argv[2]) if len(sys.argv) > 2 else 5)
+    sampler.stop()
+    for sample in sampler.results():
+        print(sample)
+    print(sampler.stats())
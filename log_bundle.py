@@ -0,0 +1,163 @@
+import argparse
+from collections import defaultdict
+from datetime import datetime, timezone
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+import result_store
+import upload_queue
+
+# Result logs are packed into one gzip'd NDJSON bundle per upload, one line
+# per file: {"path": "iperf-log/<timestamp>.json", "test_uuid": "...",
+# "content": "<original file content>"}. The results kept in result_store
+# are exported as the files they used to be written to.
+bundle_dir = "bundles"
+bundle_suffix = ".ndjson.gz"
+result_dirs = ["iperf-log", "ping-log", "pcap-summary", "session-timeline",
+               "speedtest-log", "wifi-scan"]
+
+
+def find_test_uuid(data):
+    # test_uuid is in "extra" for scans and pings, "start" for iperf and at
+    # the top level for speedtest
+    if (not isinstance(data, dict)):
+        return None
+    for parent in [data.get("extra"), data.get("start"), data]:
+        if (isinstance(parent, dict) and parent.get("test_uuid")):
+            return parent["test_uuid"]
+    return None
+
+
+def queue_orphans(source_dir, queued):
+    # Queue the bundles left out of the upload queue by a crash after their
+    # sources were deleted, queued holds the paths in the queue
+    orphans = [path for path in (source_dir / bundle_dir).glob(
+        f"*{bundle_suffix}") if str(path.resolve()) not in queued]
+    for path in orphans:
+        logging.warning("Queueing bundle left out of the upload queue: %s",
+                        path)
+        upload_queue.add(path)
+    return len(orphans)
+
+
+def fsync_dir(path):
+    # Make a rename in the directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def bundle_directory(source_dir, queued=None):
+    """Pack the result logs under source_dir and the results of result_store
+    not exported yet into a new bundle, and delete the logs. Returns the
+    bundle path, or None if there was nothing to pack.
+
+    The bundle is written and synced, then its sources are deleted and
+    marked exported, and only then is it queued for upload, so a crash
+    never leaves both a queued bundle and its sources to be bundled again.
+    A crash before queueing leaves a bundle outside the queue, which is
+    queued by the next call if queued (the paths in the upload queue) is
+    given."""
+    source_dir = Path(source_dir)
+    if (queued is not None and (source_dir / bundle_dir).is_dir()):
+        queue_orphans(source_dir, queued)
+    file_paths = sorted(
+        path for result_dir in result_dirs
+        for path in (source_dir / result_dir).glob("*.json"))
+    records = result_store.export()
+    if (not file_paths and not records):
+        return None
+
+    (source_dir / bundle_dir).mkdir(exist_ok=True)
+    timestamp = datetime.now(timezone.utc).astimezone().isoformat()
+    bundle_path = source_dir / bundle_dir / f"{timestamp}{bundle_suffix}"
+    tmp_path = bundle_path.with_name(bundle_path.name + ".tmp")
+
+    raw_bytes = 0
+    with open(tmp_path, "wb") as raw_file:
+        with gzip.open(raw_file, "wt", encoding="utf-8") as bundle_file:
+            for path in file_paths:
+                content = path.read_text(encoding="utf-8")
+                raw_bytes += path.stat().st_size
+                try:
+                    test_uuid = find_test_uuid(json.loads(content))
+                except ValueError:
+                    test_uuid = None
+                bundle_file.write(json.dumps({
+                    "path": str(path.relative_to(source_dir)),
+                    "test_uuid": test_uuid,
+                    "content": content}) + "\n")
+            for record in records:
+                raw_bytes += len(record["content"])
+                bundle_file.write(json.dumps({
+                    "path": record["path"],
+                    "test_uuid": record["test_uuid"],
+                    "content": record["content"]}) + "\n")
+        raw_file.flush()
+        os.fsync(raw_file.fileno())
+    os.replace(tmp_path, bundle_path)
+    fsync_dir(bundle_path.parent)
+
+    result_store.mark_exported(records)
+    for path in file_paths:
+        path.unlink()
+    upload_queue.add(bundle_path)
+    result_store.prune()
+
+    bundle_bytes = bundle_path.stat().st_size
+    logging.info("Bundled %d files and %d stored results into %s: %d -> %d "
+                 "bytes, ratio %.1fx, saved %d bytes.", len(file_paths),
+                 len(records), bundle_path, raw_bytes,
+                 bundle_bytes, raw_bytes / bundle_bytes,
+                 raw_bytes - bundle_bytes)
+    return bundle_path
+
+
+def read_bundle(bundle_path):
+    # Yield the records of a bundle
+    with gzip.open(bundle_path, "rt", encoding="utf-8") as bundle_file:
+        for line in bundle_file:
+            yield json.loads(line)
+
+
+def expand_bundle(bundle_path, out_dir):
+    # Write the files of a bundle back in the original layout under out_dir
+    out_dir = Path(out_dir).resolve()
+    count = 0
+    for record in read_bundle(bundle_path):
+        path = (out_dir / record["path"]).resolve()
+        if (out_dir not in path.parents):
+            logging.warning("Skipping path outside %s: %s",
+                            out_dir, record["path"])
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(record["content"], encoding="utf-8")
+        count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=("Expand log bundles into the original files, or list "
+                     "their files by test_uuid."))
+    parser.add_argument("bundles", nargs="+", help="Bundle files.")
+    parser.add_argument("-o", "--out-dir",
+                        help="Directory to expand the bundles into.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    for bundle_path in args.bundles:
+        if (args.out_dir):
+            count = expand_bundle(bundle_path, args.out_dir)
+            print(f"{bundle_path}: expanded {count} files to {args.out_dir}")
+        else:
+            by_uuid = defaultdict(list)
+            for record in read_bundle(bundle_path):
+                by_uuid[record["test_uuid"]].append(record["path"])
+            print(f"{bundle_path}:")
+            for test_uuid, paths in by_uuid.items():
+                print(f"  {test_uuid}: {', '.join(paths)}")
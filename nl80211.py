@@ -0,0 +1,440 @@
+import errno
+import json
+import logging
+import select
+import socket
+import struct
+import time
+
+# Minimal nl80211 client over a generic netlink socket. Only the messages
+# needed for scanning and station info are implemented, see
+# include/uapi/linux/nl80211.h.
+
+NETLINK_GENERIC = 16
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_DUMP = 0x300
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+CTRL_ATTR_MCAST_GROUPS = 7
+CTRL_ATTR_MCAST_GRP_NAME = 1
+CTRL_ATTR_MCAST_GRP_ID = 2
+
+NL80211_CMD_GET_STATION = 17
+NL80211_CMD_GET_SCAN = 32
+NL80211_CMD_TRIGGER_SCAN = 33
+NL80211_CMD_NEW_SCAN_RESULTS = 34
+NL80211_CMD_SCAN_ABORTED = 35
+
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_MAC = 6
+NL80211_ATTR_STA_INFO = 21
+NL80211_ATTR_BSS = 47
+
+NL80211_BSS_BSSID = 1
+NL80211_BSS_FREQUENCY = 2
+NL80211_BSS_TSF = 3
+NL80211_BSS_BEACON_INTERVAL = 4
+NL80211_BSS_CAPABILITY = 5
+NL80211_BSS_INFORMATION_ELEMENTS = 6
+NL80211_BSS_SIGNAL_MBM = 7
+NL80211_BSS_STATUS = 9
+NL80211_BSS_SEEN_MS_AGO = 10
+
+NL80211_BSS_STATUS_ASSOCIATED = 1
+
+NL80211_STA_INFO_SIGNAL = 7
+NL80211_STA_INFO_TX_BITRATE = 8
+NL80211_STA_INFO_RX_BITRATE = 14
+
+NL80211_RATE_INFO_BITRATE = 1
+NL80211_RATE_INFO_MCS = 2
+NL80211_RATE_INFO_40_MHZ_WIDTH = 3
+NL80211_RATE_INFO_SHORT_GI = 4
+NL80211_RATE_INFO_BITRATE32 = 5
+NL80211_RATE_INFO_VHT_MCS = 6
+NL80211_RATE_INFO_VHT_NSS = 7
+NL80211_RATE_INFO_80_MHZ_WIDTH = 8
+NL80211_RATE_INFO_80P80_MHZ_WIDTH = 9
+NL80211_RATE_INFO_160_MHZ_WIDTH = 10
+NL80211_RATE_INFO_HE_MCS = 13
+NL80211_RATE_INFO_HE_NSS = 14
+NL80211_RATE_INFO_HE_GI = 15
+NL80211_RATE_INFO_HE_DCM = 16
+
+nlmsghdr = struct.Struct("=IHHII")
+genlmsghdr = struct.Struct("=BBH")
+nlattr = struct.Struct("=HH")
+
+
+class NetlinkError(Exception):
+    def __init__(self, code):
+        super().__init__(f"netlink error {code} ({errno.errorcode.get(code)})")
+        self.code = code
+
+
+def bss_to_json(bss):
+    return {**bss, "ies": bss["ies"].hex()}
+
+
+def bss_from_json(bss):
+    return {**bss, "ies": bytes.fromhex(bss["ies"])}
+
+
+class GenlSocket:
+    """Generic netlink socket, optionally recording every received datagram
+    to `record_path` for ReplaySocket, with the number of datagrams received
+    before each request and the interface index and BSS list scan() got."""
+
+    def __init__(self, record_path=None):
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        self.record_path = record_path
+        self.recorded = list()
+        self.sent = list()
+        self.ifindex = None
+        self.bss = None
+
+    def send(self, data):
+        if (self.record_path):
+            self.sent.append(len(self.recorded))
+        self.sock.send(data)
+
+    def recv(self, timeout_s):
+        ready, _, _ = select.select([self.sock], [], [], timeout_s)
+        if not ready:
+            raise TimeoutError("netlink recv timed out")
+        data = self.sock.recv(65536)
+        if (self.record_path):
+            self.recorded.append(data.hex())
+        return data
+
+    def add_membership(self, group_id):
+        self.sock.setsockopt(SOL_NETLINK, NETLINK_ADD_MEMBERSHIP, group_id)
+
+    def close(self):
+        self.sock.close()
+        if (self.record_path):
+            logging.info("Writing %d netlink messages to %s.",
+                         len(self.recorded), self.record_path)
+            with open(self.record_path, "w") as record_file:
+                json.dump({
+                    "ifindex": self.ifindex,
+                    "bss": ([bss_to_json(bss) for bss in self.bss]
+                            if self.bss is not None else None),
+                    "sent": self.sent,
+                    "messages": self.recorded}, record_file, indent=1)
+
+
+class ReplaySocket:
+    """Stand-in for GenlSocket that replays datagrams recorded by
+    GenlSocket(record_path=...), allowing scans without a radio. Requests
+    must be sent after as many datagrams as when recording, e.g. GET_SCAN
+    after the NEW_SCAN_RESULTS event. `bss` is the BSS list of the recorded
+    scan, to compare the replay with."""
+
+    def __init__(self, record_path):
+        with open(record_path, "r") as record_file:
+            recording = json.load(record_file)
+        self.recorded = [bytes.fromhex(data)
+                         for data in recording["messages"]]
+        self.ifindex = recording["ifindex"]
+        self.bss = ([bss_from_json(bss) for bss in recording["bss"]]
+                    if recording["bss"] is not None else None)
+        self.sent = recording["sent"]
+        self.received = 0
+        self.seq = 0
+
+    def send(self, data):
+        if (not self.sent or self.sent[0] != self.received):
+            raise RuntimeError(
+                f"netlink request sent after {self.received} datagrams, "
+                f"recorded after {self.sent[0] if self.sent else 'none'}")
+        self.sent.pop(0)
+
+    def recv(self, timeout_s):
+        if (len(self.recorded) == 0):
+            raise TimeoutError("no more recorded netlink messages")
+        self.received += 1
+        return self.recorded.pop(0)
+
+    def add_membership(self, group_id):
+        pass
+
+    def close(self):
+        pass
+
+
+def pack_attr(attr_type, value):
+    length = nlattr.size + len(value)
+    return (nlattr.pack(length, attr_type) + value
+            + b"\0" * ((4 - length % 4) % 4))
+
+
+def parse_attrs(data):
+    attrs = dict()
+    pos = 0
+    while pos + nlattr.size <= len(data):
+        length, attr_type = nlattr.unpack_from(data, pos)
+        if (length < nlattr.size):
+            break
+        # Drop NLA_F_NESTED and NLA_F_NET_BYTEORDER flags
+        attrs[attr_type & 0x3FFF] = data[pos + nlattr.size:pos + length]
+        pos += (length + 3) & ~3
+    return attrs
+
+
+def parse_messages(data):
+    # Yield (type, seq, payload) for every message in a datagram
+    pos = 0
+    while pos + nlmsghdr.size <= len(data):
+        length, msg_type, _, seq, _ = nlmsghdr.unpack_from(data, pos)
+        if (length < nlmsghdr.size):
+            break
+        yield msg_type, seq, data[pos + nlmsghdr.size:pos + length]
+        pos += (length + 3) & ~3
+
+
+def send_genl(sock, family_id, cmd, attrs=b"", flags=NLM_F_REQUEST):
+    sock.seq += 1
+    payload = genlmsghdr.pack(cmd, 1, 0) + attrs
+    sock.send(nlmsghdr.pack(nlmsghdr.size + len(payload), family_id,
+                            flags, sock.seq, 0) + payload)
+    return sock.seq
+
+
+def recv_genl(sock, seq, timeout_s, on_event=None):
+    """Read the replies to request `seq` as (cmd, attrs), stopping at the
+    ACK or end of dump. Messages for other requests (multicast events) are
+    passed to `on_event` instead."""
+    deadline = time.monotonic() + timeout_s
+    while True:
+        data = sock.recv(max(deadline - time.monotonic(), 0))
+        for msg_type, msg_seq, payload in parse_messages(data):
+            if (msg_seq != seq):
+                if (on_event and msg_type >= GENL_ID_CTRL):
+                    on_event(payload[0],
+                             parse_attrs(payload[genlmsghdr.size:]))
+                continue
+            if (msg_type == NLMSG_DONE):
+                return
+            if (msg_type == NLMSG_ERROR):
+                code = -struct.unpack_from("=i", payload)[0]
+                if (code != 0):
+                    raise NetlinkError(code)
+                return
+            yield payload[0], parse_attrs(payload[genlmsghdr.size:])
+
+
+def resolve_family(sock, name, timeout_s=5):
+    # Get the family ID and multicast group IDs of a generic netlink family
+    seq = send_genl(sock, GENL_ID_CTRL, CTRL_CMD_GETFAMILY,
+                    pack_attr(CTRL_ATTR_FAMILY_NAME, name.encode() + b"\0"),
+                    NLM_F_REQUEST | NLM_F_ACK)
+    family_id = 0
+    groups = dict()
+    for _, attrs in recv_genl(sock, seq, timeout_s):
+        family_id = struct.unpack("=H", attrs[CTRL_ATTR_FAMILY_ID][:2])[0]
+        for group in parse_attrs(
+                attrs.get(CTRL_ATTR_MCAST_GROUPS, b"")).values():
+            group = parse_attrs(group)
+            groups[group[CTRL_ATTR_MCAST_GRP_NAME].rstrip(b"\0").decode()] = (
+                struct.unpack("=I", group[CTRL_ATTR_MCAST_GRP_ID])[0])
+    return family_id, groups
+
+
+def parse_bss(attrs):
+    bss = parse_attrs(attrs.get(NL80211_ATTR_BSS, b""))
+    if (NL80211_BSS_BSSID not in bss):
+        return None
+
+    def u32(key, default=0):
+        return struct.unpack("=I", bss[key])[0] if key in bss else default
+
+    return {
+        "bssid": bss[NL80211_BSS_BSSID].hex(":").upper(),
+        "freq": u32(NL80211_BSS_FREQUENCY),
+        "signal_mbm": (struct.unpack("=i", bss[NL80211_BSS_SIGNAL_MBM])[0]
+                       if NL80211_BSS_SIGNAL_MBM in bss else None),
+        "capability": (struct.unpack("=H", bss[NL80211_BSS_CAPABILITY])[0]
+                       if NL80211_BSS_CAPABILITY in bss else 0),
+        "seen_ms_ago": u32(NL80211_BSS_SEEN_MS_AGO),
+        "associated": (u32(NL80211_BSS_STATUS, -1)
+                       == NL80211_BSS_STATUS_ASSOCIATED),
+        "ies": bss.get(NL80211_BSS_INFORMATION_ELEMENTS, b""),
+    }
+
+
+def get_station(sock, family_id, ifindex, timeout_s=1):
+    """Get the station info of the AP `ifindex` is associated with as
+    (signal_dbm, tx_rate, rx_rate). Rates are the raw nested rate info
+    attributes, see format_rate(). Returns None if not associated."""
+    seq = send_genl(sock, family_id, NL80211_CMD_GET_STATION,
+                    pack_attr(NL80211_ATTR_IFINDEX,
+                              struct.pack("=I", ifindex)),
+                    NLM_F_REQUEST | NLM_F_DUMP)
+    station = None
+    for _, attrs in recv_genl(sock, seq, timeout_s):
+        if (station is None and NL80211_ATTR_STA_INFO in attrs):
+            sta_info = parse_attrs(attrs[NL80211_ATTR_STA_INFO])
+            station = (
+                (struct.unpack("=b", sta_info[NL80211_STA_INFO_SIGNAL][:1])[0]
+                 if NL80211_STA_INFO_SIGNAL in sta_info else None),
+                sta_info.get(NL80211_STA_INFO_TX_BITRATE),
+                sta_info.get(NL80211_STA_INFO_RX_BITRATE))
+    return station
+
+
+def get_link(iface, timeout_s=1, sock=None):
+    """The AP `iface` is associated with, as parsed from "iw dev <iface>
+    link": {"bssid", "tx_bitrate", "rx_bitrate"}, empty if not
+    associated."""
+    sock = sock or GenlSocket()
+    link = {"bssid": "", "tx_bitrate": "", "rx_bitrate": ""}
+    try:
+        family_id, _ = resolve_family(sock, "nl80211", timeout_s)
+        seq = send_genl(sock, family_id, NL80211_CMD_GET_STATION,
+                        pack_attr(NL80211_ATTR_IFINDEX, struct.pack(
+                            "=I", socket.if_nametoindex(iface))),
+                        NLM_F_REQUEST | NLM_F_DUMP)
+        for _, attrs in recv_genl(sock, seq, timeout_s):
+            if (not link["bssid"] and NL80211_ATTR_MAC in attrs
+                    and NL80211_ATTR_STA_INFO in attrs):
+                sta_info = parse_attrs(attrs[NL80211_ATTR_STA_INFO])
+                link = {
+                    "bssid": attrs[NL80211_ATTR_MAC].hex(":").upper(),
+                    "tx_bitrate": format_rate(
+                        sta_info.get(NL80211_STA_INFO_TX_BITRATE)),
+                    "rx_bitrate": format_rate(
+                        sta_info.get(NL80211_STA_INFO_RX_BITRATE)),
+                }
+        return link
+    finally:
+        sock.close()
+
+
+def format_rate(rate):
+    # Format nested rate info attributes like "iw dev <iface> link" does,
+    # e.g. "433.3 MBit/s VHT-MCS 9 80MHz short GI VHT-NSS 1"
+    if (not rate):
+        return ""
+    attrs = parse_attrs(rate)
+
+    def u8(key):
+        return attrs[key][0]
+
+    if (NL80211_RATE_INFO_BITRATE32 in attrs):
+        bitrate = struct.unpack("=I", attrs[NL80211_RATE_INFO_BITRATE32])[0]
+    elif (NL80211_RATE_INFO_BITRATE in attrs):
+        bitrate = struct.unpack("=H", attrs[NL80211_RATE_INFO_BITRATE][:2])[0]
+    else:
+        return ""
+    out = f"{bitrate // 10}.{bitrate % 10} MBit/s"
+
+    if (NL80211_RATE_INFO_MCS in attrs):
+        out += f" MCS {u8(NL80211_RATE_INFO_MCS)}"
+    if (NL80211_RATE_INFO_VHT_MCS in attrs):
+        out += f" VHT-MCS {u8(NL80211_RATE_INFO_VHT_MCS)}"
+    for key, label in [(NL80211_RATE_INFO_40_MHZ_WIDTH, "40MHz"),
+                       (NL80211_RATE_INFO_80_MHZ_WIDTH, "80MHz"),
+                       (NL80211_RATE_INFO_80P80_MHZ_WIDTH, "80P80MHz"),
+                       (NL80211_RATE_INFO_160_MHZ_WIDTH, "160MHz"),
+                       (NL80211_RATE_INFO_SHORT_GI, "short GI")]:
+        if (key in attrs):
+            out += f" {label}"
+    for key, label in [(NL80211_RATE_INFO_VHT_NSS, "VHT-NSS"),
+                       (NL80211_RATE_INFO_HE_MCS, "HE-MCS"),
+                       (NL80211_RATE_INFO_HE_NSS, "HE-NSS"),
+                       (NL80211_RATE_INFO_HE_GI, "HE-GI"),
+                       (NL80211_RATE_INFO_HE_DCM, "HE-DCM")]:
+        if (key in attrs):
+            out += f" {label} {u8(key)}"
+    return out
+
+
+def scan(iface, timeout_s=30, trigger=None, sock=None):
+    """Trigger a scan on `iface`, wait for the NEW_SCAN_RESULTS event and
+    return the BSS list. Triggering needs CAP_NET_ADMIN, which the
+    speedtest_logger service gets as an ambient capability. Without it
+    (EPERM), `trigger` is called instead, e.g. to run `iw scan trigger`
+    through sudo. Pass a ReplaySocket as `sock` to replay a recording."""
+    sock = sock or GenlSocket()
+    if (isinstance(sock, GenlSocket)):
+        sock.ifindex = socket.if_nametoindex(iface)
+    ifindex = sock.ifindex
+    ifindex_attr = pack_attr(NL80211_ATTR_IFINDEX, struct.pack("=I", ifindex))
+    done = list()
+
+    def on_event(cmd, attrs):
+        event_ifindex = struct.unpack(
+            "=I", attrs.get(NL80211_ATTR_IFINDEX, b"\0\0\0\0"))[0]
+        if (cmd in (NL80211_CMD_NEW_SCAN_RESULTS, NL80211_CMD_SCAN_ABORTED)
+                and event_ifindex == ifindex):
+            done.append(cmd)
+
+    try:
+        family_id, groups = resolve_family(sock, "nl80211")
+        # Subscribe before triggering so the results event is not missed
+        sock.add_membership(groups["scan"])
+
+        try:
+            seq = send_genl(sock, family_id, NL80211_CMD_TRIGGER_SCAN,
+                            ifindex_attr, NLM_F_REQUEST | NLM_F_ACK)
+            for _ in recv_genl(sock, seq, timeout_s, on_event):
+                pass
+        except NetlinkError as e:
+            if (e.code == errno.EPERM and trigger):
+                logging.info("No CAP_NET_ADMIN to trigger a scan on %s, "
+                             "using the fallback.", iface)
+                trigger()
+            elif (e.code != errno.EBUSY):
+                # EBUSY means a scan is already running, wait for it
+                raise
+
+        deadline = time.monotonic() + timeout_s
+        try:
+            while not done:
+                data = sock.recv(max(deadline - time.monotonic(), 0))
+                for msg_type, _, payload in parse_messages(data):
+                    if (msg_type >= GENL_ID_CTRL):
+                        on_event(payload[0],
+                                 parse_attrs(payload[genlmsghdr.size:]))
+        except TimeoutError:
+            logging.warning("No nl80211 scan results event on %s after %ds, "
+                            "reading cached results.", iface, timeout_s)
+        if (done and done[0] == NL80211_CMD_SCAN_ABORTED):
+            logging.warning("nl80211 scan on %s aborted, reading cached "
+                            "results.", iface)
+
+        seq = send_genl(sock, family_id, NL80211_CMD_GET_SCAN, ifindex_attr,
+                        NLM_F_REQUEST | NLM_F_DUMP)
+        results = list()
+        for _, attrs in recv_genl(sock, seq, timeout_s):
+            bss = parse_bss(attrs)
+            if (bss):
+                results.append(bss)
+        sock.bss = results
+        return results
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    # Usage: python nl80211.py <iface> [record.json]
+    # Scan and print BSSes, recording the netlink messages for ReplaySocket
+    import sys
+    record_path = sys.argv[2] if len(sys.argv) > 2 else None
+    for bss in scan(sys.argv[1], sock=GenlSocket(record_path)):
+        print(bss["bssid"], bss["freq"], bss["signal_mbm"],
+              bss["associated"], bss["ies"].hex())
@@ -0,0 +1,166 @@
+import argparse
+import json
+import logging
+
+try:
+    from jeepney import DBusAddress, DBusErrorResponse, new_method_call
+    from jeepney.wrappers import unwrap_msg
+    from jeepney.io.blocking import open_dbus_connection
+    dbus_errors = (DBusErrorResponse, OSError)
+except ImportError:
+    # jeepney missing, setup_network uses nmcli
+    open_dbus_connection = None
+    dbus_errors = (OSError,)
+
+# Minimal NetworkManager client over the system D-Bus, see
+# https://networkmanager.dev/docs/api/latest/spec.html
+
+bus_name = "org.freedesktop.NetworkManager"
+nm_path = "/org/freedesktop/NetworkManager"
+nm_interface = "org.freedesktop.NetworkManager"
+device_interface = "org.freedesktop.NetworkManager.Device"
+active_interface = "org.freedesktop.NetworkManager.Connection.Active"
+connection_interface = "org.freedesktop.NetworkManager.Settings.Connection"
+
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+
+# Polkit actions of Update/Delete/GetSecrets and ActivateConnection, granted
+# to the service user by the rule pi-setup.sh installs
+required_permissions = (
+    "org.freedesktop.NetworkManager.settings.modify.system",
+    "org.freedesktop.NetworkManager.network-control",
+)
+
+
+def value(variant):
+    # jeepney returns variants as (signature, value)
+    return variant[1] if isinstance(variant, tuple) else variant
+
+
+def format_bssid(bssid):
+    return ":".join(f"{byte:02X}" for byte in bssid)
+
+
+class NMClient:
+    """NetworkManager client on one system D-Bus connection."""
+
+    def __init__(self, timeout_s=10):
+        if (open_dbus_connection is None):
+            raise ImportError("jeepney is not installed")
+        self.conn = open_dbus_connection(bus="SYSTEM")
+        self.timeout_s = timeout_s
+        self.calls = 0
+
+    def call(self, path, interface, method, signature=None, body=()):
+        self.calls += 1
+        return unwrap_msg(self.conn.send_and_get_reply(
+            new_method_call(DBusAddress(path, bus_name, interface),
+                            method, signature, body),
+            timeout=self.timeout_s))
+
+    def check_permissions(self, actions=required_permissions):
+        """Raise PermissionError unless NetworkManager allows the actions
+        without authentication ("auth" needs an agent the service lacks)."""
+        permissions, = self.call(nm_path, nm_interface, "GetPermissions")
+        denied = [action for action in actions
+                  if (permissions.get(action) != "yes")]
+        if (denied):
+            raise PermissionError("Not permitted: {}".format(", ".join(
+                f"{action}={permissions.get(action)}" for action in denied)))
+
+    def snapshot(self, settings=True):
+        """Devices by interface name, active connections and connection
+        settings by object path, from a single GetManagedObjects call plus
+        GetSettings for each connection. Without settings, the connections
+        map to None and get_settings fetches the ones needed."""
+        objects, = self.call("/org/freedesktop",
+                             "org.freedesktop.DBus.ObjectManager",
+                             "GetManagedObjects")
+        snapshot = {"devices": dict(), "active": dict(),
+                    "connections": dict()}
+        for path, interfaces in objects.items():
+            if (device_interface in interfaces):
+                props = interfaces[device_interface]
+                snapshot["devices"][value(props["Interface"])] = {
+                    "path": path,
+                    "type": value(props["DeviceType"]),
+                    "state": value(props["State"]),
+                    "active": value(props["ActiveConnection"]),
+                }
+            elif (active_interface in interfaces):
+                props = interfaces[active_interface]
+                snapshot["active"][path] = {
+                    "id": value(props["Id"]),
+                    "connection": value(props["Connection"]),
+                    "state": value(props["State"]),
+                }
+            elif (connection_interface in interfaces):
+                snapshot["connections"][path] = (
+                    self.get_settings(path) if settings else None)
+        return snapshot
+
+    def get_settings(self, path):
+        settings, = self.call(path, connection_interface, "GetSettings")
+        return settings
+
+    def update(self, path, settings):
+        """Replace the settings of a connection, keeping its secrets."""
+        for setting in ("802-11-wireless-security", "802-1x"):
+            if (setting in settings):
+                secrets, = self.call(path, connection_interface,
+                                     "GetSecrets", "s", (setting,))
+                for name, values in secrets.items():
+                    settings.setdefault(name, dict()).update(values)
+        self.call(path, connection_interface, "Update", "a{sa{sv}}",
+                  (settings,))
+
+    def activate(self, path, device_path):
+        active_path, = self.call(nm_path, nm_interface, "ActivateConnection",
+                                 "ooo", (path, device_path, "/"))
+        return active_path
+
+    def delete(self, path):
+        self.call(path, connection_interface, "Delete")
+
+    def close(self):
+        self.conn.close()
+
+
+def connection_path(snapshot, conn_id):
+    """Path of the connection conn_id, from the active connections first as
+    a snapshot without settings only knows the ids of those."""
+    for active in snapshot["active"].values():
+        if (active["id"] == conn_id):
+            return active["connection"]
+    for path, settings in snapshot["connections"].items():
+        if (settings and value(settings["connection"]["id"]) == conn_id):
+            return path
+    return None
+
+
+def device_connection(snapshot, iface):
+    """Id of the activated connection of iface, or False, as the CONNECTION
+    column of nmcli device status."""
+    device = snapshot["devices"].get(iface)
+    active = snapshot["active"].get(device["active"]) if device else None
+    if (active and active["state"] == NM_ACTIVE_CONNECTION_STATE_ACTIVATED):
+        return active["id"]
+    return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print the NetworkManager devices and connections.")
+    parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    client = NMClient()
+    snapshot = client.snapshot()
+    client.close()
+    for iface in snapshot["devices"]:
+        print(f"{iface}: {device_connection(snapshot, iface) or '--'}")
+    for path, settings in snapshot["connections"].items():
+        print(f"{path}: " + json.dumps({
+            name: {key: str(value(variant)) for key, variant in values.items()}
+            for name, values in settings.items()}))
+    print(f"{client.calls} D-Bus calls")
@@ -0,0 +1,391 @@
+import argparse
+import json
+import mmap
+import numpy as np
+import struct
+import zipfile
+
+# Summaries of radiotap 802.11 captures: frame counts by type and subtype,
+# airtime, retry rate and per-transmitter RSSI for each channel. Records are
+# located with one pass over the pcap, every per-frame field is then read
+# with NumPy from the buffer at once.
+
+linktype_radiotap = 127
+
+# (alignment, size) of the radiotap fields of the first present word by bit,
+# up to VHT which is the last one used here
+radiotap_fields = [
+    (8, 8),   # 0 TSFT
+    (1, 1),   # 1 Flags
+    (1, 1),   # 2 Rate
+    (2, 4),   # 3 Channel
+    (1, 2),   # 4 FHSS
+    (1, 1),   # 5 dBm antenna signal
+    (1, 1),   # 6 dBm antenna noise
+    (2, 2),   # 7 Lock quality
+    (2, 2),   # 8 TX attenuation
+    (2, 2),   # 9 dB TX attenuation
+    (1, 1),   # 10 dBm TX power
+    (1, 1),   # 11 Antenna
+    (1, 1),   # 12 dB antenna signal
+    (1, 1),   # 13 dB antenna noise
+    (2, 2),   # 14 RX flags
+    (2, 2),   # 15 TX flags
+    (1, 1),   # 16 RTS retries
+    (1, 1),   # 17 Data retries
+    (4, 8),   # 18 XChannel
+    (1, 3),   # 19 MCS
+    (4, 8),   # 20 A-MPDU status
+    (2, 12),  # 21 VHT
+]
+rt_flags = 1
+rt_rate = 2
+rt_channel = 3
+rt_signal = 5
+rt_mcs = 19
+rt_vht = 21
+
+flag_short_preamble = 0x02
+flag_bad_fcs = 0x40
+
+type_names = ["mgmt", "ctrl", "data", "ext"]
+subtype_names = {
+    (0, 0): "assoc-req", (0, 1): "assoc-resp", (0, 2): "reassoc-req",
+    (0, 3): "reassoc-resp", (0, 4): "probe-req", (0, 5): "probe-resp",
+    (0, 8): "beacon", (0, 9): "atim", (0, 10): "disassoc", (0, 11): "auth",
+    (0, 12): "deauth", (0, 13): "action", (0, 14): "action-noack",
+    (1, 4): "beamforming-report-poll", (1, 5): "ndp-announcement",
+    (1, 7): "control-wrapper", (1, 8): "block-ack-req", (1, 9): "block-ack",
+    (1, 10): "ps-poll", (1, 11): "rts", (1, 12): "cts", (1, 13): "ack",
+    (1, 14): "cf-end", (1, 15): "cf-end-ack",
+    (2, 0): "data", (2, 4): "null", (2, 8): "qos-data", (2, 12): "qos-null",
+}
+# Control frames with a transmitter address
+ctrl_with_ta = [4, 5, 8, 9, 10, 11, 14, 15]
+
+# HT/VHT rates in Mbps for one stream at 20 MHz with long GI, by MCS, and
+# the factor for each bandwidth
+mcs_rates = np.array([6.5, 13, 19.5, 26, 39, 52, 58.5, 65, 78, 86.7])
+bw_factors = {20: 1, 40: 13.5 / 6.5, 80: 29.25 / 6.5, 160: 58.5 / 6.5}
+# VHT bandwidth field to MHz
+vht_bw = np.array([20, 40, 40, 40, 80, 80, 80, 80, 80, 80, 80]
+                  + [160] * 15)
+
+# Number of transmitters listed per channel, by frame count
+max_transmitters = 50
+
+
+def read_records(buf):
+    """Locate the records of the pcap in buf. Returns the linktype and the
+    arrays of timestamp, data offset, captured and original length."""
+    magic = bytes(buf[:4])
+    if (magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1")):
+        endian = "<"
+    elif (magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d")):
+        endian = ">"
+    else:
+        raise ValueError(f"Not a pcap file, magic {magic.hex()}")
+    ts_scale = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1",
+                                 b"\xa1\xb2\x3c\x4d") else 1e-6
+    linktype = struct.unpack_from(endian + "I", buf, 20)[0]
+
+    record = struct.Struct(endian + "IIII")
+    unpack_from = record.unpack_from
+    size = len(buf)
+    ts_sec, ts_frac, offsets, incl_lens, orig_lens = [], [], [], [], []
+    off = 24
+    while off + 16 <= size:
+        sec, frac, incl_len, orig_len = unpack_from(buf, off)
+        off += 16
+        if (off + incl_len > size):
+            break
+        ts_sec.append(sec)
+        ts_frac.append(frac)
+        offsets.append(off)
+        incl_lens.append(incl_len)
+        orig_lens.append(orig_len)
+        off += incl_len
+
+    timestamps = (np.array(ts_sec, dtype=np.float64)
+                  + np.array(ts_frac, dtype=np.float64) * ts_scale)
+    return (linktype, timestamps, np.array(offsets, dtype=np.int64),
+            np.array(incl_lens, dtype=np.int64),
+            np.array(orig_lens, dtype=np.int64))
+
+
+def field_offsets(present, n_words):
+    # Offsets of the first present word's fields from the radiotap start
+    offsets = dict()
+    off = 4 + 4 * n_words
+    for bit, (align, size) in enumerate(radiotap_fields):
+        if (present & (1 << bit)):
+            off = (off + align - 1) // align * align
+            offsets[bit] = off
+            off += size
+    return offsets
+
+
+def read_u8(data, idx):
+    return data[idx].astype(np.int64)
+
+
+def read_u16(data, idx):
+    return read_u8(data, idx) | (read_u8(data, idx + 1) << 8)
+
+
+def read_u32(data, idx):
+    return read_u16(data, idx) | (read_u16(data, idx + 2) << 16)
+
+
+def decode_frames(buf):
+    """Decode the radiotap and 802.11 headers of every frame in the pcap in
+    buf. Returns a dict of per-frame arrays."""
+    linktype, timestamps, offsets, incl_lens, orig_lens = read_records(buf)
+    if (linktype != linktype_radiotap):
+        raise ValueError(f"Linktype {linktype} is not radiotap")
+    data = np.frombuffer(buf, dtype=np.uint8)
+
+    # Drop frames too short for radiotap and the 802.11 frame control
+    valid = incl_lens >= 8
+    rt_lens = np.zeros_like(offsets)
+    rt_lens[valid] = read_u16(data, offsets[valid] + 2)
+    valid &= incl_lens >= rt_lens + 2
+    timestamps, offsets, incl_lens, orig_lens, rt_lens = (
+        timestamps[valid], offsets[valid], incl_lens[valid],
+        orig_lens[valid], rt_lens[valid])
+    n = len(offsets)
+
+    # Count the present words, bit 31 extends to the next word
+    present = read_u32(data, offsets + 4)
+    n_words = np.ones(n, dtype=np.int64)
+    word = present
+    while (True):
+        more = (word & (1 << 31)) != 0
+        more &= 4 + 4 * (n_words + 1) <= rt_lens
+        if (not more.any()):
+            break
+        word = np.zeros(n, dtype=np.int64)
+        word[more] = read_u32(data, offsets[more] + 4 + 4 * n_words[more])
+        n_words += more
+
+    flags = np.zeros(n, dtype=np.int64)
+    rate = np.full(n, np.nan)
+    freq = np.zeros(n, dtype=np.int64)
+    signal = np.full(n, np.nan)
+    preamble_us = np.full(n, 20.0)
+
+    # Frames from one capture share a few radiotap layouts, the field
+    # offsets are computed once per layout
+    layouts, layout_idx = np.unique(
+        (present & 0xffffffff) | (n_words << 32), return_inverse=True)
+    for i, layout in enumerate(layouts):
+        sel = np.nonzero(layout_idx == i)[0]
+        fields = field_offsets(int(layout) & 0xffffffff, int(layout) >> 32)
+
+        def has(bit, size):
+            # Only the frames whose radiotap header holds the whole field
+            if (bit not in fields):
+                return sel[:0], None
+            ok = sel[fields[bit] + size <= rt_lens[sel]]
+            return ok, offsets[ok] + fields[bit]
+
+        ok, idx = has(rt_flags, 1)
+        if (idx is not None):
+            flags[ok] = read_u8(data, idx)
+        ok, idx = has(rt_channel, 4)
+        if (idx is not None):
+            freq[ok] = read_u16(data, idx)
+        ok, idx = has(rt_signal, 1)
+        if (idx is not None):
+            signal[ok] = data[idx].view(np.int8)
+        ok, idx = has(rt_rate, 1)
+        if (idx is not None):
+            legacy = read_u8(data, idx) * 0.5
+            rate[ok] = np.where(legacy > 0, legacy, np.nan)
+            dsss = np.isin(legacy, [1, 2, 5.5, 11])
+            short = (flags[ok] & flag_short_preamble) != 0
+            preamble_us[ok] = np.where(dsss, np.where(short, 96, 192), 20)
+        ok, idx = has(rt_mcs, 3)
+        if (idx is not None):
+            mcs_flags = read_u8(data, idx + 1)
+            mcs = read_u8(data, idx + 2)
+            streams = mcs // 8 + 1
+            factor = np.where((mcs_flags & 3) == 1, bw_factors[40], 1)
+            factor = factor * np.where(mcs_flags & 4, 10 / 9, 1)
+            rate[ok] = mcs_rates[mcs % 8] * streams * factor
+            preamble_us[ok] = 32 + 4 * streams
+        ok, idx = has(rt_vht, 12)
+        if (idx is not None):
+            vht_flags = read_u8(data, idx + 2)
+            bandwidth = np.minimum(read_u8(data, idx + 3), len(vht_bw) - 1)
+            mcs_nss = read_u8(data, idx + 4)
+            mcs = np.minimum(mcs_nss >> 4, len(mcs_rates) - 1)
+            nss = np.maximum(mcs_nss & 0x0f, 1)
+            factor = np.select(
+                [vht_bw[bandwidth] == bw for bw in bw_factors],
+                list(bw_factors.values()))
+            factor = factor * np.where(vht_flags & 4, 10 / 9, 1)
+            rate[ok] = mcs_rates[mcs] * nss * factor
+            preamble_us[ok] = 32 + 4 * nss
+
+    # 802.11 header after radiotap
+    hdr = offsets + rt_lens
+    fc0 = read_u8(data, hdr)
+    fc1 = read_u8(data, hdr + 1)
+    frame_type = (fc0 >> 2) & 3
+    subtype = fc0 >> 4
+    frame_lens = orig_lens - rt_lens
+    has_ta = ((frame_type != 1) | np.isin(subtype, ctrl_with_ta))
+    has_ta &= incl_lens >= rt_lens + 16
+    ta = np.zeros(n, dtype=np.int64)
+    for k in range(6):
+        ta[has_ta] = (ta[has_ta] << 8) | read_u8(data, hdr[has_ta] + 10 + k)
+
+    return {
+        "timestamp": timestamps,
+        "freq": freq,
+        "type": frame_type,
+        "subtype": subtype,
+        "retry": (fc1 & 0x08) != 0,
+        "bad_fcs": (flags & flag_bad_fcs) != 0,
+        "length": frame_lens,
+        "signal": signal,
+        "rate": rate,
+        "airtime_us": preamble_us + frame_lens * 8 / rate,
+        "has_ta": has_ta,
+        "ta": ta,
+    }
+
+
+def mac_str(mac):
+    return ":".join(f"{(mac >> (8 * (5 - k))) & 0xff:02x}" for k in range(6))
+
+
+def summarize_transmitters(frames, sel):
+    # Per-transmitter frame count, retry rate, airtime and RSSI quantiles
+    sel = sel[frames["has_ta"][sel]]
+    if (len(sel) == 0):
+        return 0, list()
+    macs, inverse, counts = np.unique(
+        frames["ta"][sel], return_inverse=True, return_counts=True)
+    retries = np.bincount(inverse,
+                          weights=frames["retry"][sel].astype(np.float64))
+    airtime = frames["airtime_us"][sel]
+    airtime_s = np.bincount(inverse, weights=np.nan_to_num(airtime)) / 1e6
+
+    # RSSI quantiles from the frames sorted by transmitter then signal
+    signal = frames["signal"][sel]
+    has_signal = ~np.isnan(signal)
+    keys = inverse[has_signal]
+    order = np.lexsort((signal[has_signal], keys))
+    sorted_signal = signal[has_signal][order]
+    signal_counts = np.bincount(keys, minlength=len(macs))
+    starts = np.concatenate([[0], np.cumsum(signal_counts)[:-1]])
+    quantiles = dict()
+    if (len(sorted_signal) > 0):
+        for name, q in [("min", 0), ("p25", 0.25), ("median", 0.5),
+                        ("p75", 0.75), ("max", 1)]:
+            idx = starts + np.round(
+                q * np.maximum(signal_counts - 1, 0)).astype(np.int64)
+            quantiles[name] = sorted_signal[
+                np.minimum(idx, len(sorted_signal) - 1)]
+
+    transmitters = list()
+    for i in np.argsort(-counts)[:max_transmitters]:
+        transmitters.append({
+            "mac": mac_str(int(macs[i])),
+            "frames": int(counts[i]),
+            "retry_rate": round(float(retries[i] / counts[i]), 4),
+            "airtime_s": round(float(airtime_s[i]), 6),
+            "rssi": ({name: int(values[i])
+                      for name, values in quantiles.items()}
+                     if signal_counts[i] else None),
+        })
+    return len(macs), transmitters
+
+
+def summarize(buf):
+    """Summarize the radiotap pcap in buf (bytes or mmap), one dict per
+    channel frequency found in the radiotap headers (0 if absent)."""
+    frames = decode_frames(buf)
+    summaries = list()
+    for freq in np.unique(frames["freq"]):
+        sel = np.nonzero(frames["freq"] == freq)[0]
+        timestamps = frames["timestamp"][sel]
+        duration_s = float(timestamps.max() - timestamps.min())
+
+        types = dict()
+        pairs, counts = np.unique(
+            frames["type"][sel] * 16 + frames["subtype"][sel],
+            return_counts=True)
+        for pair, count in zip(pairs, counts):
+            frame_type, subtype = divmod(int(pair), 16)
+            name = subtype_names.get((frame_type, subtype), str(subtype))
+            types[f"{type_names[frame_type]}/{name}"] = int(count)
+
+        airtime = frames["airtime_us"][sel]
+        has_rate = ~np.isnan(airtime)
+        airtime_s = float(airtime[has_rate].sum() / 1e6)
+        transmitter_count, transmitters = summarize_transmitters(frames, sel)
+        summaries.append({
+            "freq_mhz": int(freq),
+            "frames": len(sel),
+            "bytes": int(frames["length"][sel].sum()),
+            "duration_s": round(duration_s, 6),
+            "types": types,
+            "retry_rate": round(float(frames["retry"][sel].mean()), 4),
+            "bad_fcs": int(frames["bad_fcs"][sel].sum()),
+            "airtime_s": round(airtime_s, 6),
+            "airtime_fraction": (round(airtime_s / duration_s, 4)
+                                 if duration_s > 0 else None),
+            "frames_without_rate": int((~has_rate).sum()),
+            "transmitter_count": transmitter_count,
+            "transmitters": transmitters,
+        })
+    return summaries
+
+
+def empty_summary(freq_mhz):
+    # Summary of a channel that captured no frames
+    return {
+        "freq_mhz": freq_mhz,
+        "frames": 0,
+        "bytes": 0,
+        "duration_s": 0,
+        "types": dict(),
+        "retry_rate": None,
+        "bad_fcs": 0,
+        "airtime_s": 0,
+        "airtime_fraction": None,
+        "frames_without_rate": 0,
+        "transmitter_count": 0,
+        "transmitters": list(),
+    }
+
+
+def summarize_file(path):
+    # Summarize a pcap file through a memory map
+    with open(path, "rb") as pcap_file:
+        with mmap.mmap(pcap_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as buf:
+            return summarize(buf)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=("Summarize radiotap pcap files, or the pcaps in "
+                     "monitor capture zips, as JSON."))
+    parser.add_argument("files", nargs="+", help="pcap or zip files.")
+    args = parser.parse_args()
+
+    output = dict()
+    for path in args.files:
+        if (zipfile.is_zipfile(path)):
+            with zipfile.ZipFile(path) as zip_file:
+                for name in zip_file.namelist():
+                    if (name.endswith(".pcap")):
+                        output[f"{path}/{name}"] = summarize(
+                            zip_file.read(name))
+        else:
+            output[path] = summarize_file(path)
+    print(json.dumps(output, indent=2))
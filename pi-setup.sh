@@ -7,7 +7,8 @@ echo "iperf3 iperf3/start_daemon boolean false" | sudo debconf-set-selections
 sudo sed -i "s/#deb-src/deb-src/g" /etc/apt/sources.list
 sudo apt update && DEBIAN_FRONTEND=noninteractive sudo apt install build-essential git iperf3 python3 python3-pip python3-venv tcpdump -y
 
-# Patch iwlist
+# Patch iwlist, only needed when scan_backend is "iwlist" (the nl80211
+# backend does not use wireless-tools)
 FOUND=
 for DIR in /home/$USER/wireless-tools-* ; do
 	if [ -d "$DIR" ] ; then
@@ -27,7 +28,7 @@ fi
 if [ ! -d /home/$USER/venv_firebase ]; then
 	python -m venv /home/$USER/venv_firebase
 fi
-/home/$USER/venv_firebase/bin/python -m pip install firebase-admin jc paho-mqtt
+/home/$USER/venv_firebase/bin/python -m pip install firebase-admin jc jeepney numpy paho-mqtt
 
 # 2. git clone/pull sigcap-buddy
 BRANCH_NAME="main"
@@ -83,7 +84,31 @@ if [[ -t 1 ]]; then
 	fi
 fi
 
-# 6. Enable/restart speedtest_logger service
+# 6. Enable/restart cmd_broker service, started before the services using it
+if [ -f /etc/systemd/system/cmd_broker.service ]; then
+	sed -e "s/\$USER/$USER/g" /home/$USER/sigcap-buddy/cmd_broker.service.template > cmd_broker.service
+	sudo mv cmd_broker.service /etc/systemd/system/
+	sudo systemctl reenable cmd_broker.service
+	sudo systemctl restart cmd_broker.service
+else
+	sed -e "s/\$USER/$USER/g" /home/$USER/sigcap-buddy/cmd_broker.service.template > cmd_broker.service
+	sudo mv cmd_broker.service /etc/systemd/system/
+	sudo systemctl enable cmd_broker.service
+	sudo systemctl start cmd_broker.service
+fi
+
+# 6.1. Allow the speedtest_logger user to change NetworkManager connections,
+# polkit before 0.106 only reads .pkla files
+if [ -d /etc/polkit-1/rules.d ] && [ ! -d /etc/polkit-1/localauthority ]; then
+	sed -e "s/\$USER/$USER/g" /home/$USER/sigcap-buddy/nm-polkit.rules.template > 50-sigcap-buddy-nm.rules
+	sudo mv 50-sigcap-buddy-nm.rules /etc/polkit-1/rules.d/
+else
+	sed -e "s/\$USER/$USER/g" /home/$USER/sigcap-buddy/nm-polkit.pkla.template > 50-sigcap-buddy-nm.pkla
+	sudo mkdir -p /etc/polkit-1/localauthority/50-local.d
+	sudo mv 50-sigcap-buddy-nm.pkla /etc/polkit-1/localauthority/50-local.d/
+fi
+
+# 6.2. Enable/restart speedtest_logger service
 if [ -f /etc/systemd/system/speedtest_logger.service ]; then
 	sed -e "s/\$USER/$USER/g" /home/$USER/sigcap-buddy/speedtest_logger.service.template > speedtest_logger.service
 	sudo mv speedtest_logger.service /etc/systemd/system/
@@ -96,7 +121,7 @@ else
 	sudo systemctl start speedtest_logger.service
 fi
 
-# 6.1 Enable/restart iperf service
+# 6.3. Enable/restart iperf service
 if [ -f /etc/systemd/system/iperf3_@.service ]; then
 	sudo cp /home/$USER/sigcap-buddy/iperf3_@.service /etc/systemd/system/
 	sudo systemctl reenable iperf3_@5201.service
@@ -107,7 +132,7 @@ else
 	sudo systemctl start iperf3_@5201.service
 fi
 
-# 6.2. Enable/restart mqtt_logger service
+# 6.4. Enable/restart mqtt_logger service
 if [ -f /etc/systemd/system/mqtt.service ]; then
 	sed -e "s/\$USER/$USER/g" /home/$USER/sigcap-buddy/mqtt.service.template > mqtt.service
 	sudo mv mqtt.service /etc/systemd/system/
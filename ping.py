@@ -1,9 +1,35 @@
 from datetime import datetime
-import jc
 import logging
+import math
+import os
 import re
+import signal
+import subprocess
+import threading
 import utils
 
+# Patterns for iputils `ping -D` output, producing the same fields as
+# jc.parse("ping", ...)
+re_header = re.compile(
+    r"\(([\w:.%-]+)\)\)? (?:from \S+ \S+: )?(\d+)(?:\(\d+\))? "
+    r"(?:data )?bytes")
+re_reply = re.compile(
+    r"(?:\[([\d.]+)\] )?(\d+) bytes from (?:[^\s:]+ \()?([^\s()]+?)\)?: "
+    r"icmp_seq=(\d+) ttl=(\d+) time=([\d.]+) ms")
+re_no_answer = re.compile(
+    r"(?:\[([\d.]+)\] )?no answer yet for icmp_seq=(\d+)")
+re_footer = [
+    ("packets_transmitted", int, re.compile(r"(\d+) packets transmitted")),
+    ("packets_received", int, re.compile(r"(\d+) received,")),
+    ("duplicates", int, re.compile(r"[+](\d+) duplicates")),
+    ("corrupted", int, re.compile(r"[+](\d+) corrupted")),
+    ("errors", int, re.compile(r"[+](\d+) errors")),
+    ("packet_loss_percent", float, re.compile(r"([\d\.]+)% packet loss")),
+    ("time_ms", float, re.compile(r"time (\d+)ms")),
+]
+re_rtt = re.compile(
+    r"rtt min\/avg\/max\/mdev += +([\d\.]+)\/([\d\.]+)\/([\d\.]+)\/([\d\.]+) ms")
+
 
 def get_gateway_ip(iface):
     logging.info(f"Fetching gateway IP of {iface}.")
@@ -20,17 +46,160 @@ def get_gateway_ip(iface):
         return ""
 
 
-def process_ping_results(results):
-    parsed = jc.parse("ping", results)
-    for entry in parsed["responses"]:
-        if "timestamp" in entry:
-            entry["timestamp"] = datetime.fromtimestamp(
-                entry["timestamp"]).astimezone().isoformat()
+class PingParser:
+    """Incremental parser for `ping -D` output.
+
+    Reply lines are kept as compact (timestamp, seq, ttl, rtt, bytes, ip,
+    duplicate) tuples, timeouts as (timestamp, seq). Running RTT statistics
+    are available from stats() while ping is still running, result() builds
+    the same dict as jc.parse("ping", ...) with ISO timestamps."""
+
+    def __init__(self):
+        self.header = None
+        self.in_footer = False
+        self.footer = dict()
+        self.responses = list()
+        self.received = 0
+        self.rtt_min = math.inf
+        self.rtt_max = 0
+        self.rtt_sum = 0
+        self.rtt_sum_sq = 0
+
+    def feed(self, line):
+        if (self.in_footer):
+            self.footer.setdefault("duplicates", 0)
+            for key, cast, pattern in re_footer:
+                match = pattern.search(line)
+                if (match):
+                    self.footer[key] = cast(match[1])
+            match = re_rtt.search(line)
+            if (match):
+                for i, key in enumerate(["min", "avg", "max", "stddev"]):
+                    self.footer[f"round_trip_ms_{key}"] = float(match[i + 1])
+        elif (" bytes from " in line):
+            match = re_reply.match(line)
+            if (match):
+                rtt = float(match[6])
+                self.responses.append((
+                    float(match[1]) if match[1] else None,
+                    int(match[4]), int(match[5]), rtt,
+                    int(match[2]), match[3], line.endswith("(DUP!)")))
+                self.received += 1
+                self.rtt_min = min(self.rtt_min, rtt)
+                self.rtt_max = max(self.rtt_max, rtt)
+                self.rtt_sum += rtt
+                self.rtt_sum_sq += rtt * rtt
+        elif ("no answer yet" in line):
+            match = re_no_answer.match(line)
+            if (match):
+                self.responses.append((
+                    float(match[1]) if match[1] else None, int(match[2])))
+        elif (line.startswith("PING ")):
+            match = re_header.search(line)
+            self.header = {
+                "destination_ip": (match[1] if match
+                                   else line.split()[1].strip("()")),
+                "data_bytes": int(match[2]) if match else None,
+                "pattern": None,
+            }
+        elif (line.startswith("---")):
+            self.in_footer = True
+            if (line[4] != " "):
+                self.footer["destination"] = line.split()[1]
+
+    def feed_all(self, lines):
+        for line in lines:
+            if (line):
+                self.feed(line.rstrip("\n"))
+        return self
+
+    def stats(self):
+        # Running statistics over the replies so far, like ping's summary
+        if (not self.received):
+            return {"packets_received": 0}
+        avg = self.rtt_sum / self.received
+        return {
+            "packets_received": self.received,
+            "round_trip_ms_min": self.rtt_min,
+            "round_trip_ms_avg": avg,
+            "round_trip_ms_max": self.rtt_max,
+            "round_trip_ms_stddev": math.sqrt(
+                max(self.rtt_sum_sq / self.received - avg * avg, 0)),
+        }
+
+    def result(self):
+        if (not self.header and not self.responses):
+            return dict()
+
+        def iso(timestamp):
+            return (datetime.fromtimestamp(timestamp).astimezone().isoformat()
+                    if timestamp is not None else None)
+
+        responses = list()
+        for response in self.responses:
+            if (len(response) == 2):
+                responses.append({
+                    "type": "timeout",
+                    "timestamp": iso(response[0]),
+                    "icmp_seq": response[1]})
+            else:
+                timestamp, seq, ttl, rtt, size, ip, duplicate = response
+                responses.append({
+                    "type": "reply",
+                    "timestamp": iso(timestamp),
+                    "bytes": size,
+                    "response_ip": ip,
+                    "icmp_seq": seq,
+                    "ttl": ttl,
+                    "time_ms": rtt,
+                    "duplicate": duplicate})
+
+        return {**(self.header or dict()), **self.footer,
+                "responses": responses}
+
+
+class PingStream:
+    """Run ping in the background and parse its output as it arrives."""
+
+    def __init__(self, cmd, logging_prefix):
+        self.logging_prefix = logging_prefix
+        self.parser = PingParser()
+        self.proc = utils.run_cmd_async(cmd, logging_prefix)
+        self.thread = threading.Thread(target=self.read, daemon=True)
+        self.thread.start()
+
+    def read(self):
+        for line in self.proc.stdout:
+            line = line.decode("utf-8").rstrip("\n")
+            if (line):
+                self.parser.feed(line)
+
+    def resolve(self, timeout_s=10):
+        # Stop ping with SIGINT so it prints its summary, then wait for the
+        # reader to reach EOF
+        try:
+            os.killpg(os.getpgid(self.proc.pid), signal.SIGINT)
+        except ProcessLookupError:
+            pass
+        self.thread.join(timeout_s)
+        try:
+            self.proc.wait(timeout_s)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.thread.join()
+        err = self.proc.stderr.read().decode("utf-8")
+        if (self.proc.returncode != 0 and err):
+            logging.warning("%s error:\n%s", self.logging_prefix, err)
+            return dict()
+        return self.parser.result()
 
-    return parsed
+
+def process_ping_results(results):
+    return PingParser().feed_all(results.splitlines()).result()
 
 
-def ping(iface, ping_target, ping_count):
+def ping(iface, ping_target, ping_count, bind=False):
     gateway = get_gateway_ip(iface)
     if (not gateway):
         logging.warning("Cannot find gateway!")
@@ -38,15 +207,17 @@ def ping(iface, ping_target, ping_count):
 
     logging.info("Running ping to target %s and gateway %s.",
                  ping_target, gateway)
+    # Pin to iface while the other interfaces are up
+    bind_opt = f" -I {iface}" if bind else ""
 
     output = list()
     results = utils.run_cmd(
-        f"ping {ping_target} -Dc {ping_count}",
+        f"ping {ping_target} -Dc {ping_count}{bind_opt}",
         f"Running ping to {ping_target}",
         log_result=False)
     output.append(process_ping_results(results))
     results = utils.run_cmd(
-        f"ping {gateway} -Dc {ping_count}",
+        f"ping {gateway} -Dc {ping_count}{bind_opt}",
         f"Running ping to {gateway}",
         log_result=False)
     output.append(process_ping_results(results))
@@ -54,7 +225,7 @@ def ping(iface, ping_target, ping_count):
     return output
 
 
-def ping_async(iface, ping_target):
+def ping_async(iface, ping_target, bind=False):
     gateway = get_gateway_ip(iface)
     if (not gateway):
         logging.warning("Cannot find gateway!")
@@ -62,12 +233,13 @@ def ping_async(iface, ping_target):
 
     logging.info("Running asynchronous ping to target %s and gateway %s.",
                  ping_target, gateway)
+    bind_opt = f" -I {iface}" if bind else ""
     return {
-        "target": utils.run_cmd_async(
-            f"ping {ping_target} -D",
+        "target": PingStream(
+            f"ping {ping_target} -D{bind_opt}",
             f"Running ping to {ping_target}"),
-        "gateway": utils.run_cmd_async(
-            f"ping {gateway} -D",
+        "gateway": PingStream(
+            f"ping {gateway} -D{bind_opt}",
             f"Running ping to {gateway}")}
 
 
@@ -75,18 +247,9 @@ def resolve_ping_async(proc_obj):
     logging.info("Resolving ping.")
     output = list()
 
-    results = utils.resolve_cmd_async(
-        proc_obj["target"],
-        "Resolving ping to target",
-        log_result=False,
-        kill=True)
-    output.append(process_ping_results(results))
-
-    results = utils.resolve_cmd_async(
-        proc_obj["gateway"],
-        "Resolving ping to gateway",
-        log_result=False,
-        kill=True)
-    output.append(process_ping_results(results))
+    logging.info("Resolving ping to target.")
+    output.append(proc_obj["target"].resolve())
+    logging.info("Resolving ping to gateway.")
+    output.append(proc_obj["gateway"].resolve())
 
     return output
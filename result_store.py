@@ -0,0 +1,280 @@
+import argparse
+from datetime import datetime
+from functools import lru_cache
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+# Local store of the test results, one SQLite table per kind of result with
+# the full result as JSON plus a few summary columns for queries. The rows
+# are exported to the log bundle in the layout of the former result files
+# (e.g. iperf-log/<timestamp>.json) and kept on the Pi for keep_days.
+
+db_path = ".results.db"
+keep_days = 90
+# Rows per log bundle, the rest go to the next one
+batch_rows = 5000
+store_lock = threading.RLock()
+
+
+def iperf_columns(data):
+    reverse = data["start"].get("test_start", dict()).get("reverse")
+    total = data["end"].get("sum_received" if reverse else "sum_sent",
+                            dict())
+    return {
+        "direction": "dl" if reverse else "ul",
+        "bytes": total.get("bytes"),
+        "bits_per_second": total.get("bits_per_second"),
+        "early_stop": data["end"].get("early_stop", dict()).get("reason"),
+    }
+
+
+def speedtest_columns(data):
+    # Ookla reports bandwidths in bytes/s
+    return {
+        "download_bps": data.get("download", dict()).get("bandwidth", 0) * 8,
+        "upload_bps": data.get("upload", dict()).get("bandwidth", 0) * 8,
+        "latency_ms": data.get("ping", dict()).get("latency"),
+    }
+
+
+def ping_columns(data):
+    # pings holds the target and the gateway results
+    target, gateway = (list(data.get("pings") or list()) + [None, None])[:2]
+    return {
+        "corr_test": data["extra"].get("corr_test"),
+        "target_rtt_ms": (target or dict()).get("round_trip_ms_avg"),
+        "gateway_rtt_ms": (gateway or dict()).get("round_trip_ms_avg"),
+    }
+
+
+def wifi_scan_columns(data):
+    return {
+        "corr_test": data["extra"].get("corr_test"),
+        "beacons": len(data.get("beacons") or list()),
+    }
+
+
+def monitor_columns(data):
+    sweep = data["sweep"]
+    return {
+        "channels": sweep["channels"],
+        "capture_s": sweep["capture_s"],
+        "captured_bytes": sum(stats["captured_bytes"]
+                              for stats in data["channels"]),
+    }
+
+
+# table: (directory in the log bundle, summary columns and their types,
+# function returning the summary columns of a result)
+tables = {
+    "iperf": ("iperf-log", {"direction": "TEXT", "bytes": "INTEGER",
+                            "bits_per_second": "REAL", "early_stop": "TEXT"},
+              iperf_columns),
+    "speedtest": ("speedtest-log", {"download_bps": "REAL",
+                                    "upload_bps": "REAL",
+                                    "latency_ms": "REAL"},
+                  speedtest_columns),
+    "ping": ("ping-log", {"corr_test": "TEXT", "target_rtt_ms": "REAL",
+                          "gateway_rtt_ms": "REAL"},
+             ping_columns),
+    "wifi_scan": ("wifi-scan", {"corr_test": "TEXT", "beacons": "INTEGER"},
+                  wifi_scan_columns),
+    "monitor": ("monitor-log", {"channels": "INTEGER", "capture_s": "REAL",
+                                "captured_bytes": "INTEGER"},
+                monitor_columns),
+}
+
+
+@lru_cache(maxsize=None)
+def connect(path=db_path):
+    """Connection to the store at path, shared by all threads. WAL mode
+    lets on-device queries read while the tests write, and
+    synchronous=NORMAL only syncs the WAL at checkpoints, sparing the SD
+    card an fsync per result."""
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with store_lock, conn:
+        for table, (_, columns, _) in tables.items():
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "id INTEGER PRIMARY KEY, time_s REAL NOT NULL, "
+                "timestamp TEXT NOT NULL, test_uuid TEXT, interface TEXT, "
+                + "".join(f"{name} {column_type}, "
+                          for name, column_type in columns.items())
+                + "data TEXT NOT NULL)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_test_uuid "
+                         f"ON {table} (test_uuid)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_interface "
+                         f"ON {table} (interface, time_s)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_time "
+                         f"ON {table} (time_s)")
+        # Last row of each table packed into a log bundle
+        conn.execute("CREATE TABLE IF NOT EXISTS exports ("
+                     "name TEXT PRIMARY KEY, last_id INTEGER NOT NULL)")
+    return conn
+
+
+def add(table, data, timestamp, interface=None, test_uuid=None,
+        path=db_path):
+    """Store a result, timestamp is its ISO 8601 time. Returns the row
+    id."""
+    _, _, summarize = tables[table]
+    try:
+        columns = summarize(data)
+    except (AttributeError, KeyError, TypeError) as e:
+        # Partial result, only keep the JSON
+        logging.debug("No summary of %s result: %s", table, e)
+        columns = dict()
+    columns = {
+        "time_s": datetime.fromisoformat(timestamp).timestamp(),
+        "timestamp": timestamp,
+        "test_uuid": test_uuid,
+        "interface": interface,
+        **columns,
+        "data": json.dumps(data),
+    }
+    conn = connect(path)
+    with store_lock, conn:
+        cursor = conn.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({', '.join('?' * len(columns))})",
+            list(columns.values()))
+    return cursor.lastrowid
+
+
+def where(test_uuid=None, interface=None, since_s=None, until_s=None):
+    # WHERE clause and parameters of a query
+    clauses = list()
+    params = list()
+    for clause, param in [("test_uuid = ?", test_uuid),
+                          ("interface = ?", interface),
+                          ("time_s >= ?", since_s),
+                          ("time_s < ?", until_s)]:
+        if (param is not None):
+            clauses.append(clause)
+            params.append(param)
+    return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+
+def query(table, test_uuid=None, interface=None, since_s=None, until_s=None,
+          with_data=False, path=db_path):
+    """Rows of table as dicts, oldest first, since_s and until_s are Unix
+    times. The result JSON is decoded into "data" if with_data is set."""
+    clause, params = where(test_uuid, interface, since_s, until_s)
+    conn = connect(path)
+    with store_lock:
+        rows = conn.execute(
+            f"SELECT * FROM {table}{clause} ORDER BY time_s", params
+        ).fetchall()
+    results = list()
+    for row in rows:
+        result = dict(row)
+        if (with_data):
+            result["data"] = json.loads(result["data"])
+        else:
+            del result["data"]
+        results.append(result)
+    return results
+
+
+def summarize(table, since_s=None, path=db_path):
+    # Count and mean of the numeric summary columns by interface
+    _, columns, _ = tables[table]
+    numeric = [name for name, column_type in columns.items()
+               if column_type in ("INTEGER", "REAL")]
+    clause, params = where(since_s=since_s)
+    conn = connect(path)
+    with store_lock:
+        rows = conn.execute(
+            "SELECT interface, COUNT(*) AS results, MIN(timestamp) AS first, "
+            "MAX(timestamp) AS last"
+            + "".join(f", AVG({name}) AS {name}" for name in numeric)
+            + f" FROM {table}{clause} GROUP BY interface", params
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def export(limit=batch_rows, path=db_path):
+    """Up to limit rows not yet packed into a log bundle, as log bundle
+    records {"path", "test_uuid", "content"} with the table and row id in
+    "table" and "id". mark_exported() them once the bundle is written."""
+    conn = connect(path)
+    records = list()
+    with store_lock:
+        last_ids = {row["name"]: row["last_id"] for row in
+                    conn.execute("SELECT name, last_id FROM exports")}
+        for table, (directory, _, _) in tables.items():
+            if (len(records) >= limit):
+                break
+            rows = conn.execute(
+                f"SELECT id, timestamp, test_uuid, data FROM {table} "
+                "WHERE id > ? ORDER BY id LIMIT ?",
+                (last_ids.get(table, 0), limit - len(records))).fetchall()
+            records += [{
+                "table": table,
+                "id": row["id"],
+                "path": f"{directory}/{row['timestamp']}.json",
+                "test_uuid": row["test_uuid"],
+                "content": row["data"]} for row in rows]
+    return records
+
+
+def mark_exported(records, path=db_path):
+    last_ids = dict()
+    for record in records:
+        last_ids[record["table"]] = max(last_ids.get(record["table"], 0),
+                                        record["id"])
+    conn = connect(path)
+    with store_lock, conn:
+        conn.executemany(
+            "INSERT INTO exports (name, last_id) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET last_id = excluded.last_id",
+            last_ids.items())
+
+
+def prune(max_age_days=keep_days, path=db_path):
+    # Delete exported rows older than max_age_days, returns their number
+    conn = connect(path)
+    deleted = 0
+    with store_lock, conn:
+        last_ids = {row["name"]: row["last_id"] for row in
+                    conn.execute("SELECT name, last_id FROM exports")}
+        for table in tables:
+            deleted += conn.execute(
+                f"DELETE FROM {table} WHERE time_s < ? AND id <= ?",
+                (time.time() - max_age_days * 86400,
+                 last_ids.get(table, 0))).rowcount
+    if (deleted):
+        logging.info("Pruned %d results older than %d days.", deleted,
+                     max_age_days)
+    return deleted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Query the local result store.")
+    parser.add_argument("table", choices=tables, help="Kind of result.")
+    parser.add_argument("-u", "--test-uuid", help="Only this test_uuid.")
+    parser.add_argument("-i", "--interface", help="Only this interface.")
+    parser.add_argument("-H", "--hours", type=float,
+                        help="Only the results of the last hours.")
+    parser.add_argument("-s", "--summary", action="store_true",
+                        help="Print the means by interface instead.")
+    parser.add_argument("-d", "--data", action="store_true",
+                        help="Print the full results as NDJSON.")
+    parser.add_argument("--db", default=db_path, help="Store path.")
+    args = parser.parse_args()
+
+    since_s = time.time() - args.hours * 3600 if args.hours else None
+    if (args.summary):
+        for row in summarize(args.table, since_s, args.db):
+            print(json.dumps(row))
+    else:
+        for row in query(args.table, args.test_uuid, args.interface, since_s,
+                         with_data=args.data, path=args.db):
+            print(json.dumps(row["data"] if args.data else row))
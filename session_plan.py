@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+from datetime import datetime, timezone
+import json
+import logging
+from pathlib import Path
+import sys
+import time
+
+# Per-session timelines, packed into the log bundle with the test results
+timeline_dir = "session-timeline"
+
+
+class Step:
+    """One step of a measurement plan.
+
+    func is a blocking callable run in a worker thread. uses maps the
+    resources the step needs (e.g. "eth0", "wlan0", "link") to "exclusive"
+    or "shared", a resource held exclusively conflicts with any other use.
+    The step starts once the steps named in after are finished, and is
+    skipped if when() returns False at that time."""
+
+    def __init__(self, name, func, uses=None, after=(), when=None):
+        self.name = name
+        self.func = func
+        self.uses = uses or dict()
+        self.after = list(after)
+        self.when = when
+
+    def conflicts(self, other):
+        return any(
+            "exclusive" in (mode, other.uses[resource])
+            for resource, mode in self.uses.items()
+            if resource in other.uses)
+
+
+async def execute(steps):
+    """Run the steps of a plan, overlapping those that don't conflict.
+
+    A step never starts before an earlier step of the plan it conflicts
+    with, so conflicting steps keep the plan order. Returns the timeline as
+    a list of {"name", "status", "start_s", "end_s"}, in seconds since the
+    start of the plan."""
+    names = set()
+    for step in steps:
+        unknown = [dep for dep in step.after if dep not in names]
+        if (unknown):
+            raise ValueError(f"Step {step.name} runs after unknown or later "
+                             f"steps {unknown}")
+        names.add(step.name)
+
+    loop = asyncio.get_running_loop()
+    start = time.monotonic()
+    pending = list(steps)
+    running = dict()
+    finished = set()
+    timeline = list()
+
+    def record(step, status, step_start):
+        timeline.append({
+            "name": step.name,
+            "status": status,
+            "start_s": step_start - start,
+            "end_s": time.monotonic() - start,
+        })
+        finished.add(step.name)
+
+    while (pending or running):
+        started = False
+        for step in list(pending):
+            if (any(dep not in finished for dep in step.after)
+                    or any(step.conflicts(other)
+                           for other, _ in running.values())
+                    or any(step.conflicts(other)
+                           for other in pending[:pending.index(step)])):
+                continue
+            pending.remove(step)
+            if (step.when and not step.when()):
+                logging.info("Plan: skipping %s.", step.name)
+                record(step, "skipped", time.monotonic())
+                started = True
+                continue
+            logging.info("Plan: starting %s.", step.name)
+            task = loop.run_in_executor(None, step.func)
+            running[task] = (step, time.monotonic())
+            started = True
+        if (started):
+            # Skipped steps may unblock others
+            continue
+
+        if (not running):
+            raise RuntimeError("Plan is stuck on "
+                               f"{[step.name for step in pending]}")
+        done, _ = await asyncio.wait(
+            list(running), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            step, step_start = running.pop(task)
+            status = "done"
+            if (task.exception()):
+                status = "failed"
+                logging.error("Plan: step %s failed: %s", step.name,
+                              task.exception(), exc_info=task.exception())
+            record(step, status, step_start)
+    return timeline
+
+
+def run(steps, name="session", test_uuid=None, details=None):
+    """Run a plan and log its timeline, which is also written to
+    logs/session-timeline with the fields returned by details() if set.
+    Returns the timeline."""
+    timestamp = datetime.now(timezone.utc).astimezone().isoformat()
+    start = time.monotonic()
+    timeline = asyncio.run(execute(steps))
+    wall_s = time.monotonic() - start
+    # Time the same steps would have taken one after another
+    serial_s = sum(entry["end_s"] - entry["start_s"] for entry in timeline)
+
+    logging.info("Plan %s timeline:", name)
+    for entry in timeline:
+        logging.info("  %7.1fs - %7.1fs %-8s %s", entry["start_s"],
+                     entry["end_s"], entry["status"], entry["name"])
+    logging.info("Plan %s took %.1fs, %.1fs run one after another, saved "
+                 "%.1fs.", name, wall_s, serial_s, serial_s - wall_s)
+
+    try:
+        timeline_path = Path(f"logs/{timeline_dir}/{timestamp}.json")
+        timeline_path.parent.mkdir(exist_ok=True)
+        with open(timeline_path, "w") as timeline_file:
+            json.dump({
+                "timestamp": timestamp,
+                "plan": name,
+                "test_uuid": test_uuid,
+                "wall_s": wall_s,
+                "serial_s": serial_s,
+                "steps": timeline,
+                **(details() if details else dict())}, timeline_file)
+    except OSError as e:
+        logging.warning("Cannot write session timeline: %s", e)
+    return timeline
+
+
+def summarize(timelines):
+    # Mean wall-clock and serial time of the sessions of each plan name
+    by_plan = dict()
+    for timeline in timelines:
+        by_plan.setdefault(timeline["plan"], list()).append(timeline)
+    return {
+        plan: {
+            "sessions": len(plan_timelines),
+            "wall_s": (sum(timeline["wall_s"] for timeline in plan_timelines)
+                       / len(plan_timelines)),
+            "serial_s": (sum(timeline["serial_s"]
+                             for timeline in plan_timelines)
+                         / len(plan_timelines)),
+        }
+        for plan, plan_timelines in by_plan.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print session timelines as text charts.")
+    parser.add_argument("timelines", nargs="+",
+                        help="Files in logs/session-timeline.")
+    parser.add_argument("-w", "--width", type=int, default=60,
+                        help="Chart width in characters.")
+    parser.add_argument("-s", "--summary", action="store_true",
+                        help=("Only print the mean session time of each "
+                              "plan, e.g. session-toggle and session-bind."))
+    args = parser.parse_args()
+
+    timelines = list()
+    for timeline_path in args.timelines:
+        with open(timeline_path) as timeline_file:
+            timelines.append(json.load(timeline_file))
+    if (args.summary):
+        for plan, stats in summarize(timelines).items():
+            print(f"{plan}: {stats['sessions']} sessions, mean "
+                  f"{stats['wall_s']:.1f}s, {stats['serial_s']:.1f}s "
+                  "serial")
+        sys.exit(0)
+
+    for timeline_path, timeline in zip(args.timelines, timelines):
+        scale = args.width / max(timeline["wall_s"], 1e-3)
+        print(f"{timeline_path}: {timeline['wall_s']:.1f}s, "
+              f"{timeline['serial_s']:.1f}s serial")
+        for entry in timeline["steps"]:
+            offset = int(entry["start_s"] * scale)
+            length = max(int((entry["end_s"] - entry["start_s"]) * scale), 1)
+            bar = "-" if entry["status"] == "skipped" else "#"
+            print(f"  {entry['name']:<24} {' ' * offset}{bar * length}")
@@ -1,15 +1,27 @@
 from datetime import datetime, timedelta, timezone
 import firebase
+from functools import lru_cache
 from getpass import getuser
+import iface_state
+import iperf_ports
+import iperf_stream
 import json
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from logging import Formatter
+import math
+import nm_client
+import os
 from pathlib import Path
 import ping
+import result_store
 from random import randint, uniform
+import session_plan
+import signal
+import threading
 import time
 import utils
+from uploader import BackgroundUploader
 from uuid import uuid4
 import wifi_monitor
 import wifi_scan
@@ -48,91 +60,155 @@ def unblock_wlan(iface):
         time.sleep(1)
         return
 
-    driver_name = Path(utils.run_cmd(
-        f"readlink /sys/class/net/{iface}/device/driver",
-        f"Get interface {iface} driver path")).name.strip()
+    try:
+        driver_name = Path(
+            os.readlink(f"/sys/class/net/{iface}/device/driver")).name
+    except OSError as e:
+        logging.warning(f"Cannot get interface {iface} driver ! {e}")
+        return
 
-    # Reload driver
+    # Reload driver, waiting for the interface to go and come back
     utils.run_cmd(f"sudo modprobe -r {driver_name}")
-    time.sleep(0.5)
+    iface_state.wait_for(iface, lambda state: not state["exists"], 2)
     utils.run_cmd(f"sudo modprobe {driver_name}")
-    time.sleep(0.5)
+    iface_state.wait_for(iface, lambda state: state["exists"], 5)
 
     # RF-kill unblock
     utils.run_cmd("sudo rfkill block wlan")
-    time.sleep(0.5)
     utils.run_cmd("sudo rfkill unblock wlan")
-    time.sleep(0.5)
+    iface_state.wait_for(iface, lambda state: not state["blocked"], 2)
+
+
+def connection_active(iface, conn):
+    # Whether conn is the active NetworkManager connection of iface
+    result = utils.run_cmd(
+        ["sudo", "nmcli", "--terse", "--fields", "GENERAL.CONNECTION",
+         "device", "show", iface],
+        "Check interface {} connection".format(iface))
+    return result.strip().partition(":")[2] == conn
 
 
 def set_interface_down(iface, conn=False):
     logging.info("Setting interface %s down.", iface)
-    if (conn):
-        utils.run_cmd("sudo nmcli connection down '{}'".format(conn),
-                      "Set connection {} down".format(conn))
-    utils.run_cmd("sudo ip link set {} down".format(iface),
-                  "Set interface {} link down".format(iface))
+    with iface_state.transition(iface, "down") as entry:
+        if (not iface_state.link_state(iface)["up"]):
+            # Already down, so is the connection
+            entry["skipped"] = True
+            return
+        if (conn):
+            utils.run_cmd(["sudo", "nmcli", "connection", "down", conn],
+                          "Set connection {} down".format(conn))
+        utils.run_cmd("sudo ip link set {} down".format(iface),
+                      "Set interface {} link down".format(iface))
 
 
 def set_interface_up(iface, conn=False):
     logging.info("Setting interface %s up.", iface)
+    with iface_state.transition(iface, "up") as entry:
+        state = iface_state.link_state(iface)
+        if (state["up"] and (not conn or (state["operstate"] == "up"
+                                          and connection_active(iface, conn)))):
+            entry["skipped"] = True
+            return
 
-    retry_count = 0
-    retry_max = 10
-    while (retry_count < retry_max):
-        output = utils.run_cmd(
-            f"sudo ip link set {iface} up",
-            f"Set interface {iface} link up",
-            raw_out=True)
-        if (output['returncode'] == 0):
-            retry_count += retry_max
-        else:
+        retry_count = 0
+        retry_max = 10
+        while (not iface_state.link_state(iface)["up"]
+               and retry_count < retry_max):
+            output = utils.run_cmd(
+                f"sudo ip link set {iface} up",
+                f"Set interface {iface} link up",
+                raw_out=True)
+            if (output['returncode'] == 0):
+                break
             retry_count += 1
             unblock_wlan(iface)
             logging.debug(f"Error setting link up, retry count: {retry_count}")
 
-    if (conn):
-        retry_count = 0
-        retry_max = 10
-        while retry_count < retry_max:
-            output = utils.run_cmd("sudo nmcli connection up '{}'".format(conn),
-                                   "Set connection {} up".format(conn))
-            if (output.find("successfully") >= 0):
-                retry_count += retry_max
-            else:
-                retry_count += 1
-                time.sleep(1)
-                logging.debug("Error setting conn up, retry count: %s",
-                              retry_count)
+        if (conn):
+            retry_count = 0
+            retry_max = 10
+            while retry_count < retry_max:
+                events = iface_state.LinkEvents(iface)
+                try:
+                    output = utils.run_cmd(
+                        ["sudo", "nmcli", "connection", "up", conn],
+                        "Set connection {} up".format(conn))
+                    if (output.find("successfully") >= 0):
+                        # Wait for the carrier or association
+                        iface_state.wait_for(
+                            iface, lambda state: state["operstate"] == "up",
+                            5)
+                        break
+                    retry_count += 1
+                    logging.debug("Error setting conn up, retry count: %s",
+                                  retry_count)
+                    # Retry on the next link change instead of a fixed
+                    # delay, NetworkManager may have connected meanwhile
+                    if (events.wait(1) and connection_active(iface, conn)):
+                        break
+                finally:
+                    events.close()
 
 
 def enable_monitor(iface, conn=False):
     logging.info("Enabling interface %s as monitor.", iface)
-    is_monitor = "monitor" in (
-        utils.run_cmd("sudo iw dev {} info".format(iface),
-                      "Checking iface {} info".format(iface)))
-    logging.info("{} is monitor? {}".format(iface, is_monitor))
-    if (not is_monitor):
-        set_interface_down(iface, conn)
-        utils.run_cmd("sudo iw dev {} set type monitor".format(iface),
-                      "Set interface {} as monitor".format(iface))
-    set_interface_up(iface)
+    with iface_state.transition(iface, "monitor") as entry:
+        state = iface_state.link_state(iface)
+        logging.info("{} is monitor? {}".format(iface, state["monitor"]))
+        if (state["monitor"] and state["up"]):
+            entry["skipped"] = True
+            return
+        if (not state["monitor"]):
+            set_interface_down(iface, conn)
+            utils.run_cmd("sudo iw dev {} set type monitor".format(iface),
+                          "Set interface {} as monitor".format(iface))
+        set_interface_up(iface)
 
 
 def disable_monitor(iface, conn=False):
     logging.info("Disabling interface %s as monitor.", iface)
-    is_monitor = "monitor" in (
-        utils.run_cmd("sudo iw dev {} info".format(iface),
-                      "Checking iface {} info".format(iface)))
-    logging.info("{} is monitor? {}".format(iface, is_monitor))
-    if (is_monitor):
-        set_interface_down(iface)
-        utils.run_cmd("sudo iw dev {} set type managed".format(iface),
-                      "Set interface {} as managed".format(iface))
-    set_interface_up(iface, conn)
-
-
-def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
+    with iface_state.transition(iface, "managed"):
+        is_monitor = iface_state.link_state(iface)["monitor"]
+        logging.info("{} is monitor? {}".format(iface, is_monitor))
+        if (is_monitor):
+            set_interface_down(iface)
+            utils.run_cmd("sudo iw dev {} set type managed".format(iface),
+                          "Set interface {} as managed".format(iface))
+        set_interface_up(iface, conn)
+
+
+def pick_bssid(wifi_conn, wireless_iface, wireless_mode, wireless_bssid,
+               scan_backend):
+    # BSSID the connection should be locked to, "" for any
+    target_bssid = ""
+    logging.debug(f"Setting BSSID for mode {wireless_mode}.")
+    if (wireless_mode == "bssid"):
+        target_bssid = wireless_bssid
+    elif (wireless_mode != "auto"):
+        # Must be either 2.4ghz, 5ghz, or 6ghz
+        logging.info(f"Scanning on {wireless_iface} ...")
+        results = list(filter(
+            lambda x: ((x["ssid"] == wifi_conn["ssid"])
+                       and utils.freq_str_cmp(x["freq"], wireless_mode)),
+            wifi_scan.scan(wireless_iface, scan_backend)))
+        if (len(results) > 0):
+            results = sorted(
+                results,
+                key=lambda x: float(x["rssi"].split()[0]),
+                reverse=True)
+            target_bssid = results[0]["bssid"]
+        else:
+            logging.info(f"No matching Wi-Fi candidate found !")
+    else:
+        # Must be auto
+        pass
+    logging.info(f"Got target BSSID={target_bssid}.")
+    return target_bssid
+
+
+def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid,
+                  scan_backend="iwlist"):
     logging.info("Setting up network.")
 
     # Set all interface link up, just in case
@@ -140,6 +216,111 @@ def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
     set_interface_up(wireless_iface)
     disable_monitor(wireless_iface)
 
+    # Through NetworkManager's D-Bus API if possible, falling back to nmcli
+    with iface_state.transition(wireless_iface, "setup") as entry:
+        try:
+            client = nm_client.NMClient()
+            try:
+                conn_status = setup_network_dbus(
+                    client, wifi_conn, wireless_iface, wireless_mode,
+                    wireless_bssid, scan_backend)
+            finally:
+                client.close()
+            entry["backend"] = "dbus"
+            entry["dbus_calls"] = client.calls
+        except (ImportError,) + nm_client.dbus_errors as e:
+            logging.warning("Cannot set up network over D-Bus, using nmcli: "
+                            "%s", e)
+            conn_status = setup_network_nmcli(
+                wifi_conn, wireless_iface, wireless_mode, wireless_bssid,
+                scan_backend)
+            entry["backend"] = "nmcli"
+    return conn_status
+
+
+def setup_network_dbus(client, wifi_conn, wireless_iface, wireless_mode,
+                       wireless_bssid, scan_backend):
+    # Same steps as setup_network_nmcli, from one snapshot of the
+    # NetworkManager state, once NetworkManager allows the changes (else
+    # PermissionError falls back to nmcli before anything is changed)
+    client.check_permissions()
+    snapshot = client.snapshot()
+    conn_path = None
+    for path, settings in snapshot["connections"].items():
+        conn_id = nm_client.value(settings["connection"]["id"])
+        conn_type = nm_client.value(settings["connection"]["type"])
+        if (conn_type == "802-11-wireless" and wifi_conn):
+            # Delete the connection if wifi_conn available from Firebase
+            # and the current connection is not wifi_conn
+            if (wifi_conn["ssid"] != conn_id):
+                logging.info("Deleting wlan connection %s", conn_id)
+                client.delete(path)
+            else:
+                conn_path = path
+        elif (conn_type == "802-3-ethernet" and "eth0" in snapshot["devices"]
+                and nm_client.device_connection(snapshot, "eth0") != conn_id):
+            # If the connection is ethernet and not active, try to connect
+            logging.info("Activating eth connection %s", conn_id)
+            client.activate(path, snapshot["devices"]["eth0"]["path"])
+
+    # Try connect Wi-Fi using info from Firebase, nmcli picks the security
+    # from the scan results
+    if (not conn_path and wifi_conn):
+        result = utils.run_cmd(
+            ["sudo", "nmcli", "device", "wifi", "connect", wifi_conn["ssid"],
+             "password", wifi_conn["pass"]],
+            "Adding SSID '{}'".format(wifi_conn["ssid"]))
+        if (result.find("successfully") >= 0):
+            snapshot = client.snapshot(settings=False)
+            conn_path = nm_client.connection_path(snapshot,
+                                                  wifi_conn["ssid"])
+
+    if (conn_path and wireless_iface in snapshot["devices"]):
+        settings = (snapshot["connections"].get(conn_path)
+                    or client.get_settings(conn_path))
+        edit_iface = (nm_client.value(settings["connection"].get(
+            "interface-name", "")) != wireless_iface)
+        target_bssid = pick_bssid(wifi_conn, wireless_iface, wireless_mode,
+                                  wireless_bssid, scan_backend)
+        wireless = settings.setdefault("802-11-wireless", dict())
+        curr_bssid = nm_client.format_bssid(
+            nm_client.value(wireless.get("bssid", b"")))
+        edit_bssid = curr_bssid != target_bssid.upper()
+        logging.debug("Edit connection %s interface? %s BSSID? %s",
+                      wifi_conn["ssid"], edit_iface, edit_bssid)
+
+        # Both edits in a single settings update
+        if (edit_iface or edit_bssid):
+            settings["connection"]["interface-name"] = ("s", wireless_iface)
+            if (target_bssid):
+                wireless["bssid"] = (
+                    "ay", bytes.fromhex(target_bssid.replace(":", "")))
+            else:
+                wireless.pop("bssid", None)
+            client.update(conn_path, settings)
+
+        # Activate the connection unless it is active and unchanged
+        if (edit_iface or edit_bssid
+                or nm_client.device_connection(snapshot, wireless_iface)
+                != wifi_conn["ssid"]):
+            logging.info("Activating connection %s", wifi_conn["ssid"])
+            client.activate(conn_path,
+                            snapshot["devices"][wireless_iface]["path"])
+            iface_state.wait_for(
+                wireless_iface, lambda state: state["operstate"] == "up", 30)
+
+    # Check all interfaces status
+    snapshot = client.snapshot(settings=False)
+    eth_connection = nm_client.device_connection(snapshot, "eth0")
+    wifi_connection = nm_client.device_connection(snapshot, wireless_iface)
+    logging.debug("eth0 connection: %s.", eth_connection)
+    logging.debug("%s connection: %s.", wireless_iface, wifi_connection)
+
+    return {"eth": eth_connection, "wifi": wifi_connection}
+
+
+def setup_network_nmcli(wifi_conn, wireless_iface, wireless_mode,
+                        wireless_bssid, scan_backend):
     # Check available eth and wlan connection in nmcli
     conn_found = False
     result = utils.run_cmd("sudo nmcli --terse connection show",
@@ -151,8 +332,8 @@ def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
             # and the current connection is not wifi_conn
             if (wifi_conn["ssid"] != split[0]):
                 # Delete the possibly unused connection
-                utils.run_cmd(("sudo nmcli connection "
-                               "delete '{}'").format(split[0]),
+                utils.run_cmd(["sudo", "nmcli", "connection", "delete",
+                               split[0]],
                               "Deleting wlan connection {}".format(split[0]))
             else:
                 # Otherwise the connection is found
@@ -164,16 +345,16 @@ def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
     # Try connect Wi-Fi using info from Firebase
     if (not conn_found and wifi_conn):
         result = utils.run_cmd(
-            "sudo nmcli device wifi connect '{}' password '{}'".format(
-                wifi_conn["ssid"], wifi_conn["pass"]),
+            ["sudo", "nmcli", "device", "wifi", "connect", wifi_conn["ssid"],
+             "password", wifi_conn["pass"]],
             "Adding SSID '{}'".format(wifi_conn["ssid"]))
         conn_found = (result.find("successfully") >= 0)
 
     if (conn_found):
         # Check if the interface is correct
         conn_iface = utils.run_cmd(
-            ("sudo nmcli --fields connection.interface-name connection "
-             "show '{}'").format(wifi_conn["ssid"]),
+            ["sudo", "nmcli", "--fields", "connection.interface-name",
+             "connection", "show", wifi_conn["ssid"]],
             "Check connection {} interface".format(wifi_conn["ssid"]))
         edit_iface = wireless_iface not in conn_iface
         logging.debug("Edit connection %s interface? %s",
@@ -181,33 +362,12 @@ def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
 
         # Check if BSSID needs to be specified
         edit_bssid = False
-        target_bssid = ""
-        logging.debug(f"Setting BSSID for mode {wireless_mode}.")
-        if (wireless_mode == "bssid"):
-            target_bssid = wireless_bssid
-        elif (wireless_mode != "auto"):
-            # Must be either 2.4ghz, 5ghz, or 6ghz
-            logging.info(f"Scanning on {wireless_iface} ...")
-            results = list(filter(
-                lambda x: ((x["ssid"] == wifi_conn["ssid"])
-                           and utils.freq_str_cmp(x["freq"], wireless_mode)),
-                wifi_scan.scan(wireless_iface)))
-            if (len(results) > 0):
-                results = sorted(
-                    results,
-                    key=lambda x: float(x["rssi"].split()[0]),
-                    reverse=True)
-                target_bssid = results[0]["bssid"]
-            else:
-                logging.info(f"No matching Wi-Fi candidate found !")
-        else:
-            # Must be auto
-            pass
-        logging.info(f"Got target BSSID={target_bssid}.")
+        target_bssid = pick_bssid(wifi_conn, wireless_iface, wireless_mode,
+                                  wireless_bssid, scan_backend)
 
         conn_iface = utils.run_cmd(
-            ("sudo nmcli --fields 802-11-wireless.bssid connection "
-             "show '{}'").format(wifi_conn["ssid"]),
+            ["sudo", "nmcli", "--fields", "802-11-wireless.bssid",
+             "connection", "show", wifi_conn["ssid"]],
             "Check connection {} interface".format(wifi_conn["ssid"]))
         if (target_bssid == ""):
             edit_bssid = "--" not in conn_iface
@@ -219,30 +379,30 @@ def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
         # Proceed if connection need editing.
         if (edit_bssid or edit_iface):
             # Put new connection down temporarily for editing
-            utils.run_cmd(("sudo nmcli connection "
-                           "down '{}'").format(wifi_conn["ssid"]),
+            utils.run_cmd(["sudo", "nmcli", "connection", "down",
+                           wifi_conn["ssid"]],
                           ("Setting connection {} "
                            "down temporarily").format(wifi_conn["ssid"]))
             # Ensure that the connection is active on selected iface
             if (edit_iface):
                 utils.run_cmd(
-                    ("sudo nmcli connection modify '{}' "
-                     "connection.interface-name '{}'").format(
-                        wifi_conn["ssid"], wireless_iface),
+                    ["sudo", "nmcli", "connection", "modify",
+                     wifi_conn["ssid"], "connection.interface-name",
+                     wireless_iface],
                     "Setting connection '{}' to '{}'".format(
                         wifi_conn["ssid"], wireless_iface))
             # If BSSID is in connection info, add it
             if (edit_bssid):
                 utils.run_cmd(
-                    ("sudo nmcli connection modify '{}' "
-                     "802-11-wireless.bssid '{}'").format(
-                        wifi_conn["ssid"], target_bssid),
+                    ["sudo", "nmcli", "connection", "modify",
+                     wifi_conn["ssid"], "802-11-wireless.bssid",
+                     target_bssid],
                     "Setting connection '{}' BSSID to '{}'".format(
                         wifi_conn["ssid"], target_bssid))
 
         # Activate connection, should run whether the connection is up or down
-        utils.run_cmd(("sudo nmcli connection "
-                       "up '{}'").format(wifi_conn["ssid"]),
+        utils.run_cmd(["sudo", "nmcli", "connection", "up",
+                       wifi_conn["ssid"]],
                       ("Setting connection {} "
                        "up").format(wifi_conn["ssid"]))
 
@@ -263,28 +423,100 @@ def setup_network(wifi_conn, wireless_iface, wireless_mode, wireless_bssid):
     return {"eth": eth_connection, "wifi": wifi_connection}
 
 
-def run_iperf(test_uuid, server, port, direction, duration, dev, timeout_s):
-    # Run iperf command
-    iperf_cmd = ("iperf3 -c {} -p {} -t {} -P 8 -b 2000M -J").format(
-        server, port, duration)
-    if (direction == "dl"):
-        iperf_cmd += " -R"
-    result = utils.run_cmd(
-        iperf_cmd,
-        "Running iperf command",
-        log_result=False,
-        timeout_s=timeout_s)
+@lru_cache(maxsize=None)
+def iperf_json_stream():
+    # Whether iperf3 can stream its intervals (--json-stream, iperf3 3.17+)
+    return "--json-stream" in utils.run_cmd(
+        ["iperf3", "--help"], "Checking iperf3 options", log_result=False)
 
-    if (result):
-        result_json = json.loads(result)
+
+def stream_iperf(iperf_cmd, timeout_s, budget_gbytes, confidence):
+    # Run iperf with --json-stream, interrupting it once the data budget or
+    # the confidence target is reached, returns the result as iperf3 -J
+    stream = iperf_stream.IperfStream(budget_gbytes * 1e9, confidence)
+    proc = utils.run_cmd_async(iperf_cmd + " --json-stream",
+                               "Running iperf command")
+
+    def expire():
+        stream.stop_reason = "timeout"
+        try:
+            utils.signal_cmd_async(proc, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(timeout_s, expire)
+    timer.start()
+    try:
+        for line in proc.stdout:
+            stop_reason = stream.feed(line)
+            if (stop_reason):
+                # iperf3 reports the partial test and exits on SIGINT
+                logging.info("Stopping iperf, %s reached after %.1fs.",
+                             stop_reason, stream.seconds)
+                utils.signal_cmd_async(proc, signal.SIGINT)
+    finally:
+        timer.cancel()
+    result = utils.resolve_cmd_async(proc, "Resolving iperf command",
+                                     log_result=False, timeout_s=5,
+                                     raw_out=True)
+    if (result["returncode"] != 0 and not stream.stop_reason):
+        logging.warning("iperf error:\n%s",
+                        result["stderr"] or stream.error)
+
+    if (stream.stop_reason):
+        mean_bps, ci_bps = stream.throughput()
+        logging.info("iperf stopped early (%s) after %.1fs: %.1f +/- %.1f "
+                     "Mbps.", stream.stop_reason, stream.seconds,
+                     mean_bps / 1e6, ci_bps / 1e6)
+    return stream.result()
+
+
+def run_iperf(test_uuid, ports, direction, duration, dev, timeout_s,
+              bind=False, budget_gbytes=math.inf, confidence=0):
+    # Run iperf command on a free port of ports (iperf_ports.PortSelector),
+    # moving to another port right away if the server is busy. The test
+    # stops early once it has used budget_gbytes or measured the throughput
+    # within confidence, see iperf_stream.py
+    while True:
+        port = ports.pick(dev if bind else None)
+        if (port is None):
+            logging.warning("All iperf ports of %s are busy.", ports.server)
+            return 0
+        iperf_cmd = ("iperf3 -c {} -p {} -t {} -P 8 -b 2000M -J").format(
+            ports.server, port, duration)
+        if (direction == "dl"):
+            iperf_cmd += " -R"
+        if (bind):
+            # SO_BINDTODEVICE, the other interfaces are up
+            iperf_cmd += " --bind-dev {}".format(dev)
+        if (iperf_json_stream()):
+            result_json = stream_iperf(iperf_cmd, timeout_s, budget_gbytes,
+                                       confidence)
+        else:
+            # Older iperf3, the budget is only checked between tests
+            result = utils.run_cmd(
+                iperf_cmd,
+                "Running iperf command",
+                log_result=False,
+                timeout_s=timeout_s)
+            result_json = json.loads(result) if result else None
+        if (result_json
+                and iperf_ports.busy_reply(result_json.get("error"))):
+            # Taken between the probe and the test
+            logging.info("iperf port %d is busy, trying another one.", port)
+            ports.mark_busy(port)
+            continue
+        break
+
+    if (result_json):
         result_json["start"]["interface"] = dev
         result_json["start"]["test_uuid"] = test_uuid
 
         # Log this data
-        with open("logs/iperf-log/{}.json".format(
-            datetime.now(timezone.utc).astimezone().isoformat()
-        ), "w") as log_file:
-            log_file.write(json.dumps(result_json))
+        result_store.add(
+            "iperf", result_json,
+            datetime.now(timezone.utc).astimezone().isoformat(),
+            interface=dev, test_uuid=test_uuid)
 
         if direction == "dl":
             data_used = result_json["end"]["sum_received"]["bytes"] / 1e9
@@ -296,10 +528,13 @@ def run_iperf(test_uuid, server, port, direction, duration, dev, timeout_s):
         return 0
 
 
-def run_speedtest(test_uuid, timeout_s):
-    # Run the speedtest command
+def run_speedtest(test_uuid, timeout_s, dev, bind=False):
+    # Run the speedtest command on dev, pinned to it if bind is set
+    speedtest_cmd = "./speedtest --accept-license --format=json"
+    if (bind):
+        speedtest_cmd += " --interface={}".format(dev)
     result = utils.run_cmd(
-        "./speedtest --accept-license --format=json",
+        speedtest_cmd,
         "Running speedtest command",
         log_result=False,
         timeout_s=timeout_s)
@@ -309,10 +544,10 @@ def run_speedtest(test_uuid, timeout_s):
         result_json["test_uuid"] = test_uuid
 
         # Log this data
-        with open("logs/speedtest-log/{}.json".format(
-            datetime.now(timezone.utc).astimezone().isoformat()
-        ), "w") as log_file:
-            log_file.write(json.dumps(result_json))
+        result_store.add(
+            "speedtest", result_json,
+            datetime.now(timezone.utc).astimezone().isoformat(),
+            interface=dev, test_uuid=test_uuid)
 
         data_used = (result_json["download"]["bytes"]
                      + result_json["upload"]["bytes"]) / 1e9
@@ -322,29 +557,29 @@ def run_speedtest(test_uuid, timeout_s):
         return 0
 
 
-def scan_wifi(iface, extra):
+def scan_wifi(iface, extra, backend="iwlist"):
     # Run Wi-Fi scan
     logging.info("Starting Wi-Fi scan.")
-    results = wifi_scan.scan(iface)
+    results = wifi_scan.scan(iface, backend)
     timestamp = datetime.now(timezone.utc).astimezone().isoformat()
 
     # Log this data
-    with open("logs/wifi-scan/{}.json".format(timestamp), "w") as log_file:
-        log_file.write(
-            json.dumps({
-                "timestamp": timestamp,
-                "interface": iface,
-                "extra": extra,
-                "beacons": results}))
+    result_store.add(
+        "wifi_scan", {
+            "timestamp": timestamp,
+            "interface": iface,
+            "extra": extra,
+            "beacons": results},
+        timestamp, interface=iface, test_uuid=extra.get("test_uuid"))
     return results
 
 
-def scan_wifi_async(iface, link_wait=1):
+def scan_wifi_async(iface, link_wait=1, backend="iwlist", link_rate_hz=10):
     # Run Wi-Fi scan
     logging.info("Starting Wi-Fi scan.")
     return {
-        "proc_obj": wifi_scan.scan_async(iface, link_wait),
-        "proc_link": wifi_scan.link_async(iface),
+        "proc_obj": wifi_scan.scan_async(iface, link_wait, backend),
+        "proc_link": wifi_scan.link_async(iface, link_rate_hz),
         "timestamp": datetime.now(timezone.utc).astimezone().isoformat(),
         "iface": iface
     }
@@ -356,38 +591,38 @@ def resolve_scan_wifi_async(resolve_obj, extra):
     results = wifi_scan.resolve_scan_async(resolve_obj["proc_obj"])
 
     # Log this data
-    with open("logs/wifi-scan/{}.json".format(
-              resolve_obj["timestamp"]), "w") as log_file:
-        log_file.write(
-            json.dumps({
-                "timestamp": resolve_obj["timestamp"],
-                "interface": resolve_obj["iface"],
-                "extra": extra,
-                "beacons": results,
-                "links": results_link}))
+    result_store.add(
+        "wifi_scan", {
+            "timestamp": resolve_obj["timestamp"],
+            "interface": resolve_obj["iface"],
+            "extra": extra,
+            "beacons": results,
+            "links": results_link},
+        resolve_obj["timestamp"], interface=resolve_obj["iface"],
+        test_uuid=extra.get("test_uuid"))
     return results
 
 
-def run_ping(iface, extra, ping_target, ping_count):
+def run_ping(iface, extra, ping_target, ping_count, bind=False):
     # Run Wi-Fi scan
     logging.info("Starting ping.")
-    results = ping.ping(iface, ping_target, ping_count)
+    results = ping.ping(iface, ping_target, ping_count, bind)
     timestamp = datetime.now(timezone.utc).astimezone().isoformat()
 
     # Log this data
-    with open("logs/ping-log/{}.json".format(timestamp), "w") as log_file:
-        log_file.write(
-            json.dumps({
-                "timestamp": timestamp,
-                "interface": iface,
-                "extra": extra,
-                "pings": results}))
+    result_store.add(
+        "ping", {
+            "timestamp": timestamp,
+            "interface": iface,
+            "extra": extra,
+            "pings": results},
+        timestamp, interface=iface, test_uuid=extra.get("test_uuid"))
 
 
-def run_ping_async(iface, ping_target):
+def run_ping_async(iface, ping_target, bind=False):
     # Run Wi-Fi scan
     logging.info("Starting async ping.")
-    proc_obj = ping.ping_async(iface, ping_target)
+    proc_obj = ping.ping_async(iface, ping_target, bind)
     return {
         "proc_obj": proc_obj,
         "timestamp": datetime.now(timezone.utc).astimezone().isoformat(),
@@ -400,14 +635,313 @@ def resolve_run_ping_async(resolve_obj, extra):
     results = ping.resolve_ping_async(resolve_obj["proc_obj"])
 
     # Log this data
-    with open("logs/ping-log/{}.json".format(
-              resolve_obj["timestamp"]), "w") as log_file:
-        log_file.write(
-            json.dumps({
-                "timestamp": resolve_obj["timestamp"],
-                "interface": resolve_obj["iface"],
-                "extra": extra,
-                "pings": results}))
+    result_store.add(
+        "ping", {
+            "timestamp": resolve_obj["timestamp"],
+            "interface": resolve_obj["iface"],
+            "extra": extra,
+            "pings": results},
+        resolve_obj["timestamp"], interface=resolve_obj["iface"],
+        test_uuid=extra.get("test_uuid"))
+
+
+def bind_routes(iface, table):
+    """Route the traffic from the address of iface through its gateway with
+    routing table `table`, so tests bound to iface leave through it while the
+    other interfaces are up. Returns whether the routes are set."""
+    try:
+        routes = json.loads(utils.run_cmd(
+            f"ip -j -4 route show default dev {iface}",
+            f"Get interface {iface} default route") or "[]")
+        addrs = json.loads(utils.run_cmd(
+            f"ip -j -4 addr show dev {iface}",
+            f"Get interface {iface} address") or "[]")
+        rules = json.loads(utils.run_cmd(
+            "ip -j rule show", "Get routing rules") or "[]")
+    except ValueError as e:
+        logging.warning("Cannot read %s routes: %s", iface, e)
+        return False
+    gateway = routes[0].get("gateway") if routes else None
+    addr = next((info["local"] for entry in addrs
+                 for info in entry.get("addr_info", [])), None)
+    if (not gateway or not addr):
+        logging.warning("No address or gateway on %s, cannot bind routes.",
+                        iface)
+        return False
+
+    utils.run_cmd(
+        f"sudo ip route replace default via {gateway} dev {iface} "
+        f"table {table}",
+        f"Set table {table} default route")
+    found = False
+    for rule in rules:
+        if (str(rule.get("table")) != str(table)):
+            continue
+        if (rule.get("src") == addr):
+            found = True
+        elif (rule.get("src")):
+            # Left from a previous address
+            utils.run_cmd(
+                f"sudo ip rule del from {rule['src']} table {table}",
+                f"Delete stale rule of table {table}")
+    if (not found):
+        utils.run_cmd(f"sudo ip rule add from {addr} table {table}",
+                      f"Route {addr} through table {table}")
+    return True
+
+
+def plan_session(config, conn_status, uploader, session, active_tests):
+    """Steps of a measurement session for session_plan.
+
+    Every test holds the link and its interface exclusively, so the tests
+    run one at a time in the usual order, while the interface transitions,
+    scans, monitor capture and Firebase updates that don't touch the same
+    resources overlap with them. session holds the usage of the billing
+    cycle ("usage_gbytes") and of this session ("session_gbytes"), and the
+    last Wi-Fi scan results ("last_scan").
+
+    In the "bind" interface_mode both interfaces stay up and every test is
+    pinned to its interface, instead of taking the other one down."""
+    wlan = config["wireless_interface"]
+    bind = config["interface_mode"] == "bind"
+    link = {"link": "exclusive"}
+    # Scans hold the link shared so uploads stay paused until they finish
+    scan = {wlan: "exclusive", "link": "shared"}
+
+    # Ports found busy are skipped by the following iperf tests
+    ports = iperf_ports.PortSelector(
+        config["iperf_server"],
+        range(config["iperf_minport"], config["iperf_maxport"] + 1))
+
+    def under_cap():
+        return ((session["usage_gbytes"] + session["session_gbytes"])
+                < config["data_cap_gbytes"])
+
+    def ping_idle(iface):
+        run_ping(
+            iface,
+            extra={
+                "test_uuid": config["test_uuid"],
+                "corr_test": "idle"},
+            ping_target=config["ping_target"],
+            ping_count=config["ping_count"],
+            bind=bind)
+
+    def iperf(iface, direction):
+        # iperf with a concurrent ping, and a Wi-Fi scan over Wi-Fi
+        resolve_ping_obj = run_ping_async(
+            iface, ping_target=config["ping_target"], bind=bind)
+        if (iface == wlan):
+            resolve_scan_obj = scan_wifi_async(
+                wlan,
+                backend=config["scan_backend"],
+                link_rate_hz=config["link_sample_hz"])
+        session["session_gbytes"] += run_iperf(
+            test_uuid=config["test_uuid"],
+            ports=ports,
+            direction=direction, duration=config["iperf_duration"],
+            dev=iface, timeout_s=config["timeout_s"], bind=bind,
+            budget_gbytes=(config["data_cap_gbytes"]
+                           - session["usage_gbytes"]
+                           - session["session_gbytes"]),
+            confidence=config["iperf_confidence"])
+        resolve_run_ping_async(
+            resolve_ping_obj,
+            extra={
+                "test_uuid": config["test_uuid"],
+                "corr_test": f"iperf-{direction}"})
+        if (iface == wlan):
+            session["last_scan"] = resolve_scan_wifi_async(
+                resolve_scan_obj,
+                extra={
+                    "test_uuid": config["test_uuid"],
+                    "corr_test": f"iperf-{direction}"})
+            session["last_test"] = f"iperf-{direction}"
+
+    def speedtest(iface):
+        if (iface == wlan):
+            resolve_scan_obj = scan_wifi_async(
+                wlan,
+                backend=config["scan_backend"],
+                link_rate_hz=config["link_sample_hz"])
+        session["session_gbytes"] += run_speedtest(
+            test_uuid=config["test_uuid"],
+            timeout_s=config["timeout_s"],
+            dev=iface, bind=bind)
+        if (iface == wlan):
+            session["last_scan"] = resolve_scan_wifi_async(
+                resolve_scan_obj,
+                extra={
+                    "test_uuid": config["test_uuid"],
+                    "corr_test": "speedtest"})
+            session["last_test"] = "speedtest"
+
+    def scan_wifi_idle():
+        resolve_scan_obj = scan_wifi_async(
+            wlan,
+            backend=config["scan_backend"],
+            link_rate_hz=config["link_sample_hz"])
+        ping_idle(wlan)
+        session["last_scan"] = resolve_scan_wifi_async(
+            resolve_scan_obj,
+            extra={
+                "test_uuid": config["test_uuid"],
+                "corr_test": "idle"})
+        session["last_test"] = "idle"
+
+    def scan_wifi_link(corr_test):
+        # Asynchronous Wi-Fi scan which includes link
+        resolve_scan_obj = scan_wifi_async(
+            wlan,
+            backend=config["scan_backend"],
+            link_rate_hz=config["link_sample_hz"])
+        time.sleep(5)
+        session["last_scan"] = resolve_scan_wifi_async(
+            resolve_scan_obj,
+            extra={
+                "test_uuid": config["test_uuid"],
+                "corr_test": corr_test})
+
+    def scan_beacons():
+        # Wi-Fi beacon scan only
+        session["last_scan"] = scan_wifi(
+            wlan,
+            extra={
+                "test_uuid": config["test_uuid"],
+                "corr_test": "none"},
+            backend=config["scan_backend"])
+
+    def monitor():
+        enable_monitor(config["monitor_interface"], conn_status["wifi"])
+        wifi_monitor.monitor(
+            config["monitor_interface"],
+            config["monitor_duration"],
+            config["monitor_size"],
+            config["monitor_mode"],
+            session["last_scan"],
+            config["monitor_upload"],
+            config["monitor_profiles"],
+            config["monitor_channel_profiles"],
+            config["test_uuid"])
+        disable_monitor(config["monitor_interface"], conn_status["wifi"])
+
+    def bind_all():
+        if (conn_status["eth"]):
+            bind_routes("eth0", 100)
+        if (conn_status["wifi"]):
+            bind_routes(wlan, 101)
+
+    # Keep uploads off the link while measuring
+    steps = [session_plan.Step("pause-upload", uploader.pause, link)]
+    tests = list()
+    bound = list()
+    if (bind and active_tests):
+        steps.append(session_plan.Step(
+            "bind-routes", bind_all, {"eth0": "shared", wlan: "shared"}))
+        bound.append("bind-routes")
+
+    # Skips ethernet test if active tests are disabled since there are only
+    # active tests conducted over ethernet
+    if (conn_status["eth"] and active_tests):
+        eth = {"eth0": "exclusive", "link": "exclusive"}
+        after = list(bound)
+        if (conn_status["wifi"] and not bind):
+            steps.append(session_plan.Step(
+                "eth:wlan-down",
+                lambda: set_interface_down(wlan, conn_status["wifi"]),
+                {wlan: "exclusive"}))
+            after.append("eth:wlan-down")
+        if (config["iperf_ping_enabled"]):
+            tests += [
+                session_plan.Step("eth:ping-idle", lambda: ping_idle("eth0"),
+                                  eth, after),
+                session_plan.Step("eth:iperf-dl",
+                                  lambda: iperf("eth0", "dl"),
+                                  eth, after, under_cap),
+                session_plan.Step("eth:iperf-ul",
+                                  lambda: iperf("eth0", "ul"),
+                                  eth, after, under_cap)]
+        if (config["ookla_enabled"]):
+            tests.append(session_plan.Step(
+                "eth:speedtest", lambda: speedtest("eth0"),
+                eth, after, under_cap))
+        steps += tests
+        if (conn_status["wifi"] and not bind):
+            steps.append(session_plan.Step(
+                "eth:wlan-up",
+                lambda: set_interface_up(wlan, conn_status["wifi"]),
+                {wlan: "exclusive"}, [step.name for step in tests]))
+
+    # Skips Wi-Fi tests if active tests are disabled but only do one Wi-Fi
+    # scan
+    if (conn_status["wifi"] and active_tests):
+        wifi = {wlan: "exclusive", "link": "exclusive"}
+        wifi_tests = list()
+        after = list(bound)
+        if (conn_status["eth"] and not bind):
+            steps.append(session_plan.Step(
+                "wifi:eth-down",
+                lambda: set_interface_down("eth0", conn_status["eth"]),
+                {"eth0": "exclusive"}))
+            after.append("wifi:eth-down")
+        if (config["iperf_ping_enabled"]):
+            wifi_tests += [
+                session_plan.Step("wifi:ping-idle", scan_wifi_idle,
+                                  wifi, after),
+                session_plan.Step("wifi:iperf-dl",
+                                  lambda: iperf(wlan, "dl"),
+                                  wifi, after, under_cap),
+                session_plan.Step("wifi:iperf-ul",
+                                  lambda: iperf(wlan, "ul"),
+                                  wifi, after, under_cap)]
+        if (config["ookla_enabled"]):
+            wifi_tests.append(session_plan.Step(
+                "wifi:speedtest", lambda: speedtest(wlan),
+                wifi, after, under_cap))
+        tests += wifi_tests
+        steps += wifi_tests
+        # Last asynchronous Wi-Fi scan to capture beacon and link at the end
+        # of the test
+        steps.append(session_plan.Step(
+            "wifi:end-scan",
+            lambda: scan_wifi_link(f"end-{session['last_test']}"),
+            scan))
+        if (conn_status["eth"] and not bind):
+            # Ethernet comes back while the last scan runs
+            steps.append(session_plan.Step(
+                "wifi:eth-up",
+                lambda: set_interface_up("eth0", conn_status["eth"]),
+                {"eth0": "exclusive"},
+                [step.name for step in wifi_tests]))
+    elif (conn_status["wifi"]):
+        steps.append(session_plan.Step(
+            "scan", lambda: scan_wifi_link("none"), scan))
+    else:
+        steps.append(session_plan.Step(
+            "scan", scan_beacons, scan))
+
+    # run monitor mode if set up, after the scans in case the monitor mode
+    # picks the channels from the last scan
+    after_monitor = list()
+    if (config["monitor_interface"]):
+        scans = [step.name for step in steps
+                 if step.name in ("scan", "wifi:end-scan")]
+        uses = {config["monitor_interface"]: "exclusive"}
+        if (config["monitor_interface"] == wlan):
+            # Monitor mode takes the Wi-Fi connection down, keep uploads
+            # and Firebase updates for after the capture
+            uses["link"] = "shared"
+            after_monitor.append("monitor")
+        steps.append(session_plan.Step("monitor", monitor, uses, scans))
+
+    steps.append(session_plan.Step("resume-upload", uploader.resume, link))
+
+    steps.append(session_plan.Step(
+        "push-usage",
+        lambda: firebase.push_data_used(config["rpi_id"],
+                                        session["session_gbytes"]),
+        after=[step.name for step in tests] + after_monitor))
+    return steps
 
 
 def main():
@@ -417,12 +951,15 @@ def main():
 
     curr_usage_gbytes = firebase.get_data_used(config["rpi_id"])
     logging.info("Got latest usage data: %.3f GB", curr_usage_gbytes)
-    logging.info("Upload previously recorded logs on startup.")
-    temp_used = firebase.upload_directory(
+    # Uploads run in the background, rate limited and paused during the
+    # measurements
+    uploader = BackgroundUploader(
         source_dir=logdir,
-        rpi_id=config["rpi_id"])
-    firebase.push_data_used(config["rpi_id"], temp_used)
-    curr_usage_gbytes += temp_used
+        rpi_id=config["rpi_id"],
+        rate_mbps=config["upload_rate_mbps"])
+    uploader.start()
+    logging.info("Upload previously recorded logs on startup.")
+    uploader.wake()
     last_upload_time = datetime.now(timezone.utc).astimezone()
 
     # Get previous sleep interval
@@ -461,6 +998,7 @@ def main():
         logging.info("Starting tests.")
         # Update config
         config = firebase.read_config(mac)
+        uploader.set_rate(config["upload_rate_mbps"])
         # Random UUID to correlate WiFi scans and tests
         config["test_uuid"] = str(uuid4())
         logging.info("Config: %s", config)
@@ -472,262 +1010,54 @@ def main():
             config["wifi_conn"],
             config["wireless_interface"],
             config["wireless_mode"],
-            config["wireless_bssid"])
+            config["wireless_bssid"],
+            config["scan_backend"])
         logging.info("Connection status: %s", conn_status)
 
-        # Send heartbeat to indicate up status
-        firebase.push_heartbeat(config["rpi_id"])
-
         # If the Pi has turned on for more than 1 day, randomly pick a number
         # and check for the threshold. The default threshold is 0.25 since
         # we expect 6 daily test out of 24 hours.
         if (time.clock_gettime(time.CLOCK_BOOTTIME) < 86400
                 or uniform(0, 1) < config["sampling_threshold"]):
-            this_session_usage = 0
-            last_wifi_scan_results = list()
+            session = {
+                # Usage of the current billing cycle from the local ledger
+                "usage_gbytes": firebase.get_data_used(config["rpi_id"]),
+                "session_gbytes": 0,
+                "last_scan": list(),
+                "last_test": "none",
+            }
 
             # Whether to run throuhgput & ping tests
             enable_active_tests = (uniform(0, 1)
                 < config["active_tests_sampling_threshold"])
             logging.info("Is active tests enabled? %s", enable_active_tests)
 
-            # Skips ethernet test if active tests are disabled since
-            # there are only active tests conducted over ethernet
-            if (conn_status["eth"] and enable_active_tests):
-                logging.info("Starting tests over eth0.")
-                if (conn_status["wifi"]):
-                    set_interface_down(config["wireless_interface"],
-                                       conn_status["wifi"])
-
-                if (config["iperf_ping_enabled"]):
-                    # Run idle ping
-                    run_ping(
-                        "eth0",
-                        extra={
-                            "test_uuid": config["test_uuid"],
-                            "corr_test": "idle"},
-                        ping_target=config["ping_target"],
-                        ping_count=config["ping_count"])
-
-                    # Disabled while FMNC is down
-                    # run_fmnc()
-
-                    if ((curr_usage_gbytes + this_session_usage)
-                            < config["data_cap_gbytes"]):
-                        # iperf downlink
-                        resolve_ping_obj = run_ping_async(
-                            "eth0",
-                            ping_target=config["ping_target"])
-                        this_session_usage += run_iperf(
-                            test_uuid=config["test_uuid"],
-                            server=config["iperf_server"],
-                            port=randint(config["iperf_minport"],
-                                         config["iperf_maxport"]),
-                            direction="dl", duration=config["iperf_duration"],
-                            dev="eth0", timeout_s=config["timeout_s"])
-                        resolve_run_ping_async(
-                            resolve_ping_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "iperf-dl"})
-
-                    if ((curr_usage_gbytes + this_session_usage)
-                            < config["data_cap_gbytes"]):
-                        # iperf uplink
-                        resolve_ping_obj = run_ping_async(
-                            "eth0",
-                            ping_target=config["ping_target"])
-                        this_session_usage += run_iperf(
-                            test_uuid=config["test_uuid"],
-                            server=config["iperf_server"],
-                            port=randint(config["iperf_minport"],
-                                         config["iperf_maxport"]),
-                            direction="ul", duration=config["iperf_duration"],
-                            dev="eth0", timeout_s=config["timeout_s"])
-                        resolve_run_ping_async(
-                            resolve_ping_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "iperf-ul"})
-
-                if (config["ookla_enabled"]):
-                    if ((curr_usage_gbytes + this_session_usage)
-                            < config["data_cap_gbytes"]):
-                        # Ookla Speedtest
-                        this_session_usage += run_speedtest(
-                            test_uuid=config["test_uuid"],
-                            timeout_s=config["timeout_s"])
-
-                if (conn_status["wifi"]):
-                    set_interface_up(config["wireless_interface"],
-                                     conn_status["wifi"])
-
-            # Skips Wi-Fi tests if active tests are disabled but
-            # only do one Wi-Fi scan
-            if (conn_status["wifi"] and enable_active_tests):
-                logging.info("Starting tests over Wi-Fi.")
-                if (conn_status["eth"]):
-                    set_interface_down("eth0", conn_status["eth"])
-
-                if (config["iperf_ping_enabled"]):
-                    # Run idle ping
-                    resolve_scan_obj = scan_wifi_async(
-                        config["wireless_interface"])
-                    run_ping(
-                        config["wireless_interface"],
-                        extra={
-                            "test_uuid": config["test_uuid"],
-                            "corr_test": "idle"},
-                        ping_target=config["ping_target"],
-                        ping_count=config["ping_count"])
-                    last_wifi_scan_results = resolve_scan_wifi_async(
-                        resolve_scan_obj,
-                        extra={
-                            "test_uuid": config["test_uuid"],
-                            "corr_test": "idle"})
-
-                    # Disabled while FMNC is down
-                    # run_fmnc()
-
-                    # Keep track of last test for last Wi-Fi scan
-                    last_test = "idle"
-
-                    if ((curr_usage_gbytes + this_session_usage)
-                            < config["data_cap_gbytes"]):
-                        # iperf downlink
-                        resolve_ping_obj = run_ping_async(
-                            config["wireless_interface"],
-                            ping_target=config["ping_target"])
-                        resolve_scan_obj = scan_wifi_async(
-                            config["wireless_interface"])
-                        this_session_usage += run_iperf(
-                            test_uuid=config["test_uuid"],
-                            server=config["iperf_server"],
-                            port=randint(config["iperf_minport"],
-                                         config["iperf_maxport"]),
-                            direction="dl", duration=config["iperf_duration"],
-                            dev=config["wireless_interface"],
-                            timeout_s=config["timeout_s"])
-                        resolve_run_ping_async(
-                            resolve_ping_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "iperf-dl"})
-                        last_wifi_scan_results = resolve_scan_wifi_async(
-                            resolve_scan_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "iperf-dl"})
-                        last_test = "iperf-dl"
-
-                    if ((curr_usage_gbytes + this_session_usage)
-                            < config["data_cap_gbytes"]):
-                        # iperf uplink
-                        resolve_ping_obj = run_ping_async(
-                            config["wireless_interface"],
-                            ping_target=config["ping_target"])
-                        resolve_scan_obj = scan_wifi_async(
-                            config["wireless_interface"])
-                        this_session_usage += run_iperf(
-                            test_uuid=config["test_uuid"],
-                            server=config["iperf_server"],
-                            port=randint(config["iperf_minport"],
-                                         config["iperf_maxport"]),
-                            direction="ul", duration=config["iperf_duration"],
-                            dev=config["wireless_interface"],
-                            timeout_s=config["timeout_s"])
-                        resolve_run_ping_async(
-                            resolve_ping_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "iperf-ul"})
-                        last_wifi_scan_results = resolve_scan_wifi_async(
-                            resolve_scan_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "iperf-ul"})
-                        last_test = "iperf-ul"
-
-                if (config["ookla_enabled"]):
-                    if ((curr_usage_gbytes + this_session_usage)
-                            < config["data_cap_gbytes"]):
-                        # Ookla Speedtest
-                        resolve_scan_obj = scan_wifi_async(
-                            config["wireless_interface"])
-                        this_session_usage += run_speedtest(
-                            test_uuid=config["test_uuid"],
-                            timeout_s=config["timeout_s"])
-                        last_wifi_scan_results = resolve_scan_wifi_async(
-                            resolve_scan_obj,
-                            extra={
-                                "test_uuid": config["test_uuid"],
-                                "corr_test": "speedtest"})
-                        last_test = "speedtest"
-
-                # Run last asynchronous Wi-Fi scan to capture beacon and
-                # link at the end of the test
-                resolve_scan_obj = scan_wifi_async(
-                    config["wireless_interface"])
-                time.sleep(5)
-                # Resolve asynchronous Wi-Fi scan
-                last_wifi_scan_results = resolve_scan_wifi_async(
-                    resolve_scan_obj,
-                    extra={
-                        "test_uuid": config["test_uuid"],
-                        "corr_test": f"end-{last_test}"})
-
-                if (conn_status["eth"]):
-                    set_interface_up("eth0", conn_status["eth"])
-            else:
-                if (conn_status["wifi"]):
-                    # Run asynchronous Wi-Fi scan which includes link
-                    resolve_scan_obj = scan_wifi_async(
-                        config["wireless_interface"])
-                    time.sleep(5)
-                    # Resolve asynchronous Wi-Fi scan
-                    last_wifi_scan_results = resolve_scan_wifi_async(
-                        resolve_scan_obj,
-                        extra={
-                            "test_uuid": config["test_uuid"],
-                            "corr_test": "none"})
-                else:
-                    # Run Wi-Fi beacon scan only
-                    last_wifi_scan_results = scan_wifi(
-                        config["wireless_interface"],
-                        extra={
-                            "test_uuid": config["test_uuid"],
-                            "corr_test": "none"})
-
-            # run monitor mode if set up
-            if (config["monitor_interface"]):
-                enable_monitor(
-                    config["monitor_interface"],
-                    conn_status["wifi"])
-                wifi_monitor.monitor(
-                    config["monitor_interface"],
-                    config["monitor_duration"],
-                    config["monitor_size"],
-                    config["monitor_mode"],
-                    last_wifi_scan_results)
-                disable_monitor(
-                    config["monitor_interface"],
-                    conn_status["wifi"])
+            steps = plan_session(config, conn_status, uploader, session,
+                                 enable_active_tests)
+            # Send heartbeat to indicate up status
+            steps.insert(0, session_plan.Step(
+                "heartbeat",
+                lambda: firebase.push_heartbeat(config["rpi_id"])))
+            session_plan.run(
+                steps, f"session-{config['interface_mode']}",
+                test_uuid=config["test_uuid"],
+                details=lambda: {
+                    "interface_transitions": iface_state.drain()})
 
             # Upload
             curr_time = datetime.now(timezone.utc).astimezone()
             count_minutes = (curr_time - last_upload_time).total_seconds() / 60
             if (count_minutes > config["upload_interval"]):
-                this_session_usage += firebase.upload_directory(
-                    source_dir=logdir,
-                    rpi_id=config["rpi_id"])
+                uploader.wake()
                 last_upload_time = curr_time
             else:
                 logging.info("Skipping upload, there is %d minutes from last "
                              "upload time.", int(count_minutes))
-            firebase.push_data_used(config["rpi_id"], this_session_usage)
-            curr_usage_gbytes += this_session_usage
+            logging.info("Uploader: %s", uploader.stats())
 
         else:
+            # Send heartbeat to indicate up status
+            firebase.push_heartbeat(config["rpi_id"])
             logging.info("Skipping test due to randomized sampling.")
 
         # Sleep for interval + random backoff
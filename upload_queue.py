@@ -0,0 +1,420 @@
+import argparse
+import io
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from random import random
+import requests
+import resource
+import threading
+import time
+
+# Persistent index of the files waiting to be uploaded. Writers add a file
+# once it is complete, so an upload only looks at the manifest instead of
+# walking the logs tree. Records are JSON lines appended to manifest_path:
+#
+#   add:      {"type": "add", "path": p, "size": n}
+#   session:  {"type": "session", "path": p, "session": url}, resumable
+#             upload started
+#   progress: {"type": "progress", "path": p, "sent": n}, bytes confirmed
+#   fail:     {"type": "fail", "path": p, "attempts": n, "next_s": t,
+#              "error": "..."}, retry after the epoch time t
+#   done:     {"type": "done", "path": p}, uploaded and deleted
+#   seeded:   {"type": "seeded"}, files written before the manifest existed
+#             have been added
+#
+# An entry is pending until its done record, in-flight while it has a
+# resumable session. Failures back off exponentially per file.
+manifest_path = ".upload-manifest.jsonl"
+manifest_lock = threading.RLock()
+
+# Files larger than this are sent as resumable uploads in chunks of
+# chunk_size bytes (a multiple of 256 KiB as required by GCS), so an
+# interrupted upload continues from the last confirmed chunk
+resumable_threshold = 8 * 1024 * 1024
+chunk_size = 8 * 1024 * 1024
+chunk_timeout_s = 120
+
+backoff_base_s = 60
+backoff_max_s = 6 * 3600
+
+# Upload runs are recorded here, one JSON line each, see record_run()
+stats_path = ".upload-stats.jsonl"
+
+# Approximate memory per worker: a process imports google-cloud-storage on
+# its own, a thread only needs its request buffers
+process_worker_bytes = 80 * 1024 * 1024
+thread_worker_bytes = 4 * 1024 * 1024
+# Below this many bytes per batch, starting processes costs more than the
+# CPU they free up
+process_min_bytes = 64 * 1024 * 1024
+
+skip_suffixes = (".log", ".tmp")
+
+
+class Paused(Exception):
+    """Raised by a throttle to abort the upload in progress."""
+
+
+class ThrottledReader(io.BytesIO):
+    """Request body calling throttle(n) before n bytes go out, so the HTTP
+    client sends the data in small blocks at the throttle's pace."""
+
+    def __init__(self, data, throttle):
+        super().__init__(data)
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = super().read(size)
+        if (data):
+            self.throttle(len(data))
+        return data
+
+
+def append_records(path, records):
+    with manifest_lock:
+        with open(path, "a") as manifest_file:
+            for record in records:
+                manifest_file.write(json.dumps(record) + "\n")
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+
+def add(file_path, path=manifest_path):
+    # Queue a finished file for upload
+    file_path = Path(file_path).resolve()
+    append_records(path, [{
+        "type": "add",
+        "path": str(file_path),
+        "size": file_path.stat().st_size}])
+
+
+def read_meminfo_kb(key, path="/proc/meminfo"):
+    # Value of key in a /proc meminfo-style file in kB, None if unknown
+    try:
+        with open(path, "r") as meminfo_file:
+            for line in meminfo_file:
+                if (line.startswith(key + ":")):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Reset VmHWM so it reports the peak RSS from here on
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def plan_workers(sizes, max_workers=8, mem_bytes=None):
+    """Pick the worker type and count to upload files of the given sizes.
+
+    Uploads are mostly waiting on the network, so threads are used unless
+    the batch is large enough for the CPU to matter and there is memory for
+    a process per CPU. Either way the workers have to fit in half of the
+    available memory. Returns ("thread" | "process", count)."""
+    count = min(len(sizes), max_workers)
+    if (count <= 1):
+        return "thread", 1
+    if (mem_bytes is None):
+        mem_kb = read_meminfo_kb("MemAvailable")
+        mem_bytes = mem_kb * 1024 if mem_kb else None
+    budget = mem_bytes / 2 if mem_bytes else math.inf
+
+    cpus = os.cpu_count() or 1
+    if (cpus > 1 and count >= cpus and sum(sizes) >= process_min_bytes):
+        processes = min(count, cpus, budget // process_worker_bytes)
+        if (processes >= 2):
+            return "process", int(processes)
+    return "thread", int(max(min(count, budget // thread_worker_bytes), 1))
+
+
+def record_run(worker_type, workers, sizes, latencies_s, wall_s,
+               path=stats_path):
+    """Log an upload run and append it to path, with the latency of each
+    upload (None if they were not measured) and the peak RSS since
+    reset_peak_rss()."""
+    latencies_ms = sorted(latency * 1e3 for latency in latencies_s or list())
+    run = {
+        "time": time.time(),
+        "worker_type": worker_type,
+        "workers": workers,
+        "files": len(sizes),
+        "bytes": sum(sizes),
+        "wall_s": round(wall_s, 3),
+        "latency_ms": {
+            "min": round(latencies_ms[0], 1),
+            "median": round(latencies_ms[len(latencies_ms) // 2], 1),
+            "max": round(latencies_ms[-1], 1),
+        } if latencies_ms else None,
+        "mem_available_kb": read_meminfo_kb("MemAvailable"),
+        "peak_rss_kb": read_meminfo_kb("VmHWM", "/proc/self/status"),
+        "peak_rss_children_kb": resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+    logging.info("Upload run: %s", run)
+    try:
+        append_records(path, [run])
+    except OSError as e:
+        logging.warning("Cannot record upload run: %s", e)
+    return run
+
+
+def backoff_s(attempts):
+    # Exponential backoff with jitter, so failed files do not retry in step
+    delay = min(backoff_base_s * 2 ** (attempts - 1), backoff_max_s)
+    return delay * (0.5 + random() / 2)
+
+
+def query_offset(session, size):
+    """Ask GCS how much of a resumable upload it has. Returns the next offset
+    to send, size if the upload is complete, or None if the session is gone.
+    """
+    resp = requests.put(
+        session,
+        headers={"Content-Range": f"bytes */{size}"},
+        timeout=chunk_timeout_s)
+    if (resp.status_code in (200, 201)):
+        return size
+    elif (resp.status_code == 308):
+        # Range: bytes=0-<last byte received>, absent if nothing arrived
+        received = resp.headers.get("Range")
+        return int(received.split("-")[1]) + 1 if received else 0
+    elif (resp.status_code in (404, 410)):
+        return None
+    resp.raise_for_status()
+    raise IOError(f"Unexpected status {resp.status_code}")
+
+
+class UploadQueue:
+    """In-memory view of the manifest at `path`.
+
+    refresh() reads the records appended since the last call, so the cost
+    of finding the files to upload depends on the number of new files, not
+    on the size of the backlog. The manifest is rewritten with only the
+    pending entries once finished entries make up most of it."""
+
+    def __init__(self, path=manifest_path):
+        self.path = path
+        self.entries = dict()
+        self.offset = 0
+        self.lines = 0
+        self.seeded = False
+
+    def apply(self, record):
+        if (record["type"] == "seeded"):
+            self.seeded = True
+            return
+        file_path = record["path"]
+        if (record["type"] == "add"):
+            self.entries[file_path] = {
+                "size": record["size"],
+                "attempts": record.get("attempts", 0),
+                "next_s": record.get("next_s", 0),
+                "session": record.get("session"),
+                "sent": record.get("sent", 0)}
+            return
+        entry = self.entries.get(file_path)
+        if (entry is None):
+            return
+        if (record["type"] == "session"):
+            entry["session"] = record["session"]
+            entry["sent"] = 0
+        elif (record["type"] == "progress"):
+            entry["sent"] = record["sent"]
+        elif (record["type"] == "fail"):
+            entry["attempts"] = record["attempts"]
+            entry["next_s"] = record["next_s"]
+        elif (record["type"] == "done"):
+            del self.entries[file_path]
+
+    def append(self, record):
+        append_records(self.path, [record])
+        with manifest_lock:
+            self.refresh()
+
+    def refresh(self):
+        # Apply the complete records appended since the last refresh
+        with manifest_lock:
+            if (not os.path.isfile(self.path)):
+                return
+            with open(self.path, "rb") as manifest_file:
+                if (os.fstat(manifest_file.fileno()).st_size < self.offset):
+                    # Rewritten by another queue, start over
+                    self.entries = dict()
+                    self.offset = 0
+                    self.lines = 0
+                    self.seeded = False
+                manifest_file.seek(self.offset)
+                data = manifest_file.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                self.lines += 1
+                try:
+                    self.apply(json.loads(line))
+                except Exception as e:
+                    logging.warning("Skipping bad manifest record %s: %s",
+                                    line, e)
+            self.offset += end
+            if (end < len(data)):
+                # A record cut short by a crash, drop it so appends stay
+                # line-aligned
+                logging.warning("Dropping partial manifest record: %s",
+                                data[end:])
+                with open(self.path, "rb+") as manifest_file:
+                    manifest_file.truncate(self.offset)
+
+    def compact(self):
+        # Rewrite the manifest with one add record per pending entry
+        with manifest_lock:
+            self.refresh()
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as manifest_file:
+                if (self.seeded):
+                    manifest_file.write(json.dumps({"type": "seeded"}) + "\n")
+                for file_path, entry in self.entries.items():
+                    manifest_file.write(json.dumps(
+                        {"type": "add", "path": file_path, **entry}) + "\n")
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+            os.replace(tmp_path, self.path)
+            self.offset = os.path.getsize(self.path)
+            self.lines = len(self.entries) + self.seeded
+
+    def bootstrap(self, source_dir):
+        """Add the files already under source_dir to a new manifest. This is
+        the only time the whole tree is walked."""
+        with manifest_lock:
+            self.refresh()
+            if (self.seeded):
+                return 0
+            file_paths = [
+                path.resolve() for path in Path(source_dir).rglob("*")
+                if path.is_file() and not path.name.endswith(skip_suffixes)]
+            append_records(self.path, [{
+                "type": "add",
+                "path": str(path),
+                "size": path.stat().st_size} for path in file_paths
+                if str(path) not in self.entries] + [{"type": "seeded"}])
+            self.refresh()
+            logging.info("Seeded upload manifest with %d files.",
+                         len(file_paths))
+            return len(file_paths)
+
+    def due(self, now_s=None):
+        # Entries ready for an attempt, oldest first
+        now_s = now_s or time.time()
+        with manifest_lock:
+            self.refresh()
+            if (self.lines > 64 and self.lines > 4 * len(self.entries)):
+                self.compact()
+            return [(file_path, dict(entry))
+                    for file_path, entry in self.entries.items()
+                    if entry["next_s"] <= now_s]
+
+    def stats(self):
+        with manifest_lock:
+            self.refresh()
+            return {
+                "pending": len(self.entries),
+                "pending_bytes": sum(
+                    entry["size"] for entry in self.entries.values()),
+                "in_flight": sum(
+                    1 for entry in self.entries.values() if entry["session"]),
+                "backing_off": sum(
+                    1 for entry in self.entries.values()
+                    if entry["next_s"] > time.time()),
+            }
+
+    def done(self, file_path):
+        # Delete the local copy once it is uploaded
+        try:
+            Path(file_path).unlink()
+        except FileNotFoundError:
+            pass
+        self.append({"type": "done", "path": file_path})
+
+    def fail(self, file_path, error):
+        with manifest_lock:
+            attempts = self.entries[file_path]["attempts"] + 1
+        self.append({
+            "type": "fail",
+            "path": file_path,
+            "attempts": attempts,
+            "next_s": time.time() + backoff_s(attempts),
+            "error": str(error)})
+
+    def upload_resumable(self, blob, file_path, entry, throttle=None):
+        """Send file_path to blob in chunks, continuing a previous session if
+        there is one. Returns the number of bytes sent."""
+        size = entry["size"]
+        offset = None
+        if (entry["session"]):
+            offset = query_offset(entry["session"], size)
+            if (offset is None):
+                logging.info("Upload session of %s expired, restarting.",
+                             file_path)
+        if (offset is None):
+            entry["session"] = blob.create_resumable_upload_session(size=size)
+            self.append({
+                "type": "session",
+                "path": file_path,
+                "session": entry["session"]})
+            offset = 0
+        elif (offset > 0):
+            logging.info("Resuming upload of %s at %d/%d bytes.",
+                         file_path, offset, size)
+
+        sent = 0
+        with open(file_path, "rb") as upload_file:
+            upload_file.seek(offset)
+            while offset < size:
+                chunk = upload_file.read(chunk_size)
+                if (not chunk):
+                    raise IOError(f"{file_path} is shorter than {size} bytes")
+                end = offset + len(chunk) - 1
+                resp = requests.put(
+                    entry["session"],
+                    data=(ThrottledReader(chunk, throttle) if throttle
+                          else chunk),
+                    headers={"Content-Range": f"bytes {offset}-{end}/{size}"},
+                    timeout=chunk_timeout_s)
+                sent += len(chunk)
+                if (resp.status_code in (200, 201)):
+                    offset = size
+                elif (resp.status_code == 308):
+                    received = resp.headers.get("Range")
+                    offset = int(received.split("-")[1]) + 1 if received else 0
+                    upload_file.seek(offset)
+                    self.append({
+                        "type": "progress",
+                        "path": file_path,
+                        "sent": offset})
+                else:
+                    resp.raise_for_status()
+                    raise IOError(f"Unexpected status {resp.status_code}")
+        return sent
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Show the files waiting in the upload manifest.")
+    parser.add_argument("--manifest", default=manifest_path,
+                        help="Manifest path.")
+    args = parser.parse_args()
+
+    queue = UploadQueue(args.manifest)
+    queue.refresh()
+    now_s = time.time()
+    for file_path, entry in queue.entries.items():
+        state = "in-flight" if entry["session"] else "pending"
+        wait_s = max(entry["next_s"] - now_s, 0)
+        print(f"{file_path}: {state}, {entry['size']} bytes, "
+              f"{entry['attempts']} attempts, retry in {wait_s:.0f} s")
+    print(json.dumps(queue.stats()))
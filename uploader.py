@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+import firebase
+import logging
+import threading
+import time
+import upload_queue
+
+
+class TokenBucket:
+    """Token bucket of rate_bps bytes per second holding up to burst_bytes.
+    A rate of 0 means unlimited."""
+
+    def __init__(self, rate_bps, burst_bytes):
+        self.rate_bps = rate_bps
+        self.burst_bytes = burst_bytes
+        self.tokens = burst_bytes
+        self.last = time.monotonic()
+
+    def set_rate(self, rate_bps, burst_bytes):
+        self.refill()
+        self.rate_bps = rate_bps
+        self.burst_bytes = burst_bytes
+        self.tokens = min(self.tokens, burst_bytes)
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * self.rate_bps,
+                          self.burst_bytes)
+        self.last = now
+
+    def take(self, n):
+        """Take n bytes if there are enough tokens and return 0, otherwise
+        return the seconds to wait before trying again."""
+        if (self.rate_bps <= 0):
+            return 0
+        self.refill()
+        need = min(n, self.burst_bytes)
+        if (self.tokens >= need):
+            # Larger requests than the bucket can hold go into debt
+            self.tokens -= n
+            return 0
+        return (need - self.tokens) / self.rate_bps
+
+
+class BackgroundUploader:
+    """Runs firebase.upload_directory in a background thread.
+
+    Uploads are rate limited by a token bucket of rate_mbps (0 for no
+    limit) and stop while the measurement loop holds a pause, an upload
+    in progress is aborted and resumes from its last chunk afterwards.
+    The uploaded bytes are recorded with firebase.push_data_used after
+    every run."""
+
+    def __init__(self, source_dir, rpi_id, rate_mbps=0, burst_s=1):
+        self.source_dir = source_dir
+        self.rpi_id = rpi_id
+        self.burst_s = burst_s
+        self.bucket = TokenBucket(0, 0)
+        self.set_rate(rate_mbps)
+        self.cond = threading.Condition()
+        self.pauses = 0
+        self.busy = False
+        self.pending = False
+        self.thread = None
+        self.run_bytes = 0
+        self.total_bytes = 0
+        self.total_active_s = 0
+        self.runs = 0
+
+    def set_rate(self, rate_mbps):
+        rate_bps = rate_mbps * 1e6 / 8
+        self.bucket.set_rate(rate_bps, max(rate_bps * self.burst_s,
+                                           upload_queue.chunk_size / 64))
+
+    def throttle(self, n):
+        # Called by the upload for every block before it is sent
+        with self.cond:
+            while True:
+                if (self.pauses):
+                    raise upload_queue.Paused()
+                wait_s = self.bucket.take(n)
+                if (wait_s <= 0):
+                    self.run_bytes += n
+                    return
+                self.cond.wait(wait_s)
+
+    def wake(self):
+        # Ask for an upload, it starts as soon as there is no pause
+        with self.cond:
+            self.pending = True
+            self.cond.notify_all()
+
+    def pause(self):
+        """Stop uploading until resume() and wait for the upload in progress
+        to stop sending. The upload stops at its next throttle() call, at
+        most one file or chunk block away, or after the process batch in
+        flight when there is no rate limit."""
+        with self.cond:
+            self.pauses += 1
+            self.cond.notify_all()
+            start = time.monotonic()
+            self.cond.wait_for(lambda: not self.busy)
+            if (time.monotonic() - start > 1):
+                logging.info("Waited %.1fs for the upload to pause.",
+                             time.monotonic() - start)
+
+    def resume(self):
+        with self.cond:
+            self.pauses = max(self.pauses - 1, 0)
+            self.cond.notify_all()
+
+    @contextmanager
+    def paused(self):
+        self.pause()
+        try:
+            yield
+        finally:
+            self.resume()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending and not self.pauses)
+                self.pending = False
+                self.busy = True
+                self.run_bytes = 0
+            start = time.monotonic()
+            try:
+                # Also with no rate limit, the throttle counts the bytes
+                # and aborts on a pause. With a rate limit, files over the
+                # burst go through the chunked path
+                firebase.upload_directory(
+                    source_dir=self.source_dir,
+                    rpi_id=self.rpi_id,
+                    throttle=self.throttle,
+                    batch_bytes=(self.bucket.burst_bytes
+                                 if self.bucket.rate_bps > 0 else None))
+            except Exception as e:
+                logging.error("Upload failed: %s", e, exc_info=1)
+            active_s = time.monotonic() - start
+
+            with self.cond:
+                self.busy = False
+                run_bytes = self.run_bytes
+                self.total_bytes += run_bytes
+                self.total_active_s += active_s
+                self.runs += 1
+                if (self.pauses):
+                    # Interrupted, finish after the pause
+                    self.pending = True
+                self.cond.notify_all()
+
+            if (run_bytes):
+                logging.info("Uploaded %d bytes in %.1fs, %.2f Mbps.",
+                             run_bytes, active_s,
+                             run_bytes * 8 / active_s / 1e6)
+                try:
+                    firebase.push_data_used(self.rpi_id, run_bytes / 1e9)
+                except Exception as e:
+                    logging.error("Cannot record upload usage: %s", e)
+
+    def start(self):
+        if (not self.thread):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "runs": self.runs,
+                "bytes": self.total_bytes,
+                "active_s": self.total_active_s,
+                "throughput_mbps": (
+                    self.total_bytes * 8 / self.total_active_s / 1e6
+                    if self.total_active_s else 0),
+                "paused": self.pauses > 0,
+            }
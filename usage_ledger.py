@@ -0,0 +1,162 @@
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import threading
+
+
+def continues(cycle, timestamp):
+    # Whether timestamp is still in the billing cycle, the same rule the
+    # data_used entries in Firebase have always used
+    return ((timestamp - cycle["start"]).days < 32
+            and timestamp.day >= cycle["last"].day)
+
+
+class UsageLedger:
+    """Crash-safe local record of data usage per billing cycle.
+
+    Every change is appended to `path` as a JSON line and fsync'd before it
+    is applied, replaying the file gives the cycles back. The ledger is the
+    source of truth for usage, `sync_func` copies it to Firebase in the
+    background: it is called as sync_func(cycle) with the cycle's Firebase
+    key (None if not pushed yet) and returns the key it wrote to. Pending
+    records are batched into one write per cycle.
+
+    Record types:
+      usage:  {"type": "usage", "time": iso, "gbytes": x}
+      import: {"type": "import", "start": iso, "last": iso, "gbytes": x,
+               "key": k}, the latest Firebase entry when the ledger started
+      sync:   {"type": "sync", "start": iso, "last": iso, "gbytes": x,
+               "key": k}, written to Firebase up to here"""
+
+    def __init__(self, path, sync_func=None, import_func=None):
+        self.path = path
+        self.sync_func = sync_func
+        self.import_func = import_func
+        self.lock = threading.Lock()
+        self.cycles = list()
+        self.imported = False
+        self.sync_event = threading.Event()
+        self.sync_thread = None
+        self.load()
+
+    def load(self):
+        if (not os.path.isfile(self.path)):
+            return
+        with open(self.path, "rb+") as ledger_file:
+            data = ledger_file.read()
+            # Drop a record cut short by a crash so appends stay line-aligned
+            end = data.rfind(b"\n") + 1
+            if (end < len(data)):
+                logging.warning("Dropping partial ledger record: %s",
+                                data[end:])
+                ledger_file.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                self.apply(json.loads(line))
+            except Exception as e:
+                logging.warning("Skipping bad ledger record %s: %s", line, e)
+        logging.info("Loaded usage ledger with %d cycles.", len(self.cycles))
+
+    def apply(self, record):
+        cycle = self.cycles[-1] if self.cycles else None
+        if (record["type"] == "usage"):
+            timestamp = datetime.fromisoformat(record["time"])
+            if (cycle and continues(cycle, timestamp)):
+                cycle["gbytes"] += record["gbytes"]
+                cycle["last"] = timestamp
+            else:
+                self.cycles.append({
+                    "start": timestamp,
+                    "last": timestamp,
+                    "gbytes": record["gbytes"],
+                    "key": None,
+                    "synced": None})
+        elif (record["type"] == "import"):
+            self.imported = True
+            if (not record["start"]):
+                # Nothing in Firebase yet
+                return
+            imported = {
+                "start": datetime.fromisoformat(record["start"]),
+                "last": datetime.fromisoformat(record["last"]),
+                "gbytes": record["gbytes"],
+                "key": record["key"]}
+            imported["synced"] = (imported["last"], imported["gbytes"])
+            if (not cycle):
+                self.cycles.append(imported)
+            elif (not cycle["key"] and continues(imported, cycle["start"])):
+                # Usage recorded before the import is part of the same cycle
+                cycle["start"] = imported["start"]
+                cycle["gbytes"] += imported["gbytes"]
+                cycle["key"] = imported["key"]
+                cycle["synced"] = imported["synced"]
+        elif (record["type"] == "sync"):
+            start = datetime.fromisoformat(record["start"])
+            for cycle in self.cycles:
+                if (cycle["start"] == start):
+                    cycle["key"] = record["key"]
+                    cycle["synced"] = (datetime.fromisoformat(record["last"]),
+                                       record["gbytes"])
+
+    def append(self, record):
+        with self.lock:
+            with open(self.path, "a") as ledger_file:
+                ledger_file.write(json.dumps(record) + "\n")
+                ledger_file.flush()
+                os.fsync(ledger_file.fileno())
+            self.apply(record)
+
+    def usage(self, now=None):
+        # Usage of the billing cycle at now in GB
+        now = now or datetime.now(timezone.utc).astimezone()
+        with self.lock:
+            if (self.cycles and continues(self.cycles[-1], now)):
+                return self.cycles[-1]["gbytes"]
+        return 0
+
+    def record(self, gbytes, now=None):
+        now = now or datetime.now(timezone.utc).astimezone()
+        self.append({
+            "type": "usage",
+            "time": now.isoformat(timespec="seconds"),
+            "gbytes": gbytes})
+        self.sync_event.set()
+
+    def sync(self):
+        # Write every cycle with unsynced records, one write per cycle
+        if (not self.imported and self.import_func):
+            found = self.import_func()
+            self.append({"type": "import", **found} if found
+                        else {"type": "import", "start": None})
+        with self.lock:
+            pending = [dict(cycle) for cycle in self.cycles
+                       if cycle["synced"] != (cycle["last"], cycle["gbytes"])]
+        for cycle in pending:
+            key = self.sync_func(cycle)
+            self.append({
+                "type": "sync",
+                "start": cycle["start"].isoformat(timespec="seconds"),
+                "last": cycle["last"].isoformat(timespec="seconds"),
+                "gbytes": cycle["gbytes"],
+                "key": key})
+        return len(pending)
+
+    def run_sync(self, interval_s):
+        while True:
+            self.sync_event.wait(interval_s)
+            self.sync_event.clear()
+            try:
+                count = self.sync()
+                if (count):
+                    logging.info("Synced %d usage ledger cycles.", count)
+            except Exception as e:
+                logging.warning("Cannot sync usage ledger: %s", e)
+
+    def start_sync(self, interval_s=600):
+        # Sync in the background after each record, retrying every interval
+        if (not self.sync_thread):
+            self.sync_thread = threading.Thread(
+                target=self.run_sync, args=(interval_s,), daemon=True)
+            self.sync_thread.start()
+            self.sync_event.set()
@@ -1,7 +1,16 @@
+import cmd_broker
 import logging
 import os
+import shlex
 import subprocess
 import signal
+import time
+
+# Route "sudo" commands through cmd_broker if it is running
+use_broker = True
+
+# Shell syntax that keeps a command on the "sudo" + shell path
+shell_chars = set(";|&<>$`(){}*?~\\\n")
 
 
 def hex_to_bssid(input_string):
@@ -26,6 +35,23 @@ def freq_str_to_mhz(freq_str):
         return 0
 
 
+def freq_to_channel(freq):
+    # Channel number of a frequency in MHz
+    if (freq == 2484):
+        return 14
+    elif (freq >= 2412 and freq < 2484):
+        return (freq - 2407) // 5
+    elif (freq == 5935):
+        return 2
+    elif (freq >= 5955 and freq <= 7115):
+        return (freq - 5950) // 5
+    elif (freq >= 5000 and freq < 5925):
+        return (freq - 5000) // 5
+    else:
+        logging.warning(f"Unknown frequency {freq} !")
+        return 0
+
+
 def freq_str_cmp(freq_str, cmp_str):
     freq = freq_str_to_mhz(freq_str)
     if (cmp_str == "2.4ghz"):
@@ -65,32 +91,70 @@ def sanitize(cmd):
         raise Exception("Symbols not allowed in cmd!")
 
 
+def broker_argv(cmd):
+    # Get the argv of a "sudo" command that cmd_broker can run instead
+    if (not use_broker or not cmd_broker.available()):
+        return None
+    if (isinstance(cmd, str)):
+        if (any(c in shell_chars for c in cmd)):
+            return None
+        try:
+            cmd = shlex.split(cmd)
+        except ValueError:
+            return None
+    if (len(cmd) > 1 and cmd[0] == "sudo"
+            and cmd_broker.check_argv(cmd[1:])):
+        return cmd[1:]
+    return None
+
+
+def cmd_to_str(cmd):
+    return cmd if isinstance(cmd, str) else shlex.join(cmd)
+
+
 def run_cmd(cmd, logging_prefix="Running command", log_result=True,
             timeout_s=None, raw_out=False):
-    sanitize(cmd)
-    logging.info("%s: %s.", logging_prefix, cmd)
+    # cmd is either a shell command string, or an argv list which never goes
+    # through a shell
+    if (isinstance(cmd, str)):
+        sanitize(cmd)
+    logging.info("%s: %s.", logging_prefix, cmd_to_str(cmd))
 
     try:
-        result = subprocess.run(
-            cmd,
-            timeout=timeout_s,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=True)
-        if (raw_out):
-            return {
+        start = time.monotonic()
+        argv = broker_argv(cmd)
+        result = None
+        if (argv):
+            try:
+                result = cmd_broker.run(argv, timeout_s, os.getcwd())
+            except (ConnectionError, FileNotFoundError, PermissionError) as e:
+                logging.warning("Command broker error, using sudo: %s", e)
+        if (not result):
+            result = subprocess.run(
+                cmd,
+                timeout=timeout_s,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                shell=isinstance(cmd, str))
+            result = {
                 "returncode": result.returncode,
                 "stdout": result.stdout.decode("utf-8"),
                 "stderr": result.stderr.decode("utf-8")
             }
-        elif (result.returncode == 0 or not result.stderr):
-            output = result.stdout.decode("utf-8")
+        logging.debug("%s took %.1f ms%s.", logging_prefix,
+                      (time.monotonic() - start) * 1e3,
+                      " through broker" if argv else "")
+
+        if (raw_out):
+            return result
+        elif (result["returncode"] == 0 or not result["stderr"]):
+            output = result["stdout"]
             if (log_result):
                 logging.debug(output)
             return output
         else:
             logging.warning("%s error:\n%s", logging_prefix,
-                            result.stderr.decode("utf-8"))
+                            result["stderr"])
             return ""
     except subprocess.TimeoutExpired as e:
         logging.warning("%s error: %s", logging_prefix, e)
@@ -115,15 +179,30 @@ def run_cmd(cmd, logging_prefix="Running command", log_result=True,
 
 
 def run_cmd_async(cmd, logging_prefix="Running async command"):
-    sanitize(cmd)
-
-    logging.info("%s: %s.", logging_prefix, cmd)
+    if (isinstance(cmd, str)):
+        sanitize(cmd)
+
+    logging.info("%s: %s.", logging_prefix, cmd_to_str(cmd))
+    argv = broker_argv(cmd)
+    if (argv):
+        try:
+            return cmd_broker.BrokerProcess(argv, os.getcwd())
+        except (ConnectionError, FileNotFoundError, PermissionError) as e:
+            logging.warning("Command broker error, using sudo: %s", e)
     return subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
         preexec_fn=os.setsid,
-        shell=True)
+        shell=isinstance(cmd, str))
+
+
+def signal_cmd_async(proc, sig):
+    # Signal the process group of a run_cmd_async process
+    if (isinstance(proc, cmd_broker.BrokerProcess)):
+        proc.send_signal(sig)
+    else:
+        os.killpg(os.getpgid(proc.pid), sig)
 
 
 def resolve_cmd_async(proc, logging_prefix="Resolving async command",
@@ -132,7 +211,7 @@ def resolve_cmd_async(proc, logging_prefix="Resolving async command",
     logging.info("%s.", logging_prefix)
     try:
         if kill:
-            os.killpg(os.getpgid(proc.pid), signal.SIGINT)
+            signal_cmd_async(proc, signal.SIGINT)
             logging.debug("Process terminated.")
 
         out, err = proc.communicate(timeout=timeout_s)
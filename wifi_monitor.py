@@ -1,8 +1,49 @@
+import bisect
 from datetime import datetime, timezone
+import json
 import logging
+import math
+import os
 from pathlib import Path
+import queue
+import result_store
+import shlex
+import signal
+import struct
+import subprocess
+import tempfile
+import threading
 import time
+import upload_queue
 import utils
+import zipfile
+
+try:
+    import pcap_summary
+except ImportError:
+    # NumPy missing, only raw captures can be kept
+    pcap_summary = None
+
+# Per-channel activity of the past sweeps, seeds the dwell schedule
+activity_path = ".monitor-activity.json"
+# Weight of the latest sweep in the activity average
+activity_alpha = 0.5
+# Share of the dwell time every channel gets as a probe
+probe_fraction = 0.2
+# Frames waiting for the writer thread, tcpdump blocks (and the kernel drops
+# frames) rather than the capture filling up the memory
+queue_frames = 10000
+
+# Capture profiles: a BPF filter compiled by tcpdump into the kernel and a
+# snaplen, None for the monitor_size of the config. "monitor_profiles" in the
+# config adds or overrides profiles, and "monitor_channel_profiles" picks
+# them by channel ("6ghz_37_80"), band ("2.4ghz") or "default".
+capture_profiles = {
+    "full": {"filter": "", "snaplen": None},
+    # Radiotap, 802.11 and LLC headers of every frame
+    "headers": {"filter": "", "snaplen": 128},
+    "mgmt-only": {"filter": "type mgt", "snaplen": None},
+}
 
 # List of channel targets:
 # 6 GHz channels BW 80 MHz, 5 GHz channels BW 40 MHz, and 2.4 GHz channels BW 20 MHz
@@ -58,8 +99,346 @@ channel_list = [
 ]
 
 
+class ChannelHopper:
+    """Sweep channels with a single tcpdump on the monitor interface.
+
+    The radio is retuned between dwell windows while tcpdump keeps running,
+    and each frame goes to the channel whose window holds its timestamp.
+    A window stays open until the next hop, so dwell() can extend it.
+    Frames from the retune gaps are dropped. The frames of each channel are
+    compressed into their own pcap member of zip_file (unless it is None)
+    and, if summarize is set, written to a temporary pcap in tmp_dir that
+    pcap_summary reads through a memory map, both by a writer thread
+    overlapping with the capture of the next channel. Channels without
+    frames get an empty member, stats and summary."""
+
+    def __init__(self, zip_file, monitor_iface, packet_size, summarize=False,
+                 bpf_filter="", tmp_dir=None):
+        self.zip_file = zip_file
+        self.monitor_iface = monitor_iface
+        self.packet_size = packet_size
+        self.summarize = summarize
+        self.bpf_filter = bpf_filter
+        self.tmp_dir = tmp_dir
+        self.lock = threading.Lock()
+        self.starts = list()
+        self.windows = list()
+        self.window_frames = list()
+        self.frames = queue.Queue(maxsize=queue_frames)
+        self.ready = threading.Event()
+        self.header = None
+        self.gap_frames = 0
+        self.late_frames = 0
+        self.channel_stats = list()
+        self.summaries = list()
+
+    def start(self, timeout_s=5):
+        self.proc = utils.run_cmd_async(
+            (["sudo", "tcpdump", "-i", self.monitor_iface,
+              "-s", str(self.packet_size), "-U", "-w", "-"]
+             + shlex.split(self.bpf_filter)),
+            (f"Capture Wi-Fi packets on {self.monitor_iface}, size "
+             f"{self.packet_size}, filter '{self.bpf_filter}'"))
+        self.reader = threading.Thread(target=self.read, daemon=True)
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.reader.start()
+        self.writer.start()
+        # tcpdump writes the pcap header once it is capturing
+        self.ready.wait(timeout_s)
+        self.sweep_start = time.time()
+        return self.ready.is_set()
+
+    def hop(self, ch, file_name, duration):
+        self.close_window()
+        set_freq_cmd = (f"sudo iw dev {self.monitor_iface} set freq "
+                        f"{ch['primary_center_freq']} {ch['width']}")
+        if (ch['width'] > 20):
+            set_freq_cmd += f" {ch['center_freq']}"
+        result = utils.run_cmd(
+            set_freq_cmd,
+            (f"Set iface {self.monitor_iface} freq "
+             f"{ch['primary_center_freq']} {ch['width']} "
+             f"{ch['center_freq']}"),
+            raw_out=True)
+        if (result['returncode'] != 0):
+            logging.warning(f"Cannot set {self.monitor_iface} freq ! "
+                            f"{result['stderr']}")
+            return False
+
+        window_start = time.time()
+        with self.lock:
+            self.starts.append(window_start)
+            self.windows.append([window_start, math.inf, file_name,
+                                 ch['primary_center_freq']])
+            self.window_frames.append(0)
+        self.dwell(duration)
+        return True
+
+    def dwell(self, duration):
+        # Stay on the current channel for duration more seconds
+        time.sleep(duration)
+
+    def close_window(self):
+        with self.lock:
+            if (self.windows and self.windows[-1][1] == math.inf):
+                self.windows[-1][1] = time.time()
+
+    def last_window(self):
+        # Seconds since the current window opened and its frame count
+        with self.lock:
+            return (time.time() - self.windows[-1][0],
+                    self.window_frames[-1])
+
+    def stop(self, timeout_s=5):
+        logging.info('Resolving Wi-Fi packet capture.')
+        self.close_window()
+        sweep_end = time.time()
+        utils.signal_cmd_async(self.proc, signal.SIGINT)
+        self.reader.join(timeout_s)
+        if (self.reader.is_alive()):
+            utils.signal_cmd_async(self.proc, signal.SIGKILL)
+            self.reader.join()
+        try:
+            self.proc.wait(timeout=timeout_s)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        err = self.proc.stderr.read().decode("utf-8", "replace")
+        if (self.proc.returncode not in (0, -signal.SIGINT)
+                and not self.header):
+            logging.warning(f"tcpdump failed ! {err}")
+        self.frames.put(None)
+        self.writer.join()
+
+        capture_s = sum(end - start for start, end, *_ in self.windows)
+        sweep_s = sweep_end - self.sweep_start
+        return {
+            "channels": len(self.windows),
+            "capture_s": capture_s,
+            "sweep_s": sweep_s,
+            "capture_fraction": capture_s / sweep_s if sweep_s > 0 else 0,
+            "gap_frames": self.gap_frames,
+            "late_frames": self.late_frames,
+        }
+
+    def window_of(self, timestamp):
+        # Index of the dwell window holding timestamp, None if in a gap
+        with self.lock:
+            i = bisect.bisect_right(self.starts, timestamp) - 1
+            if (i >= 0 and timestamp < self.windows[i][1]):
+                self.window_frames[i] += 1
+                return i
+        return None
+
+    def read(self):
+        stdout = self.proc.stdout
+        header = stdout.read(24)
+        if (len(header) < 24):
+            return
+        magic = header[:4]
+        if (magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1")):
+            record = struct.Struct("<IIII")
+        else:
+            record = struct.Struct(">IIII")
+        # Microsecond or nanosecond timestamps
+        ts_scale = 1e-9 if magic in (b"\x4d\x3c\xb2\xa1",
+                                     b"\xa1\xb2\x3c\x4d") else 1e-6
+        self.header = header
+        self.ready.set()
+
+        while True:
+            record_header = stdout.read(record.size)
+            if (len(record_header) < record.size):
+                break
+            ts_sec, ts_frac, incl_len, _ = record.unpack(record_header)
+            data = stdout.read(incl_len)
+            if (len(data) < incl_len):
+                break
+            i = self.window_of(ts_sec + ts_frac * ts_scale)
+            if (i is None):
+                self.gap_frames += 1
+            else:
+                self.frames.put((i, record_header + data))
+
+    def open_channel(self, i):
+        # Zip member and temporary pcap of channel i, both with the header
+        member = None
+        pcap = None
+        if (self.zip_file):
+            member = self.zip_file.open(
+                self.windows[i][2], "w", force_zip64=True)
+            member.write(self.header)
+        if (self.summarize):
+            pcap = tempfile.NamedTemporaryFile(
+                dir=self.tmp_dir, suffix=".pcap.tmp", delete=False)
+            pcap.write(self.header)
+        return member, pcap
+
+    def close_empty(self, start, end):
+        # Channels start to end - 1 captured no frames
+        for i in range(start, end):
+            member, pcap = self.open_channel(i)
+            self.close_channel(i, member, pcap, len(self.header), 0)
+
+    def write(self):
+        current = None
+        member = None
+        pcap = None
+        captured = 0
+        frames = 0
+        for i, data in iter(self.frames.get, None):
+            if (current is not None and i < current):
+                # Arrived after the next channel started
+                self.late_frames += 1
+                continue
+            if (i != current):
+                if (current is not None):
+                    self.close_channel(current, member, pcap, captured,
+                                       frames)
+                self.close_empty(0 if current is None else current + 1, i)
+                current = i
+                member, pcap = self.open_channel(i)
+                captured = len(self.header)
+                frames = 0
+            if (member):
+                member.write(data)
+            if (pcap):
+                pcap.write(data)
+            captured += len(data)
+            frames += 1
+        if (current is not None):
+            self.close_channel(current, member, pcap, captured, frames)
+        if (self.header):
+            self.close_empty(0 if current is None else current + 1,
+                             len(self.windows))
+
+    def close_channel(self, i, member, pcap, captured, frames):
+        window_start, window_end, file_name, freq = self.windows[i]
+        stats = {
+            "file_name": file_name,
+            "frames": frames,
+            "captured_bytes": captured,
+            "capture_s": window_end - window_start,
+        }
+        if (member):
+            member.close()
+            written = self.zip_file.getinfo(file_name).compress_size
+            stats["written_bytes"] = written
+            stats["ratio"] = captured / max(written, 1)
+            logging.info(f"Capture finished ! {file_name}: {frames} frames, "
+                         f"{captured} -> {written} bytes, ratio "
+                         f"{stats['ratio']:.1f}x.")
+        if (pcap):
+            pcap.close()
+            try:
+                summaries = (pcap_summary.summarize_file(pcap.name)
+                             if frames else list())
+                # A channel without frames still gets its zero summary
+                for summary in (summaries
+                                or [pcap_summary.empty_summary(freq)]):
+                    self.summaries.append({"file_name": file_name, **summary})
+            except Exception as e:
+                logging.warning(f"Cannot summarize {file_name} ! {e}")
+            finally:
+                os.unlink(pcap.name)
+        self.channel_stats.append(stats)
+
+
+def channel_key(ch):
+    return f"{ch['freq_label']}_{ch['primary_ch']}_{ch['width']}"
+
+
+class DwellSchedule:
+    """Splits a sweep budget of duration seconds per channel by activity.
+
+    Every channel is probed for probe_fraction of duration, then stays for
+    its share of the remaining budget, weighted by the frames/s seen in the
+    probe averaged with the past sweeps in activity_path. Channels not yet
+    visited are weighted by their history, or by the mean probe rate of
+    this sweep if they have none, so the sweep never exceeds the budget."""
+
+    def __init__(self, target_chs, duration, path=activity_path):
+        self.path = Path(path)
+        try:
+            self.history = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.history = dict()
+        self.remaining = [channel_key(ch) for ch in target_chs]
+        self.budget_s = len(target_chs) * duration
+        self.probe_s = duration * probe_fraction
+        self.spent_s = 0
+        self.probe_rates = list()
+        self.dwells = dict()
+
+    def expected_rate(self, key):
+        if (key in self.history):
+            return self.history[key]
+        if (self.probe_rates):
+            return sum(self.probe_rates) / len(self.probe_rates)
+        return 0
+
+    def extra_s(self, key, probe_rate):
+        """Seconds to stay on channel key after a probe that saw probe_rate
+        frames/s."""
+        self.remaining.remove(key)
+        self.spent_s += self.probe_s
+        self.probe_rates.append(probe_rate)
+        weight = probe_rate
+        if (key in self.history):
+            weight = (activity_alpha * probe_rate
+                      + (1 - activity_alpha) * self.history[key])
+        others = sum(self.expected_rate(other) for other in self.remaining)
+        # Keep the probes of the remaining channels in the budget
+        left_s = (self.budget_s - self.spent_s
+                  - self.probe_s * len(self.remaining))
+        if (weight <= 0 or left_s <= 0):
+            return 0
+        extra_s = left_s * weight / (weight + others)
+        self.spent_s += extra_s
+        return extra_s
+
+    def skip(self, key):
+        # The channel could not be tuned, its probe goes to the others
+        self.remaining.remove(key)
+
+    def record(self, key, dwell_s, frames):
+        rate = frames / dwell_s if dwell_s > 0 else 0
+        self.dwells[key] = dwell_s
+        if (key in self.history):
+            rate = (activity_alpha * rate
+                    + (1 - activity_alpha) * self.history[key])
+        self.history[key] = rate
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.history))
+        os.replace(tmp_path, self.path)
+
+
+def channel_profile(ch, channel_profiles):
+    # Capture profile of a channel, by channel key, then band, then default
+    for key in (channel_key(ch), ch['freq_label'], "default"):
+        if (key in channel_profiles):
+            return channel_profiles[key]
+    return "full"
+
+
+def sweep_channels(hopper, chs, schedule):
+    for ch in chs:
+        key = channel_key(ch)
+        if (not hopper.hop(ch, f"capture_{key}.pcap", schedule.probe_s)):
+            schedule.skip(key)
+            continue
+        probe_s, frames = hopper.last_window()
+        extra_s = schedule.extra_s(key, frames / probe_s)
+        if (extra_s > 0):
+            hopper.dwell(extra_s)
+        schedule.record(key, *hopper.last_window())
+
+
 def monitor(monitor_iface, duration, packet_size=765, mode='all',
-            last_scan=None):
+            last_scan=None, upload='raw', profiles=None,
+            channel_profiles=None, test_uuid=None):
     # Determine target channels
     target_chs = list()
     if (mode == 'all'):
@@ -77,50 +456,122 @@ def monitor(monitor_iface, duration, packet_size=765, mode='all',
     logging.info(f"Capturing {len(target_chs)} channels !")
     if (len(target_chs) > 0):
         logging.debug(target_chs)
-        capture_files = list()
+        curr_datetime = datetime.now(timezone.utc).astimezone().isoformat()
+        zip_path = Path(f"logs/pcap-log/{curr_datetime}.zip")
+        tmp_path = zip_path.with_name(zip_path.name + ".tmp")
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        # Keep the raw pcaps, their summaries or both
+        if (upload not in ('raw', 'summary', 'both')):
+            logging.error(f"Unknown monitor upload {upload}, using raw !")
+            upload = 'raw'
+        keep_raw = upload in ('raw', 'both')
+        summarize = upload in ('summary', 'both')
+        if (summarize and pcap_summary is None):
+            logging.warning("NumPy is not available, keeping raw captures !")
+            keep_raw, summarize = True, False
+
+        # One tcpdump for the whole sweep, each channel's frames are
+        # compressed into their own member of one zip file, the raw pcaps
+        # never touch the disk
+        zip_file = (zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED)
+                    if keep_raw else None)
+        # One tcpdump per capture profile, with its filter and snaplen
+        profiles = {**capture_profiles, **(profiles or dict())}
+        groups = dict()
         for ch in target_chs:
-            set_freq_cmd = (f"sudo iw dev {monitor_iface} set freq "
-                            f"{ch['primary_center_freq']} {ch['width']}")
-            if (ch['width'] > 20):
-                set_freq_cmd += f" {ch['center_freq']}"
-            result = utils.run_cmd(
-                set_freq_cmd,
-                (f"Set iface {monitor_iface} freq "
-                 f"{ch['primary_center_freq']} {ch['width']} "
-                 f"{ch['center_freq']}"),
-                raw_out=True)
-            if (result['returncode'] != 0):
-                logging.warning(f"Cannot set {monitor_iface} freq ! "
-                                f"{result['stderr']}")
-                continue
+            name = channel_profile(ch, channel_profiles or dict())
+            if (name not in profiles):
+                logging.error(f"Unknown capture profile {name}, using full !")
+                name = "full"
+            groups.setdefault(name, list()).append(ch)
 
-            file_name = Path(f"capture_{ch['freq_label']}_{ch['primary_ch']}_"
-                             f"{ch['width']}.pcap")
-            proc = utils.run_cmd_async(
-                (f"sudo tcpdump -i {monitor_iface} -s {packet_size} "
-                 f"-w {file_name}"),
-                (f"Capture Wi-Fi packets on {monitor_iface}, size {packet_size}"
-                 f" to {file_name}"))
-            time.sleep(duration)
-            utils.resolve_cmd_async(
-                proc,
-                'Resolving Wi-Fi packet capture',
-                timeout_s=duration + 1,
-                kill=True)
-            logging.info('Capture finished !')
-            capture_files.append(file_name)
-
-        completed_capture_files = [fn for fn in capture_files if fn.is_file()]
-        if (len(completed_capture_files) > 0):
-            logging.info(f"Zipping {len(completed_capture_files)} pcap files.")
-            curr_datetime = datetime.now(timezone.utc).astimezone().isoformat()
-            files_str = " ".join([str(fn) for fn in completed_capture_files])
-            utils.run_cmd(
-                f"zip logs/pcap-log/{curr_datetime}.zip {files_str}",
-                'Zipping all capture files.')
-            # Delete capture files afterwards
-            for fn in completed_capture_files:
-                fn.unlink()
-        else:
+        schedule = DwellSchedule(target_chs, duration)
+        sweep_start = time.time()
+        sweeps = list()
+        capture_stats = list()
+        summaries = list()
+        profile_stats = dict()
+        for name, chs in groups.items():
+            profile = profiles[name]
+            hopper = ChannelHopper(zip_file, monitor_iface,
+                                   profile["snaplen"] or packet_size,
+                                   summarize, profile["filter"],
+                                   zip_path.parent)
+            if (hopper.start()):
+                sweep_channels(hopper, chs, schedule)
+            else:
+                logging.warning("tcpdump did not start capturing !")
+                for ch in chs:
+                    schedule.skip(channel_key(ch))
+            sweep = hopper.stop()
+            sweeps.append(sweep)
+            for stats in hopper.channel_stats:
+                stats["profile"] = name
+            capture_stats += hopper.channel_stats
+            summaries += hopper.summaries
+
+            captured = sum(stats["captured_bytes"]
+                           for stats in hopper.channel_stats)
+            profile_stats[name] = {
+                "filter": profile["filter"],
+                "snaplen": profile["snaplen"] or packet_size,
+                "channels": len(chs),
+                "capture_s": sweep["capture_s"],
+                "captured_bytes": captured,
+                "bytes_per_s": (captured / sweep["capture_s"]
+                                if sweep["capture_s"] > 0 else 0),
+            }
+            logging.info(f"Profile {name}: {captured} bytes in "
+                         f"{sweep['capture_s']:.1f}s, "
+                         f"{profile_stats[name]['bytes_per_s']:.0f} B/s.")
+        schedule.save()
+
+        capture_s = sum(sweep["capture_s"] for sweep in sweeps)
+        sweep_s = time.time() - sweep_start
+        sweep_stats = {
+            "channels": sum(sweep["channels"] for sweep in sweeps),
+            "capture_s": capture_s,
+            "sweep_s": sweep_s,
+            "capture_fraction": capture_s / sweep_s if sweep_s > 0 else 0,
+            "gap_frames": sum(sweep["gap_frames"] for sweep in sweeps),
+            "late_frames": sum(sweep["late_frames"] for sweep in sweeps),
+            "budget_s": schedule.budget_s,
+            "dwell_s": schedule.dwells,
+            "profiles": profile_stats,
+        }
+        logging.info(f"Sweep: {sweep_stats}")
+        if (len(capture_stats) > 0):
+            result_store.add("monitor", {
+                "sweep": sweep_stats,
+                "channels": capture_stats}, curr_datetime, monitor_iface,
+                test_uuid)
+
+        if (zip_file and len(capture_stats) > 0):
+            zip_file.writestr("capture_stats.json", json.dumps({
+                "sweep": sweep_stats,
+                "channels": capture_stats}))
+            zip_file.close()
+            os.replace(tmp_path, zip_path)
+            upload_queue.add(zip_path)
+            captured = sum(stats["captured_bytes"] for stats in capture_stats)
+            written = zip_path.stat().st_size
+            logging.info(f"Wrote {len(capture_stats)} captures to {zip_path}:"
+                         f" {captured} -> {written} bytes, ratio "
+                         f"{captured / max(written, 1):.1f}x.")
+        elif (zip_file):
+            zip_file.close()
+            tmp_path.unlink()
             logging.info("No completed captures, skip zipping...")
 
+        if (summarize and len(capture_stats) > 0):
+            # Packed into the log bundle with the other results
+            summary_path = Path(f"logs/pcap-summary/{curr_datetime}.json")
+            summary_path.parent.mkdir(exist_ok=True)
+            with open(summary_path, "w") as summary_file:
+                json.dump({
+                    "sweep": sweep_stats,
+                    "channels": capture_stats,
+                    "summaries": summaries}, summary_file)
+            logging.info(f"Wrote {len(summaries)} channel summaries "
+                         f"to {summary_path}: "
+                         f"{summary_path.stat().st_size} bytes.")